@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# coding=UTF-8
+#
+"""
+Compare the throughput of each hash algorithm that scanner.py can use, on the local disk.
+
+A file of random data is written to the directory given with --dir (by default, a temporary directory),
+read once so that it is in the page cache, and then hashed with every algorithm and buffer size.
+Run it on the file system you intend to scan. Use --size larger than RAM to measure the disk rather than the cache.
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+import scanner
+
+MiB = 1024 * 1024
+
+def make_file(dirname, size):
+    fd, path = tempfile.mkstemp(dir=dirname, suffix=".bench")
+    with os.fdopen(fd, "wb") as f:
+        remaining = size
+        while remaining > 0:
+            block = os.urandom(min(remaining, 16 * MiB))
+            f.write(block)
+            remaining -= len(block)
+    return path
+
+def time_hash(path, algorithm, bufsize):
+    t0 = time.time()
+    with open(path, "rb") as f:
+        scanner.hash_file(f, algorithm, bufsize)
+    return time.time() - t0
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compare hash algorithm throughput',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--dir", help="Directory for the test file (default is a temporary directory)")
+    parser.add_argument("--size", help="Size of the test file in MiB", type=int, default=256)
+    parser.add_argument("--bufsize", help="Comma-separated read buffer sizes in bytes",
+                        default="{},{},{}".format(scanner.HASH_BUFSIZE, MiB, 8 * MiB))
+    parser.add_argument("--repeat", help="Times to hash with each setting; the fastest is reported", type=int, default=3)
+    args = parser.parse_args()
+
+    path = make_file(args.dir, args.size * MiB)
+    try:
+        time_hash(path, scanner.DEFAULT_HASH_ALGORITHM, scanner.HASH_BUFSIZE)
+        print("{:12} {:>10} {:>10}".format("algorithm", "bufsize", "MiB/s"))
+        for algorithm in sorted(scanner.HASH_ALGORITHMS):
+            for bufsize in [int(b) for b in args.bufsize.split(",")]:
+                best = min(time_hash(path, algorithm, bufsize) for i in range(args.repeat))
+                print("{:12} {:>10} {:>10.0f}".format(algorithm, bufsize, args.size / best))
+    finally:
+        os.unlink(path)
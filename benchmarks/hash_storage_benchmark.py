@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# coding=UTF-8
+#
+"""
+Compare hex and binary storage of hashes in SQLite3: the size of the hashes table and its index on hash,
+and how fast batches of hashes are looked up, as get_hashids_for_hexdigests() does.
+
+Two tables of --hashes random MD5s are made in a temporary database, one with hash TEXT holding hex as
+schema version 6 did, and one with hash BLOB holding the bytes of each digest (see scandb.hash_to_db).
+Sizes come from the dbstat virtual table, which most builds of SQLite include.
+"""
+
+import hashlib
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+import scandb
+
+def make_table(conn, name, column_type, keys):
+    conn.execute(f"CREATE TABLE {name} (hashid INTEGER PRIMARY KEY, hash {column_type} NOT NULL UNIQUE)")
+    conn.executemany(f"INSERT INTO {name} (hash) VALUES (?)", ((key,) for key in keys))
+    conn.commit()
+
+def sizes(conn, name):
+    """Return the bytes used by the table and by the indexes on it"""
+    rows = dict(conn.execute("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name"))
+    indexes = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE tbl_name=?", (name,))
+               if row[0] != name]
+    return (rows[name], sum(rows[index] for index in indexes))
+
+def time_lookups(conn, name, keys, batch):
+    """Return the hashes looked up per second, batch at a time"""
+    t0 = time.time()
+    for i in range(0, len(keys), batch):
+        chunk = keys[i:i + batch]
+        found = conn.execute(f"SELECT hashid, hash FROM {name} WHERE hash IN ({','.join('?' * len(chunk))})",
+                             chunk).fetchall()
+        assert len(found) == len(chunk)
+    return len(keys) / (time.time() - t0)
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compare hex and binary hash storage in SQLite3',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--hashes", help="Number of hashes in each table", type=int, default=1000000)
+    parser.add_argument("--lookups", help="Number of hashes looked up", type=int, default=200000)
+    parser.add_argument("--batch", help="Hashes looked up in each query", type=int, default=scandb.MAX_SQL_VARS - 2)
+    args = parser.parse_args()
+
+    hexdigests = [hashlib.md5(str(i).encode()).hexdigest() for i in range(args.hashes)]
+    wanted = random.Random(0).sample(hexdigests, min(args.lookups, args.hashes))
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(os.path.join(tmp, "hashes.db"))
+        make_table(conn, "hex_hashes", "TEXT", hexdigests)
+        make_table(conn, "binary_hashes", "BLOB", (scandb.hash_to_db(h) for h in hexdigests))
+        print("{:8} {:>12} {:>12} {:>14}".format("storage", "table MiB", "index MiB", "lookups/s"))
+        for (label, name, keys) in [("hex", "hex_hashes", wanted),
+                                    ("binary", "binary_hashes", [scandb.hash_to_db(h) for h in wanted])]:
+            (table, index) = sizes(conn, name)
+            print("{:8} {:12.1f} {:12.1f} {:14,.0f}".format(label, table / 1024 / 1024, index / 1024 / 1024,
+                                                             time_lookups(conn, name, keys, args.batch)))
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# coding=UTF-8
+#
+"""
+Time the scan comparisons behind fchange.py --report on a synthetic pair of scans.
+
+A new SQLite3 database is filled directly with two scans of --files files each, without touching the
+file system. Between the scans, 1% of the files are deleted, 1% change contents, 1% are renamed
+and 1% are new. Each comparison is then run to completion and timed.
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+import scandb
+
+PER_DIR = 1000
+
+def insert_rows(sdb, table, columns, rows):
+    """Insert rows with as many values per statement as the database allows"""
+    placeholders = "(" + ",".join(["%s"] * len(columns)) + ")"
+    for chunk in scandb.chunks(rows, scandb.MAX_SQL_VARS // len(columns)):
+        sdb.csfra(f"INSERT INTO {table} ({','.join(columns)}) VALUES " + ",".join([placeholders] * len(chunk)),
+                  [val for row in chunk for val in row])
+    sdb.db.commit()
+
+def make_scans(sdb, nfiles):
+    """Fill sdb with two scans of nfiles files and return their scanids.
+    Files 0..nfiles-1 are in scan 0. Paths and hashes nfiles..2*nfiles-1 are only used by scan 1."""
+    npaths = 2 * nfiles
+    insert_rows(sdb, sdb.dirnames, ["dirnameid", "dirname"],
+                [(d + 1, "/bench/d{}".format(d)) for d in range(npaths // PER_DIR + 1)])
+    insert_rows(sdb, sdb.filenames, ["filenameid", "filename"],
+                [(i + 1, "f{}.txt".format(i)) for i in range(npaths)])
+    insert_rows(sdb, sdb.paths, ["pathid", "dirnameid", "filenameid"],
+                [(i + 1, i // PER_DIR + 1, i + 1) for i in range(npaths)])
+    insert_rows(sdb, sdb.hashes, ["hashid", "hash"],
+                [(i + 1, "{:032x}".format(i)) for i in range(npaths)])
+    scan0 = sdb.get_scanid(0)
+    scan1 = sdb.get_scanid(86400)
+    insert_rows(sdb, sdb.files, ["pathid", "mtime", "size", "hashid", "scanid"],
+                [(i + 1, 0, 100, i + 1, scan0) for i in range(nfiles)])
+    rows = []
+    for i in range(nfiles):
+        kind = i % 100
+        if kind == 0:                                           # deleted
+            continue
+        elif kind == 1:                                         # changed
+            rows.append((i + 1, 1, 100, nfiles + i + 1, scan1))
+        elif kind == 2:                                         # renamed
+            rows.append((nfiles + i + 1, 0, 100, i + 1, scan1))
+        elif kind == 3:                                         # unchanged, and a new file
+            rows.append((i + 1, 0, 100, i + 1, scan1))
+            rows.append((nfiles + i + 1, 0, 100, nfiles + i + 1, scan1))
+        else:                                                   # unchanged
+            rows.append((i + 1, 0, 100, i + 1, scan1))
+    insert_rows(sdb, sdb.files, ["pathid", "mtime", "size", "hashid", "scanid"], rows)
+    return (scan0, scan1)
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Time scan comparisons on a synthetic pair of scans',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--files", help="Number of files in each scan", type=int, default=1000000)
+    parser.add_argument("--sqlite3db", help="Database to create (default is a temporary file)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        sdb = scandb.SQLite3ScanDatabase(fname=args.sqlite3db or os.path.join(tmp, "report.db"))
+        sdb.create_database()
+        t0 = time.time()
+        (scan0, scan1) = make_scans(sdb, args.files)
+        print("Created two scans of {:,} files in {:.1f} seconds".format(args.files, time.time() - t0))
+        for name in ["new_files", "deleted_files", "changed_files", "renamed_files"]:
+            t0 = time.time()
+            count = sum(1 for f in getattr(sdb, name)(scan0, scan1))
+            print("{:14} {:8,} rows {:8.1f} seconds".format(name, count, time.time() - t0))
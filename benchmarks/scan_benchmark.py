@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# coding=UTF-8
+#
+"""
+Benchmark scans and scan comparisons on a synthetic tree, and record the results as JSON.
+
+A deterministic tree is generated from --seed with --files files spread --depth directories deep.
+File sizes are drawn from a log-uniform distribution between --min_size and --max_size bytes.
+A --dup_ratio fraction of the files repeat the contents of an earlier file, and a --zip_ratio fraction
+are ZIP archives with a few members each. The tree is scanned, --churn percent of its files are then
+changed, deleted, renamed or added in equal parts, and it is scanned again, --rescans times. Finally
+duplicate_files(), changed_files() and renamed_files() are run to completion on the last two scans.
+The database stores the scans in the --layout given (see ScanDatabase.set_layout). With --fast_rescan,
+unchanged directories are not listed, and with --trusted their files are not looked at either.
+
+Each phase records its time, files per second, database queries per file and the peak RSS of the process
+so far. Run it against SQLite3 and, with --config, a local MySQL database, and keep the --json output
+of each version so that regressions can be seen with --baseline.
+"""
+
+import contextlib
+import io
+import itertools
+import json
+import math
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+import zipfile
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+import scandb
+import scanner
+
+PER_DIR = 100
+BLOCK = 64 * 1024
+
+def contents(contentid, size):
+    """Return size bytes that depend only on contentid"""
+    block = random.Random(contentid).randbytes(min(size, BLOCK))
+    return (block * (size // BLOCK + 1))[:size] if size > BLOCK else block
+
+def file_path(i, depth, fanout):
+    """The relative path of file i. Files are PER_DIR to a directory, and directories fanout to a parent."""
+    d = i // PER_DIR
+    parts = []
+    for level in range(depth):
+        parts.append("d{}".format(d % fanout))
+        d //= fanout
+    return os.path.join(*parts, "f{}".format(i)) if parts else "f{}".format(i)
+
+def write_file(path, contentid, size, is_zip, mtime):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if is_zip:
+        with zipfile.ZipFile(path, "w") as zf:
+            for m in range(4):
+                zf.writestr("m{}.dat".format(m), contents(contentid * 4 + m, max(size // 4, 1)))
+    else:
+        with open(path, "wb") as f:
+            f.write(contents(contentid, size))
+    os.utime(path, (mtime, mtime))
+
+class Tree():
+    """A synthetic tree. files maps each relative path to its (contentid, size, is_zip)."""
+    def __init__(self, root, args):
+        self.root = root
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.churns = 0
+        self.files = {}
+        self.unique = []
+        self.fanout = max(2, math.ceil((args.files / PER_DIR) ** (1 / args.depth))) if args.depth else 1
+        for i in range(args.files):
+            self.add(file_path(i, args.depth, self.fanout), mtime=1000000000)
+
+    def new_contents(self):
+        """Return (contentid, size, is_zip) for a new file, which may duplicate an earlier one"""
+        if self.unique and self.rng.random() < self.args.dup_ratio:
+            return self.rng.choice(self.unique)
+        size = int(math.exp(self.rng.uniform(math.log(self.args.min_size), math.log(self.args.max_size))))
+        self.unique.append((len(self.unique) + 1, size, self.rng.random() < self.args.zip_ratio))
+        return self.unique[-1]
+
+    def add(self, relpath, mtime):
+        (contentid, size, is_zip) = self.new_contents()
+        if is_zip:
+            relpath += ".zip"
+        self.files[relpath] = (contentid, size, is_zip)
+        write_file(os.path.join(self.root, relpath), contentid, size, is_zip, mtime)
+
+    def churn(self, percent):
+        """Change, delete, rename and add percent of the files, in equal parts"""
+        paths = sorted(self.files)
+        victims = self.rng.sample(paths, int(len(paths) * percent / 100))
+        # A day later each time, so that a file changed again with the same size still looks changed
+        self.churns += 1
+        mtime = 1000000000 + 86400 * self.churns
+        for (n, relpath) in enumerate(victims):
+            path = os.path.join(self.root, relpath)
+            kind = n % 4
+            if kind == 0:                                       # changed
+                (contentid, size, is_zip) = self.files[relpath]
+                self.unique.append((len(self.unique) + 1, size, is_zip))
+                self.files[relpath] = self.unique[-1]
+                write_file(path, len(self.unique), size, is_zip, mtime)
+            elif kind == 1:                                     # deleted
+                del self.files[relpath]
+                os.unlink(path)
+            elif kind == 2:                                     # renamed
+                self.files[relpath + ".renamed"] = self.files.pop(relpath)
+                os.rename(path, path + ".renamed")
+            else:                                               # a new file next to it
+                self.add(relpath + ".new", mtime)
+
+class QueryCounter():
+    """Count the queries a ScanDatabase makes by wrapping its csfra() and iter_select() methods"""
+    def __init__(self, sdb):
+        self.counter = itertools.count()
+        for name in ["csfra", "iter_select"]:
+            setattr(sdb, name, self.counting(getattr(sdb, name)))
+
+    def counting(self, method):
+        def wrapper(*args, **kwargs):
+            next(self.counter)      # atomic, so scanner threads can share it
+            return method(*args, **kwargs)
+        return wrapper
+
+    def count(self):
+        """Return the number of queries so far"""
+        return next(self.counter)
+
+def peak_rss_kib():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+def run_phase(results, name, queries, function, files=None):
+    """Run function(), which returns a row or file count, and record the phase in results"""
+    q0 = queries.count()
+    t0 = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        count = function()
+    seconds = time.time() - t0
+    nqueries = queries.count() - q0 - 1
+    files = files() if files else count
+    results[name] = {"seconds": round(seconds, 3),
+                     "files": files,
+                     "files_per_second": round(files / max(seconds, 0.001), 1),
+                     "queries": nqueries,
+                     "queries_per_file": round(nqueries / max(files, 1), 3),
+                     "peak_rss_kib": peak_rss_kib()}
+    print("  {:16} {:8.2f} s {:10,} files {:10,.0f} files/s {:8.2f} queries/file {:8,} KiB".format(
+        name, seconds, files, results[name]["files_per_second"], results[name]["queries_per_file"],
+        results[name]["peak_rss_kib"]))
+
+def benchmark(sdb, args):
+    """Run every phase on a new tree and database, and return the results by phase"""
+    sdb.create_database()
+    sdb.set_hash_algorithm(scanner.DEFAULT_HASH_ALGORITHM)
+    sdb.set_layout(args.layout)
+    queries = QueryCounter(sdb)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        t0 = time.time()
+        tree = Tree(tmp, args)
+        results["generate"] = {"seconds": round(time.time() - t0, 3), "files": len(tree.files)}
+        sdb.add_root(tmp)
+        sdb.set_trusted(tmp, args.trusted)
+
+        def scan():
+            sdb.scan_enabled_roots(preload=args.preload, jobs=args.jobs, bulk=args.bulk, fast_rescan=args.fast_rescan)
+        def scanned():
+            return sdb.csfra(f"SELECT COUNT(*) FROM {sdb.scan_files} WHERE scanid=%s", (sdb.last_scan(),))[0][0]
+
+        run_phase(results, "scan", queries, scan, scanned)
+        scan0 = sdb.last_scan()
+        for n in range(args.rescans):
+            scan0 = sdb.last_scan()
+            tree.churn(args.churn)
+            time.sleep(1)       # scans are identified by the second they start
+            run_phase(results, "rescan" if n == 0 else "rescan{}".format(n + 1), queries, scan, scanned)
+        scan1 = sdb.last_scan()
+        run_phase(results, "duplicate_files", queries,
+                  lambda: sum(len(dups) for dups in sdb.duplicate_files(scan1)))
+        run_phase(results, "changed_files", queries, lambda: sum(1 for f in sdb.changed_files(scan0, scan1)))
+        run_phase(results, "renamed_files", queries, lambda: sum(1 for f in sdb.renamed_files(scan0, scan1)))
+    if isinstance(sdb, scandb.SQLite3ScanDatabase):
+        (pages, page_size) = (sdb.csfra("PRAGMA page_count")[0][0], sdb.csfra("PRAGMA page_size")[0][0])
+        results["database"] = {"bytes": pages * page_size}
+        print("  {:16} {:10.1f} MiB".format("database", pages * page_size / 1024 / 1024))
+    return results
+
+def compare(results, baseline):
+    """Print the change in each phase's time from the baseline results"""
+    for (backend, phases) in results["backends"].items():
+        for (name, phase) in phases.items():
+            old = baseline.get("backends", {}).get(backend, {}).get(name)
+            if old and old.get("bytes"):
+                print("{:8} {:16} {:+7.1%} size".format(backend, name, phase["bytes"] / old["bytes"] - 1))
+            elif old and old.get("seconds"):
+                print("{:8} {:16} {:+7.1%} time {:+8.3f} queries/file".format(
+                    backend, name, phase["seconds"] / old["seconds"] - 1,
+                    phase.get("queries_per_file", 0) - old.get("queries_per_file", 0)))
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark scans and comparisons on a synthetic tree',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--files", help="Number of files in the tree", type=int, default=20000)
+    parser.add_argument("--depth", help="Levels of directories above the files", type=int, default=3)
+    parser.add_argument("--min_size", help="Smallest file size in bytes", type=int, default=64)
+    parser.add_argument("--max_size", help="Largest file size in bytes", type=int, default=1024 * 1024)
+    parser.add_argument("--dup_ratio", help="Fraction of files that duplicate another", type=float, default=0.1)
+    parser.add_argument("--zip_ratio", help="Fraction of files that are ZIP archives", type=float, default=0.01)
+    parser.add_argument("--churn", help="Percent of the files changed, deleted, renamed or added before the rescan",
+                        type=float, default=5)
+    parser.add_argument("--rescans", help="Number of times the tree is churned and scanned again", type=int, default=1)
+    parser.add_argument("--layout", help="How the database stores completed scans",
+                        choices=scandb.ScanDatabase.LAYOUTS, default="rows")
+    parser.add_argument("--seed", help="Seed for the tree", type=int, default=0)
+    parser.add_argument("--jobs", help="Hashing threads", type=int, default=1)
+    parser.add_argument("--preload", help="Rescan against a snapshot of the first scan", action='store_true')
+    parser.add_argument("--bulk", help="Use the bulk-load profile", action='store_true')
+    parser.add_argument("--fast_rescan", help="Do not list directories unchanged since the previous scan",
+                        action='store_true')
+    parser.add_argument("--trusted", help="With --fast_rescan, do not stat() the files in unchanged directories",
+                        action='store_true')
+    parser.add_argument("--sqlite3db", help="SQLite3 database to create (default is a temporary file)")
+    parser.add_argument("--config", help="Also benchmark the MySQL database in this config file")
+    parser.add_argument("--prefix", help="Prefix for the MySQL benchmark tables", default="bench_")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--baseline", help="Compare with the results in this file from an earlier --json")
+    args = parser.parse_args()
+
+    results = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "python": platform.python_version(),
+               "schema_version": scandb.SCHEMA_VERSION,
+               "params": vars(args),
+               "backends": {}}
+    with tempfile.TemporaryDirectory() as tmp:
+        print("sqlite3")
+        sdb = scandb.SQLite3ScanDatabase(fname=args.sqlite3db or os.path.join(tmp, "bench.db"))
+        results["backends"]["sqlite3"] = benchmark(sdb, args)
+    if args.config:
+        print("mysql")
+        sdb = scandb.MySQLScanDatabase.FromConfigFile(args.config, prefix=args.prefix)
+        results["backends"]["mysql"] = benchmark(sdb, args)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=4)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# coding=UTF-8
+#
+"""
+Measure the speedup of the SQLite3 bulk-load profile (fchange.py --scan --bulk).
+
+A tree of small files is written to a temporary directory and scanned into a new database twice:
+once with the default settings and once with --bulk. Each scan is an initial scan, so the bulk scan
+also builds the deferred files indexes at the end, which is included in its time.
+"""
+
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+import scandb
+import scanner
+
+def make_tree(root, nfiles, per_dir):
+    for i in range(nfiles):
+        dirname = os.path.join(root, "d{}".format(i // per_dir))
+        if i % per_dir == 0:
+            os.mkdir(dirname)
+        with open(os.path.join(dirname, "f{}.txt".format(i)), "w") as f:
+            f.write("file {}\n".format(i))
+
+def time_scan(tree, dbname, bulk, batch_size):
+    sdb = scandb.SQLite3ScanDatabase(fname=dbname)
+    sdb.create_database()
+    sdb.add_root(tree)
+    t0 = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        sdb.scan_enabled_roots(bulk=bulk, batch_size=batch_size)
+    return time.time() - t0
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compare initial SQLite3 scans with and without --bulk',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--files", help="Number of files in the tree", type=int, default=50000)
+    parser.add_argument("--per_dir", help="Files in each directory", type=int, default=500)
+    parser.add_argument("--batch_size", help="Files written in each transaction", type=int, default=scanner.BATCH_SIZE)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tree = os.path.join(tmp, "tree")
+        os.mkdir(tree)
+        make_tree(tree, args.files, args.per_dir)
+        times = {}
+        for bulk in [False, True]:
+            times[bulk] = time_scan(tree, os.path.join(tmp, "bulk{}.db".format(bulk)), bulk, args.batch_size)
+            print("bulk={!s:5} {:8.1f} seconds {:10,.0f} files/s".format(bulk, times[bulk], args.files / times[bulk]))
+        print("speedup: {:.2f}x".format(times[False] / times[True]))
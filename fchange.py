@@ -11,12 +11,16 @@ This database mechanim is used to store data found by the scanner class
 __version__ = '0.0.1'
 import os.path
 import configparser
+import datetime
 
 import scanner
 import scandb
 import ctools.dbfile as dbfile
 import ctools.tydoc as tydoc
+import itertools
 import json
+import re
+import sys
 
 
 ############################################################
@@ -25,18 +29,125 @@ import json
 # Tools for extracting from the database
 
 def report_dups(fcm, scanid=None, min_dupsize=0, fname_json=None):
+    """Print the sets of duplicate files as they are read from the database.
+    If fname_json is provided, also write them there as a JSON list of lists, one set at a time."""
     duplicated_bytes = 0
-    the_dups = list(fcm.duplicate_files(fcm.last_scan(), min_dupsize=min_dupsize))
-    for dups in the_dups:
+    out = open(fname_json, "w") if fname_json else None
+    if out:
+        out.write("[")
+    for (i, dups) in enumerate(fcm.duplicate_files(scanid or fcm.last_scan(), min_dupsize=min_dupsize)):
         print("Filesize: {:,}  Count: {}".format(dups[0]["size"], len(dups)))
         for d in dups:
             print("    {}".format(os.path.join(d["dirname"], d["filename"])))
         print()
         duplicated_bytes += dups[0]["size"] * (len(dups) - 1)
+        if out:
+            out.write((",\n" if i else "\n") + json.dumps(dups))
     print("\n-----------")
     print("Total space duplicated by files larger than {:,}: {:,}".format(min_dupsize, duplicated_bytes))
+    if out:
+        out.write("\n]\n")
+        out.close()
+
+def report_dirdups(fcm, scanid=None, min_dupsize=0, similarity=None, fname_json=None):
+    """Print the sets of identical directories, and with similarity, the pairs of directories that are at least
+    that alike. If fname_json is provided, also write them there as a JSON object with a list of each."""
+    reclaimable = 0
+    report = {"identical": [], "similar": []}
+    for dups in fcm.duplicate_directories(scanid, min_bytes=min_dupsize):
+        print("Files: {:,}  Size: {:,}  Copies: {}  Reclaimable: {:,}".format(
+            dups["files"], dups["bytes"], len(dups["dirnames"]), dups["reclaimable"]))
+        for dirname in dups["dirnames"]:
+            print("    {}".format(dirname))
+        print()
+        reclaimable += dups["reclaimable"]
+        report["identical"].append(dups)
+    if similarity is not None:
+        for pair in fcm.similar_directories(scanid, similarity=similarity, min_bytes=min_dupsize):
+            print("Similarity: {:.0%}".format(pair["similarity"]))
+            for (dirname, files, size) in zip(pair["dirnames"], pair["files"], pair["bytes"]):
+                print("    {}  ({:,} files, {:,} bytes)".format(dirname, files, size))
+            print()
+            report["similar"].append(pair)
+    print("\n-----------")
+    print("Total space reclaimable from identical directories larger than {:,}: {:,}".format(min_dupsize, reclaimable))
     if fname_json:
-        json.dump( the_dups, open(fname_json,"w"))
+        with open(fname_json, "w") as f:
+            json.dump(report, f, indent=4)
+
+DUMP_BUFSIZE = 4 * 1024 * 1024       # bytes buffered before each write of --dump output
+
+def dump_scan(fcm, out, scanid=None, order=None):
+    """Write a line of "hash  size  mtime  path" to the text file out for each file in a scan (by default,
+    the last one), sorted by the database if order is "path" or "hash". The rows come from one cursor
+    and are written as they arrive, so memory use does not grow with the scan. Return the number of lines."""
+    scanid = scanid or fcm.last_scan()
+    if scanid is None:
+        return 0
+    fcm.check_complete(scanid)
+    rows = fcm.scan_rows(scanid, order=order)
+    count = 0
+    for chunk in iter(lambda: list(itertools.islice(rows, 10000)), []):
+        out.write("".join(f"{hexdigest}  {size}  {mtime}  {os.path.join(dirname, filename)}\n"
+                          for (dirname, filename, size, mtime, hexdigest) in chunk))
+        count += len(chunk)
+    return count
+
+def print_compaction(result):
+    """Print what ScanDatabase.compact() did"""
+    print("Deleted {:,} scans".format(len(result["scans"])))
+    for (table, count) in result["deleted"].items():
+        print("    {:12} {:12,} rows".format(table, count))
+    if result["deferred"]:
+        print("A scan is running, so unreferenced names and hashes were kept and the tables were not rebuilt")
+    print("Space used: {:,.1f} MiB -> {:,.1f} MiB ({:,.1f} MiB reclaimed) in {:.1f} seconds".format(
+        result["bytes_before"] / 1024 / 1024, result["bytes_after"] / 1024 / 1024,
+        (result["bytes_before"] - result["bytes_after"]) / 1024 / 1024, result["seconds"]))
+
+EXPORT_ROW_GROUP_SIZE = 256 * 1024   # rows in each row group (or record batch) of an exported file
+
+def export_columnar(fcm, fname, fmt="parquet", scanid=None, delta=None, row_group_size=EXPORT_ROW_GROUP_SIZE):
+    """Write the files of a scan (by default, the last one) to fname as Parquet, or with fmt="arrow" as an
+    Arrow IPC stream. With delta=(scan0, scan1), write the files that are new, changed or deleted between the
+    two scans instead, with a change column (see ScanDatabase.delta_rows).
+    Rows are streamed from the database and written row_group_size at a time, so memory use does not grow
+    with the scan. The dirname, filename and change columns are dictionary-encoded. Needs pyarrow.
+    Return the number of rows written."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if delta:
+        fcm.check_complete(*delta)
+        rows  = fcm.delta_rows(*delta)
+        names = ["change", "dirname", "filename", "size", "mtime", "hash"]
+    else:
+        scanid = scanid or fcm.last_scan()
+        fcm.check_complete(scanid)
+        rows  = fcm.scan_rows(scanid)
+        names = ["dirname", "filename", "size", "mtime", "hash"]
+    types = {"change": pa.string(), "dirname": pa.string(), "filename": pa.string(),
+             "size": pa.int64(), "mtime": pa.int64(), "hash": pa.string()}
+    encoded = [name for name in names if name in ("change", "dirname", "filename")]
+    if fmt == "parquet":
+        # Parquet dictionary-encodes each column chunk itself
+        schema = pa.schema([(name, types[name]) for name in names])
+        writer = pq.ParquetWriter(fname, schema, use_dictionary=encoded)
+    else:
+        schema = pa.schema([(name, pa.dictionary(pa.int32(), types[name]) if name in encoded else types[name])
+                            for name in names])
+        writer = pa.ipc.new_stream(fname, schema)
+    count = 0
+    with writer:
+        for chunk in iter(lambda: list(itertools.islice(rows, row_group_size)), []):
+            arrays = [pa.array(column, type=types[name]) for (name, column) in zip(names, zip(*chunk))]
+            if fmt == "parquet":
+                writer.write_batch(pa.record_batch(arrays, schema=schema), row_group_size=row_group_size)
+            else:
+                arrays = [array.dictionary_encode() if name in encoded else array
+                          for (name, array) in zip(names, arrays)]
+                writer.write_batch(pa.record_batch(arrays, schema=schema))
+            count += len(chunk)
+    return count
 
 if __name__ == "__main__":
     import argparse
@@ -49,24 +160,78 @@ if __name__ == "__main__":
 
     g = parser.add_mutually_exclusive_group(required=True)
     g.add_argument("--create", help="Create a database", action='store_true')
+    g.add_argument("--upgrade", help="Upgrade a database made by an older version of this program", action='store_true')
     g.add_argument("--listscans", help="List the scans in the DB", action='store_true')
     g.add_argument("--listroots", help="List all roots in the DB", action='store_true')  # initial root?
     g.add_argument("--report", help="Report what's changed between scans A and B (e.g. A-B)")
     g.add_argument("--jreport", help="Create 'what's changed?' json report", action='store_true')
     g.add_argument("--dump",   help='Dump the last scan in a standard form', action='store_true')
     g.add_argument("--reportdups", help="Report duplicates for most recent scan", action='store_true')
+    g.add_argument("--reportdirdups", help="Report duplicate directories for most recent scan", action='store_true')
+    g.add_argument("--export_parquet", help="Write the last scan (or --scanid, or --delta) to this Parquet file")
+    g.add_argument("--export_arrow", help="Write the last scan (or --scanid, or --delta) to this Arrow IPC stream file")
     g.add_argument("--addroot", help="Add a new root", type=str)
     g.add_argument("--delroot", help="Delete an existing root", type=str)
+    g.add_argument("--trustroot", help="Let --fast_rescan carry forward the files of unchanged directories in this root "
+                   "without looking at them. Only for roots whose files are never modified in place", type=str)
+    g.add_argument("--distrustroot", help="Have --fast_rescan stat() the files of unchanged directories in this root",
+                   type=str)
     g.add_argument("--scan", help="Initiate a scan", action='store_true')
+    g.add_argument("--compact", help="Delete the scans not kept by --keep or --keep_days, and reclaim their space",
+                   action='store_true')
 
     parser.add_argument("--fname_json", help="If specified, output report in JSON to the provided name")
     parser.add_argument("--min_dupsize", help="Don't report dups smaller than dupsize",
                         default=1024 * 1024, type=int)
-    parser.add_argument("--out", help="Specifies output filename")
+    parser.add_argument("--similarity", help="With --reportdirdups, also report pairs of directories whose "
+                        "contents are at least this alike (0 to 1), whatever the files are called", type=float)
+    parser.add_argument("--progress", help="With --scan, print a progress line to stderr this often, in seconds (0 for none)",
+                        type=float, default=scanner.PROGRESS_SECONDS)
+    parser.add_argument("--stats_json", help="With --scan, write the scan's counters and timers to this JSON file")
+    parser.add_argument("--profile", help="With --scan, profile the scan with cProfile, save the profile to this file "
+                        "and print the top functions. Only the calling thread is profiled, not the hashing threads")
+    parser.add_argument("--out", help="Specifies output filename (for --dump, default is stdout)")
+    parser.add_argument("--sort", help="With --dump, have the database sort the lines by path or by hash",
+                        choices=["path", "hash"])
+    parser.add_argument("--scanid", help="With --dump, --reportdups, --reportdirdups, --export_parquet or --export_arrow, "
+                        "the scan to use instead of the last one", type=int)
+    parser.add_argument("--delta", help="With --export_parquet or --export_arrow, export the files that are new, "
+                        "changed or deleted between scans A and B (e.g. A-B)")
+    parser.add_argument("--keep", help="With --compact, the number of most recent scans to keep", type=int)
+    parser.add_argument("--keep_days", help="With --compact, keep the scans from the last this many days "
+                        "(the most recent scan is always kept)", type=float)
     parser.add_argument("--vfiles", help="Report each file as ingested", action="store_true")
     parser.add_argument("--vdirs", help="Report each dir as ingested", action="store_true")
     parser.add_argument("--limit", help="Only search this many", type=int)
     parser.add_argument("--debug", help="Enable debugging", action='store_true')
+    parser.add_argument("--hash_algorithm", help="With --create, the algorithm used to hash files",
+                        choices=sorted(scanner.HASH_ALGORITHMS), default=scanner.DEFAULT_HASH_ALGORITHM)
+    parser.add_argument("--layout", help="How completed scans are stored: a row per file per scan, or intervals of "
+                        "scans in which each file was unchanged. With --create, the layout of the new database; "
+                        "with --upgrade, convert the database to it", choices=scandb.ScanDatabase.LAYOUTS)
+    parser.add_argument("--bufsize", help="With --scan, bytes read at a time when hashing",
+                        default=scanner.HASH_BUFSIZE, type=int)
+    parser.add_argument("--jobs", help="With --scan, number of threads hashing files, or listing S3 shards", default=1, type=int)
+    parser.add_argument("--dedup", help="With --scan, scan for --reportdups: only fully hash files whose size "
+                        "and first and last bytes match another file's", action='store_true')
+    parser.add_argument("--preload", help="With --scan, load the previous scan into memory first so that "
+                        "unchanged files are recognized without per-file queries", action='store_true')
+    parser.add_argument("--resume", help="With --scan, continue the latest scan that was interrupted, "
+                        "skipping the directories it completed", action='store_true')
+    parser.add_argument("--bulk", help="With --scan, use the database's bulk-load profile "
+                        "(SQLite3: WAL journaling, a large cache, and indexes built after an initial scan)",
+                        action='store_true')
+    parser.add_argument("--batch_size", help="With --scan, files written in each transaction",
+                        default=scanner.BATCH_SIZE, type=int)
+    parser.add_argument("--archive_depth", help="With --scan, levels of archives whose members are scanned: "
+                        "1 scans the members of archives, 2 also those of archives inside them, and 0 none",
+                        default=scanner.ARCHIVE_DEPTH, type=int)
+    parser.add_argument("--archive_formats", help="With --scan, comma-separated archive formats to open",
+                        default=",".join(scanner.ARCHIVE_READERS))
+    parser.add_argument("--archive_max_size", help="With --scan, archives larger than this many MiB are scanned "
+                        "as ordinary files", type=int)
+    parser.add_argument("--fast_rescan", help="With --scan, record each directory's mtime and inode, and do not list "
+                        "the directories that are unchanged since the previous scan", action='store_true')
     
     args = parser.parse_args()
 
@@ -83,12 +248,27 @@ if __name__ == "__main__":
 
     if args.create:
         fcm.create_database()
+        fcm.set_hash_algorithm(args.hash_algorithm)
+    elif args.upgrade:
+        fcm.upgrade_database()
+        print("Database is at schema version", fcm.get_schema_version())
+    else:
+        fcm.check_schema()
+    if args.layout and (args.create or args.upgrade):
+        fcm.set_layout(args.layout)
+        print("Database layout:", fcm.get_layout())
     if args.addroot:
         fcm.add_root(args.addroot)
         print("Added root: ", args.addroot)
     if args.delroot:
         fcm.del_root(args.delroot)
         print("Deleted root: ", args.delroot)
+    if args.trustroot:
+        fcm.set_trusted(args.trustroot, True)
+        print("Trusted root: ", args.trustroot)
+    if args.distrustroot:
+        fcm.set_trusted(args.distrustroot, False)
+        print("Distrusted root: ", args.distrustroot)
     if args.listscans:
         for (scanid,when,duration) in fcm.get_scans():
             print(scanid,  when,duration)
@@ -101,7 +281,54 @@ if __name__ == "__main__":
     if args.jreport:
         fcm.jreport()
     if args.reportdups:
-        report_dups(fcm, min_dupsize=args.min_dupsize, fname_json=args.fname_json)
+        report_dups(fcm, scanid=args.scanid, min_dupsize=args.min_dupsize, fname_json=args.fname_json)
+    if args.reportdirdups:
+        report_dirdups(fcm, scanid=args.scanid, min_dupsize=args.min_dupsize, similarity=args.similarity,
+                       fname_json=args.fname_json)
+    if args.dump:
+        sys.stdout.flush()
+        with (open(args.out, "w", buffering=DUMP_BUFSIZE, errors="surrogateescape") if args.out else
+              open(sys.stdout.fileno(), "w", buffering=DUMP_BUFSIZE, errors="surrogateescape", closefd=False)) as out:
+            dump_scan(fcm, out, scanid=args.scanid, order=args.sort)
+    if args.export_parquet or args.export_arrow:
+        try:
+            import pyarrow
+        except ImportError:
+            print("pyarrow is required for --export_parquet/--export_arrow")
+            exit(1)
+        delta = None
+        if args.delta:
+            m = re.search(r"(\d+)-(\d+)", args.delta)
+            if not m:
+                print("Usage: --delta N-M")
+                exit(1)
+            delta = (int(m.group(1)), int(m.group(2)))
+        count = export_columnar(fcm, args.export_parquet or args.export_arrow,
+                                fmt="parquet" if args.export_parquet else "arrow", scanid=args.scanid, delta=delta)
+        print("Exported {:,} files".format(count))
+    if args.compact:
+        if args.keep is None and args.keep_days is None:
+            print("Usage: --compact --keep N and/or --keep_days D")
+            exit(1)
+        before = None
+        if args.keep_days is not None:
+            # scans.time is UTC
+            before = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None) - datetime.timedelta(days=args.keep_days)
+        print_compaction(fcm.compact(keep=args.keep, before=before))
     if args.scan:
-        fcm.scan_enabled_roots()
+        if args.profile:
+            import cProfile
+            import pstats
+            profiler = cProfile.Profile()
+            profiler.enable()
+        fcm.scan_enabled_roots(preload=args.preload, jobs=args.jobs, bufsize=args.bufsize, dedup=args.dedup,
+                               bulk=args.bulk, batch_size=args.batch_size, archive_depth=args.archive_depth,
+                               archive_formats=args.archive_formats.split(","),
+                               archive_max_size=args.archive_max_size * 1024 * 1024 if args.archive_max_size else None,
+                               resume=args.resume, progress=args.progress, stats_json=args.stats_json,
+                               fast_rescan=args.fast_rescan)
+        if args.profile:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
             
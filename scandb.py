@@ -9,25 +9,41 @@ This class builds upon the ctools.dbfile class. It should have no code that is i
 
 Table design:
 
-metadata - arbitrary metadata for the database. Not used, but ready for storing things like preferences.
+metadata - arbitrary metadata for the database: the schema_version and the hash_algorithm used for scans.
 roots    - points where scans begin. Roots are never deleted, but only the enabled roots are scanned.
            A root might be "/" or "/home/users/junky" or "s3://foobar/baz".  The root is included in the directory name.
 scans    - each time the roots were scanned.
 dirnames - the complete directory name. (e.g. /home/users/junky or s3://foobar/baz/home/users/junky)
 filenames- the filename in the directory. (e.g. .bashrc)
 paths    - a combination of a dirname and a filename. 
-hashes   - a set of hashes, irrespective of which file they are in
+hashes   - a set of hashes, irrespective of which file they are in, tagged with the algorithm that made them
+           and whether they are of the whole file or (after a dedup scan) only part of it.
+           Hashes are stored as binary digests (see hash_to_db), and are hex everywhere outside this module.
 files    - the collection of scanned files! Contains the pathid, mtime, size, hashid, amnd the scan in which tit took place
+crcs     - the CRC32 of each hash that was made of a zipfile member, so that unchanged members need not be read again
+checkpoints - the directories that an unfinished scan has completed, so that it can be resumed. Emptied when the scan ends.
+versions - in the intervals layout, each version of a file, valid from first_scanid to last_scanid. Scans are written
+           to files and folded into versions when they end; scan_files is a view of the versions by scan.
+dirtree  - the parent of each directory in dirnames, so that a directory's subdirectories can be found without LIKE.
+rollups  - for each completed scan and directory, the number of files and bytes below it, and a hash of its contents.
+           archive is 1 for the directory that holds the members of an archive.
 
 """
 __version__ = '0.0.1'
 import datetime
+import hashlib
+import itertools
+import json
+import random
 import time
 import os.path
+import re
 import sqlite3
 from abc import ABC, abstractmethod
+from collections import OrderedDict, Counter
 
 import scanner
+import snapshot
 import ctools.dbfile as dbfile
 from ctools.tydoc import *
 import configparser
@@ -38,6 +54,20 @@ TABLE_PREFIX="table_prefix"
 
 
 
+# Version of the table design. Databases created before versions were recorded are version 1.
+# Version 2: hashes.algorithm records the algorithm that made each hash.
+# Version 3: hashes.partial marks hashes of only part of a file, made by dedup scans.
+# Version 4: files_idx8 on files(scanid,pathid).
+# Version 5: the crcs table.
+# Version 6: the checkpoints table.
+# Version 7: hashes.hash holds binary digests rather than hex, with a unique index on MySQL.
+# Version 8: the versions table and scan_files view, for the intervals layout.
+# Version 9: the dirtree and rollups tables.
+# Version 10: rollups.archive marks the rollups of archives' members.
+# Version 11: the dirscans table and roots.trusted, for fast rescans.
+# Version 12: hashes are unique by (hash, algorithm, partial) rather than by hash alone.
+SCHEMA_VERSION = 12
+
 # We don't use an object relation mapper (ORM) because the performance was just not there.
 # However, we should migrate as much here as possible to the ctools/dbfile class
 
@@ -47,7 +77,8 @@ CREATE TABLE IF NOT EXISTS metadata (key VARCHAR(255) PRIMARY KEY,value VARCHAR(
 
 CREATE TABLE IF NOT EXISTS roots (rootid INTEGER PRIMARY KEY, 
                                   rootdir VARCHAR(255) NOT NULL UNIQUE,
-                                  enabled INTEGER NOT NULL DEFAULT 1);
+                                  enabled INTEGER NOT NULL DEFAULT 1,
+                                  trusted INTEGER NOT NULL DEFAULT 0);
 CREATE INDEX IF NOT EXISTS roots_idx0 ON roots(rootdir);
 CREATE INDEX IF NOT EXISTS roots_idx1 ON roots(enabled);
 
@@ -75,9 +106,11 @@ CREATE INDEX IF NOT EXISTS paths_idx1 ON paths(pathid);
 CREATE INDEX IF NOT EXISTS paths_idx2 ON paths(dirnameid);
 CREATE INDEX IF NOT EXISTS paths_idx3 ON paths(filenameid);
 
-CREATE TABLE IF NOT EXISTS hashes (hashid INTEGER PRIMARY KEY,hash TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS hashes (hashid INTEGER PRIMARY KEY,hash BLOB NOT NULL,
+                                   algorithm VARCHAR(32) NOT NULL DEFAULT 'md5',
+                                   partial INTEGER NOT NULL DEFAULT 0,
+                                   UNIQUE (hash, algorithm, partial));
 CREATE INDEX IF NOT EXISTS hashes_idx1 ON hashes(hashid);
-CREATE INDEX IF NOT EXISTS hashes_idx2 ON hashes(hash);
 
 CREATE TABLE IF NOT EXISTS files (fileid INTEGER PRIMARY KEY,
                                   pathid INTEGER NOT NULL,
@@ -95,9 +128,75 @@ CREATE INDEX IF NOT EXISTS files_idx3 ON files(size);
 CREATE INDEX IF NOT EXISTS files_idx4 ON files(hashid);
 CREATE INDEX IF NOT EXISTS files_idx5 ON files(scanid);
 CREATE INDEX IF NOT EXISTS files_idx6 ON files(scanid,hashid);
+CREATE INDEX IF NOT EXISTS files_idx8 ON files(scanid,pathid);
+
+CREATE TABLE IF NOT EXISTS crcs (hashid INTEGER PRIMARY KEY,
+                                 crc32 BIGINT NOT NULL,
+                                 CONSTRAINT fk1 FOREIGN KEY (hashid) REFERENCES hashes(hashid));
+
+CREATE TABLE IF NOT EXISTS checkpoints (scanid INTEGER NOT NULL,
+                                        dirname TEXT NOT NULL,
+                                        subtree INTEGER NOT NULL,
+                                        fileid INTEGER,
+                                        CONSTRAINT fk1 FOREIGN KEY (scanid) REFERENCES scans(scanid));
+CREATE INDEX IF NOT EXISTS checkpoints_idx1 ON checkpoints(scanid);
 
 """
 
+SQLITE3_VERSIONS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS versions (versionid INTEGER PRIMARY KEY,
+                                     pathid INTEGER NOT NULL,
+                                     mtime INTEGER NOT NULL,
+                                     size INTEGER NOT NULL,
+                                     hashid INTEGER NOT NULL,
+                                     first_scanid INTEGER NOT NULL,
+                                     last_scanid INTEGER NOT NULL,
+                                     CONSTRAINT fk1 FOREIGN KEY (pathid) REFERENCES paths(pathid),
+                                     CONSTRAINT fk2 FOREIGN KEY (hashid) REFERENCES hashes(hashid));
+CREATE INDEX IF NOT EXISTS versions_idx1 ON versions(pathid);
+CREATE INDEX IF NOT EXISTS versions_idx2 ON versions(hashid);
+CREATE INDEX IF NOT EXISTS versions_idx3 ON versions(last_scanid,pathid);
+CREATE INDEX IF NOT EXISTS versions_idx4 ON versions(first_scanid);
+
+CREATE VIEW IF NOT EXISTS scan_files AS
+       SELECT versionid AS fileid, pathid, mtime, size, hashid, scanid
+       FROM versions JOIN scans ON scanid BETWEEN first_scanid AND last_scanid
+       WHERE duration IS NOT NULL;
+"""
+SQLITE3_SCHEMA += SQLITE3_VERSIONS_SCHEMA
+
+SQLITE3_DIRTREE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirtree (dirnameid INTEGER PRIMARY KEY,
+                                    parent_dirnameid INTEGER,
+                                    CONSTRAINT fk1 FOREIGN KEY (dirnameid) REFERENCES dirnames(dirnameid),
+                                    CONSTRAINT fk2 FOREIGN KEY (parent_dirnameid) REFERENCES dirnames(dirnameid));
+CREATE INDEX IF NOT EXISTS dirtree_idx1 ON dirtree(parent_dirnameid);
+
+CREATE TABLE IF NOT EXISTS rollups (scanid INTEGER NOT NULL,
+                                    dirnameid INTEGER NOT NULL,
+                                    files INTEGER NOT NULL,
+                                    bytes INTEGER NOT NULL,
+                                    hash BLOB NOT NULL,
+                                    archive INTEGER NOT NULL DEFAULT 0,
+                                    PRIMARY KEY (scanid, dirnameid),
+                                    CONSTRAINT fk1 FOREIGN KEY (scanid) REFERENCES scans(scanid),
+                                    CONSTRAINT fk2 FOREIGN KEY (dirnameid) REFERENCES dirnames(dirnameid));
+CREATE INDEX IF NOT EXISTS rollups_idx1 ON rollups(dirnameid);
+"""
+SQLITE3_SCHEMA += SQLITE3_DIRTREE_SCHEMA
+
+SQLITE3_DIRSCANS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirscans (scanid INTEGER NOT NULL,
+                                     dirnameid INTEGER NOT NULL,
+                                     mtime INTEGER NOT NULL,
+                                     inode INTEGER NOT NULL,
+                                     entries INTEGER NOT NULL,
+                                     PRIMARY KEY (scanid, dirnameid),
+                                     CONSTRAINT fk1 FOREIGN KEY (scanid) REFERENCES scans(scanid),
+                                     CONSTRAINT fk2 FOREIGN KEY (dirnameid) REFERENCES dirnames(dirnameid));
+"""
+SQLITE3_SCHEMA += SQLITE3_DIRSCANS_SCHEMA
+
 MYSQL_SCHEMA = """
 DROP TABLE IF EXISTS {prefix}metadata;
 CREATE TABLE  {prefix}metadata (name VARCHAR(255) PRIMARY KEY, 
@@ -106,7 +205,8 @@ CREATE TABLE  {prefix}metadata (name VARCHAR(255) PRIMARY KEY,
 DROP TABLE IF EXISTS {prefix}roots;
 CREATE TABLE {prefix}roots (rootid INTEGER PRIMARY KEY AUTO_INCREMENT, 
                             rootdir VARCHAR(255) UNIQUE NOT NULL,
-                            enabled INTEGER DEFAULT 1) character set utf8;
+                            enabled INTEGER DEFAULT 1,
+                            trusted INTEGER NOT NULL DEFAULT 0) character set utf8;
 CREATE INDEX  roots_idx1 ON {prefix}roots(rootdir);
 CREATE INDEX  roots_idx2 ON {prefix}roots(enabled);
 
@@ -133,8 +233,10 @@ CREATE INDEX  paths_idx1 ON {prefix}paths(dirnameid);
 CREATE INDEX  paths_idx2 ON {prefix}paths(filenameid);
 
 DROP TABLE IF EXISTS {prefix}hashes;
-CREATE TABLE  {prefix}hashes (hashid INTEGER PRIMARY KEY AUTO_INCREMENT,hash TEXT(65536) NOT NULL) character set utf8;
-CREATE INDEX  hashes_idx2 ON {prefix}hashes( hash(700));
+CREATE TABLE  {prefix}hashes (hashid INTEGER PRIMARY KEY AUTO_INCREMENT,hash VARBINARY(64) NOT NULL,
+                              algorithm VARCHAR(32) NOT NULL DEFAULT 'md5',
+                              partial INTEGER NOT NULL DEFAULT 0) character set utf8;
+CREATE UNIQUE INDEX  hashes_idx2 ON {prefix}hashes(hash, algorithm, partial);
 
 DROP TABLE IF EXISTS {prefix}files;
 CREATE TABLE  {prefix}files (fileid INTEGER PRIMARY KEY AUTO_INCREMENT,
@@ -149,8 +251,193 @@ CREATE INDEX  files_idx4 ON {prefix}files(size);
 CREATE INDEX  files_idx5 ON {prefix}files(hashid);
 CREATE INDEX  files_idx6 ON {prefix}files(scanid);
 CREATE INDEX  files_idx7 ON {prefix}files(scanid,hashid);
+CREATE INDEX  files_idx8 ON {prefix}files(scanid,pathid);
+
+DROP TABLE IF EXISTS {prefix}crcs;
+CREATE TABLE  {prefix}crcs (hashid INTEGER PRIMARY KEY REFERENCES {prefix}hashes(hashid),
+                            crc32 BIGINT NOT NULL) character set utf8;
+
+DROP TABLE IF EXISTS {prefix}checkpoints;
+CREATE TABLE  {prefix}checkpoints (scanid INTEGER REFERENCES {prefix}scans(scanid),
+                                   dirname TEXT(65536) NOT NULL,
+                                   subtree INTEGER NOT NULL,
+                                   fileid INTEGER) character set utf8;
+CREATE INDEX  checkpoints_idx1 ON {prefix}checkpoints(scanid);
+
+DROP TABLE IF EXISTS {prefix}versions;
+DROP TABLE IF EXISTS {prefix}dirtree;
+DROP TABLE IF EXISTS {prefix}rollups;
+DROP TABLE IF EXISTS {prefix}dirscans;
 """
 
+MYSQL_VERSIONS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS {prefix}versions (versionid INTEGER PRIMARY KEY AUTO_INCREMENT,
+                                             pathid INTEGER REFERENCES {prefix}paths(pathid),
+                                             mtime INTEGER NOT NULL,
+                                             size INTEGER NOT NULL,
+                                             hashid INTEGER REFERENCES {prefix}hashes(hashid),
+                                             first_scanid INTEGER NOT NULL,
+                                             last_scanid INTEGER NOT NULL,
+                                             INDEX versions_idx1 (pathid),
+                                             INDEX versions_idx2 (hashid),
+                                             INDEX versions_idx3 (last_scanid,pathid),
+                                             INDEX versions_idx4 (first_scanid)) character set utf8;
+
+CREATE OR REPLACE VIEW {prefix}scan_files AS
+       SELECT versionid AS fileid, pathid, mtime, size, hashid, scanid
+       FROM {prefix}versions JOIN {prefix}scans ON scanid BETWEEN first_scanid AND last_scanid
+       WHERE duration IS NOT NULL;
+"""
+MYSQL_SCHEMA += MYSQL_VERSIONS_SCHEMA
+
+MYSQL_DIRTREE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS {prefix}dirtree (dirnameid INTEGER PRIMARY KEY REFERENCES {prefix}dirnames(dirnameid),
+                                            parent_dirnameid INTEGER REFERENCES {prefix}dirnames(dirnameid),
+                                            INDEX dirtree_idx1 (parent_dirnameid)) character set utf8;
+
+CREATE TABLE IF NOT EXISTS {prefix}rollups (scanid INTEGER NOT NULL REFERENCES {prefix}scans(scanid),
+                                            dirnameid INTEGER NOT NULL REFERENCES {prefix}dirnames(dirnameid),
+                                            files INTEGER NOT NULL,
+                                            bytes BIGINT NOT NULL,
+                                            hash VARBINARY(32) NOT NULL,
+                                            archive INTEGER NOT NULL DEFAULT 0,
+                                            PRIMARY KEY (scanid, dirnameid),
+                                            INDEX rollups_idx1 (dirnameid)) character set utf8;
+"""
+MYSQL_SCHEMA += MYSQL_DIRTREE_SCHEMA
+
+MYSQL_DIRSCANS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS {prefix}dirscans (scanid INTEGER NOT NULL REFERENCES {prefix}scans(scanid),
+                                             dirnameid INTEGER NOT NULL REFERENCES {prefix}dirnames(dirnameid),
+                                             mtime BIGINT NOT NULL,
+                                             inode BIGINT NOT NULL,
+                                             entries INTEGER NOT NULL,
+                                             PRIMARY KEY (scanid, dirnameid)) character set utf8;
+"""
+MYSQL_SCHEMA += MYSQL_DIRSCANS_SCHEMA
+
+# The largest number of %s placeholders in one statement. SQLite3 builds before 3.32 are limited to 999.
+MAX_SQL_VARS = 999
+
+# Rows deleted in each transaction by compact(), so that a scan running at the same time is never kept waiting long.
+COMPACT_BATCH_SIZE = 10000
+
+# The bulk-load profile of SQLite3ScanDatabase (see begin_bulk_load).
+# WAL journaling with synchronous=NORMAL cannot corrupt the database if the scan is interrupted.
+# At worst the last few batches are lost, and the scan is left without a duration, like any interrupted scan.
+SQLITE3_BULK_PRAGMAS = {"journal_mode": "WAL",
+                        "synchronous":  "NORMAL",
+                        "cache_size":   -256 * 1024,     # KiB
+                        "mmap_size":    1024 ** 3,
+                        "temp_store":   "MEMORY"}
+
+# Indexes on files that a scan does not read. files_idx1 (pathid) is kept, since every batch looks up
+# (pathid, mtime, size). The CREATE statements are taken from the schema.
+SQLITE3_INDEXES = {m.group(1): m.group(0)
+                   for m in re.finditer(r"CREATE INDEX IF NOT EXISTS (\w+) ON [^;]*", SQLITE3_SCHEMA)}
+SQLITE3_HASHES_TABLE = re.search(r"CREATE TABLE IF NOT EXISTS hashes [^;]*", SQLITE3_SCHEMA).group(0)
+SQLITE3_DEFERRED_INDEXES = ["files_idx0", "files_idx2", "files_idx3", "files_idx4", "files_idx5", "files_idx6",
+                            "files_idx8"]
+
+def parent_dirname(dirname):
+    """Return the directory that contains dirname, or None for a top directory such as / or an S3 bucket."""
+    if dirname.startswith(scanner.S3_PREFIX) and "/" not in dirname[len(scanner.S3_PREFIX):]:
+        return None
+    parent = os.path.dirname(dirname)
+    return parent if parent and parent != dirname else None
+
+def rollup_hash(data=b""):
+    """The hash of rollups. It only needs to tell directories apart, so 128 bits are plenty."""
+    return hashlib.blake2b(data, digest_size=16)
+
+def rollup_entry(name, value):
+    """The bytes that an entry of a directory contributes to its rollup hash: its name and its hash."""
+    value = value.encode("utf-8") if isinstance(value, str) else bytes(value)
+    return b"%d:%s%d:%s" % (len(name.encode("utf-8", "surrogateescape")), name.encode("utf-8", "surrogateescape"),
+                            len(value), value)
+
+# Near-identical directories are found with MinHash signatures of the sets of file hashes below them.
+# Each signature is MINHASH_PERMUTATIONS long and is cut into MINHASH_BANDS bands. Directories that agree
+# on a whole band are compared. With 16 bands of 4, pairs that are 80% alike are almost always compared,
+# and pairs that are 50% alike about two times in three. Bands shared by more than MINHASH_MAX_BUCKET
+# directories, which come from files that are everywhere, are not used.
+MINHASH_PERMUTATIONS = 64
+MINHASH_BANDS = 16
+MINHASH_MAX_BUCKET = 100
+MINHASH_PRIME = (1 << 61) - 1
+MINHASH_COEFFICIENTS = [(rng.randrange(1, MINHASH_PRIME), rng.randrange(MINHASH_PRIME))
+                        for rng in [random.Random(0)] for i in range(MINHASH_PERMUTATIONS)]
+
+def minhash(value):
+    """Return the MinHash values of a file hash, one for each permutation"""
+    x = int.from_bytes(hashlib.blake2b(bytes(value), digest_size=8).digest(), "little")
+    return [(a * x + b) % MINHASH_PRIME for (a, b) in MINHASH_COEFFICIENTS]
+
+def chunks(seq, n):
+    """Return successive slices of seq that are at most n long."""
+    for i in range(0, len(seq), n):
+        yield seq[i:i+n]
+
+# Hashes are stored as the bytes of their hex digests, which halves the size of the hashes table's index
+# and of every key compared in it. Anything that is not lower-case hex, such as an S3 multipart ETag
+# (<hex>-<parts>), is stored as its UTF-8 text, and the algorithm says which it is (see hash_from_db).
+HEX_DIGEST = re.compile(r"(?:[0-9a-f][0-9a-f])+")
+TEXT_HASH_ALGORITHMS = (scanner.S3_MULTIPART_ALGORITHM,)
+
+def hash_to_db(hexdigest):
+    """Return the bytes that the hashes table stores for hexdigest"""
+    if HEX_DIGEST.fullmatch(hexdigest):
+        return bytes.fromhex(hexdigest)
+    return hexdigest.encode('utf-8')
+
+def hash_from_db(value, algorithm):
+    """Return the hex digest (or ETag) that the hashes table stores as value, made by algorithm"""
+    if algorithm in TEXT_HASH_ALGORITHMS:
+        return value.decode('utf-8')
+    return value.hex()
+
+# The table a query reads or writes first, which is what ScanStats counts it against
+QUERY_TABLE = re.compile(r"\b(?:FROM|INTO|UPDATE|TABLE)\s+(\w+)", re.IGNORECASE)
+
+# Default number of entries in each of the id caches. Each entry is a few hundred bytes at most.
+DEFAULT_CACHE_SIZES = {"dirnames": 10000, "filenames": 100000, "paths": 100000, "hashes": 100000}
+
+class LRUCache():
+    """A bounded dictionary that discards the least recently used entry when it is full.
+    Counts hits and misses so that the scan summary can report how well it worked."""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data    = OrderedDict()
+        self.hits    = 0
+        self.misses  = 0
+
+    def get(self, key):
+        """Return the value for key, or None if it is not in the cache."""
+        try:
+            value = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def clear(self):
+        self.data.clear()
+
+    def __str__(self):
+        lookups = self.hits + self.misses
+        return "{:,} hits, {:,} misses ({:.0%} hit rate)".format(self.hits, self.misses,
+                                                               self.hits / lookups if lookups else 0)
+
 """Explanation of tables:
 files        - list of all files
 hashes       - table of all hash code
@@ -169,10 +456,20 @@ class ScanDatabase(ABC):
 
     Each of these methods is tested in tests/scandb_tests.py for every implementation
     """
-    def __init__(self, *, db, prefix="", auth=None):
+    def __init__(self, *, db, prefix="", auth=None, cache_sizes=None):
         self.prefix  = prefix
         self.db      = db
         self.auth    = auth
+        # In-memory caches of the ids of dirnames, filenames, (dirnameid, filenameid) pairs and hashes.
+        # @param cache_sizes - a dictionary that overrides entries in DEFAULT_CACHE_SIZES.
+        sizes = {**DEFAULT_CACHE_SIZES, **(cache_sizes or {})}
+        self.caches    = {name: LRUCache(sizes[name]) for name in DEFAULT_CACHE_SIZES}
+        self.snapshot  = None   # index of the previous scan, when scan_enabled_roots() is asked to preload it
+        self.resumed   = None   # dirname -> subtree of the directories done, when scan_enabled_roots() resumes a scan
+        self.archives_known = False     # True if the previous scan opened every archive that this one would
+        self.hash_algorithm = None      # read from the metadata table when first needed
+        self.layout    = None           # likewise
+        self.stats     = scanner.ScanStats()   # counters and timers, renewed by each scan_enabled_roots()
         # table names
         self.metadata  = self.prefix + "metadata"
         self.roots     = self.prefix + "roots"
@@ -182,21 +479,288 @@ class ScanDatabase(ABC):
         self.paths     = self.prefix + "paths"
         self.hashes    = self.prefix + "hashes"
         self.files     = self.prefix + "files"
+        self.crcs      = self.prefix + "crcs"
+        self.checkpoints = self.prefix + "checkpoints"
+        self.versions  = self.prefix + "versions"
+        self.dirtree   = self.prefix + "dirtree"
+        self.rollups   = self.prefix + "rollups"
+        self.dirscans  = self.prefix + "dirscans"
 
     @abstractmethod
     def create_database(self):
         pass
 
+    @abstractmethod
+    def get_columns(self, table):
+        """Return the names of the columns in table"""
+        pass
+
+    @abstractmethod
+    def get_indexes(self, table):
+        """Return the names of the indexes on table"""
+        pass
+
+    @abstractmethod
+    def database_bytes(self):
+        """Return the bytes used by the database's tables and indexes"""
+        pass
+
+    @abstractmethod
+    def reclaim_space(self, rebuild):
+        """Update the statistics that the query planner uses after compact() has deleted rows.
+        @param rebuild - if True, also rebuild the tables so that the space freed is returned to the file system.
+                         This locks them for a while, so compact() only asks for it when no scan is running."""
+        pass
+
+    # Metadata and schema versions
+
+    METADATA_KEY = "key"        # name of the key column of the metadata table
+
+    def get_metadata(self, key, default=None):
+        rows = self.csfra(f"SELECT value FROM {self.metadata} WHERE {self.METADATA_KEY}=%s", (key,))
+        return rows[0][0] if rows else default
+
+    def set_metadata(self, key, value):
+        self.csfra(f"REPLACE INTO {self.metadata} ({self.METADATA_KEY},value) VALUES (%s,%s)", (key, str(value)))
+        self.commit()
+
+    def get_schema_version(self):
+        return int(self.get_metadata("schema_version", 1))
+
+    def check_schema(self):
+        """Raise an error if the database was made by an older version and needs upgrade_database()"""
+        version = self.get_schema_version()
+        if version < SCHEMA_VERSION:
+            raise RuntimeError(f"Database schema is version {version} but this program needs version {SCHEMA_VERSION}. "
+                               "Run fchange.py --upgrade")
+
+    def add_column(self, table, column, definition):
+        """Add a column to table if it is not already there."""
+        if column not in self.get_columns(table):
+            self.csfra(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+    def add_index(self, table, name, columns):
+        """Create the index name on table(columns) if table has no index of that name."""
+        if name not in self.get_indexes(table):
+            self.csfra(f"CREATE INDEX {name} ON {table}({columns})")
+
+    def upgrade_to_2(self):
+        self.add_column(self.hashes, "algorithm", "VARCHAR(32) NOT NULL DEFAULT 'md5'")
+
+    def upgrade_to_3(self):
+        self.add_column(self.hashes, "partial", "INTEGER NOT NULL DEFAULT 0")
+
+    def upgrade_to_4(self):
+        # For comparing two scans path by path (see changed_files)
+        self.add_index(self.files, "files_idx8", "scanid,pathid")
+
+    def upgrade_to_5(self):
+        self.csfra(f"CREATE TABLE IF NOT EXISTS {self.crcs} (hashid INTEGER PRIMARY KEY, crc32 BIGINT NOT NULL)")
+
+    def upgrade_to_6(self):
+        """Scans made before this version were never given a duration, so they would all look interrupted.
+        They are marked complete with a duration of 0."""
+        if self.get_columns(self.scans):
+            self.csfra(f"UPDATE {self.scans} SET duration=0 WHERE duration IS NULL")
+        self.csfra(f"""CREATE TABLE IF NOT EXISTS {self.checkpoints} (scanid INTEGER NOT NULL, dirname TEXT NOT NULL,
+                                                                  subtree INTEGER NOT NULL, fileid INTEGER)""")
+        self.add_index(self.checkpoints, "checkpoints_idx1", "scanid")
+
+    def upgrade_to_7(self):
+        self.convert_hashes()
+        self.clear_caches()
+
+    @abstractmethod
+    def convert_hashes(self):
+        """Convert hashes.hash from hex text to binary digests (see hash_to_db) if it is not already.
+        Hashes keep their hashids, so nothing that refers to them changes."""
+        pass
+
+    def create_tables(self, schema):
+        """Run each statement of schema, which creates tables only if they do not exist."""
+        for statement in schema.format(prefix=self.prefix).split(";"):
+            if statement.strip():
+                self.csfra(statement)
+        self.commit()
+
+    def upgrade_to_8(self):
+        self.create_tables(self.VERSIONS_SCHEMA)
+
+    def upgrade_to_9(self):
+        self.create_tables(self.DIRTREE_SCHEMA)
+
+    def upgrade_to_10(self):
+        """Rollups made without the archive column are deleted, to be made again when needed (see ensure_rollups)."""
+        if "archive" not in self.get_columns(self.rollups):
+            self.add_column(self.rollups, "archive", "INTEGER NOT NULL DEFAULT 0")
+            self.csfra(f"DELETE FROM {self.rollups}")
+            self.commit()
+
+    def upgrade_to_11(self):
+        if self.get_columns(self.roots):     # a database with no roots table has no roots to trust
+            self.add_column(self.roots, "trusted", "INTEGER NOT NULL DEFAULT 0")
+        self.create_tables(self.DIRSCANS_SCHEMA)
+
+    def upgrade_to_12(self):
+        self.widen_hash_key()
+        self.clear_caches()
+
+    @abstractmethod
+    def widen_hash_key(self):
+        """Make hashes unique by (hash, algorithm, partial) if they are unique by hash alone, so that the same
+        digest made by another algorithm, or of only part of a file, is a hash of its own."""
+        pass
+
+    UPGRADES = {2: upgrade_to_2, 3: upgrade_to_3, 4: upgrade_to_4, 5: upgrade_to_5, 6: upgrade_to_6,
+                7: upgrade_to_7, 8: upgrade_to_8, 9: upgrade_to_9, 10: upgrade_to_10, 11: upgrade_to_11,
+                12: upgrade_to_12}
+
+    def upgrade_database(self):
+        """Bring a database made by an older version of this program up to SCHEMA_VERSION.
+        Every step checks before it changes anything, so this is also run on newly-created databases."""
+        for version in range(self.get_schema_version() + 1, SCHEMA_VERSION + 1):
+            self.UPGRADES[version](self)
+            self.set_metadata("schema_version", version)
+
+    def get_hash_algorithm(self):
+        """Return the name of the algorithm that scans use to hash files."""
+        if self.hash_algorithm is None:
+            self.hash_algorithm = self.get_metadata("hash_algorithm", scanner.DEFAULT_HASH_ALGORITHM)
+        return self.hash_algorithm
+
+    def set_hash_algorithm(self, algorithm):
+        """Choose the algorithm used to hash files. This can only be done before the first scan,
+        since every scan of a database must use the same algorithm for its results to be comparable."""
+        if algorithm not in scanner.HASH_ALGORITHMS:
+            raise ValueError(f"Unknown hash algorithm {algorithm}. Available: {', '.join(sorted(scanner.HASH_ALGORITHMS))}")
+        if algorithm != self.get_hash_algorithm() and self.csfra(f"SELECT scanid FROM {self.scans} LIMIT 1"):
+            raise RuntimeError(f"Database has already been scanned with {self.get_hash_algorithm()}")
+        self.set_metadata("hash_algorithm", algorithm)
+        self.hash_algorithm = algorithm
+
+    # Storage layouts. In the rows layout, which is the default, every scan has a files row for every file.
+    # In the intervals layout, the files table only holds the scans in progress. When a scan ends it is
+    # folded into versions, where a file that is unchanged since the previous scan only has its last_scanid
+    # extended. Queries about particular scans read scan_files and ones about any scan read file_history,
+    # which are both the files table in the rows layout.
+
+    LAYOUTS = ("rows", "intervals")
+
+    def get_layout(self):
+        """Return the layout in which the database stores the files of completed scans."""
+        if self.layout is None:
+            self.layout = self.get_metadata("layout", "rows")
+        return self.layout
+
+    @property
+    def scan_files(self):
+        """The table or view with a (fileid, pathid, mtime, size, hashid, scanid) row for each file in each
+        completed scan."""
+        return self.files if self.get_layout() == "rows" else self.prefix + "scan_files"
+
+    @property
+    def file_history(self):
+        """The table whose (pathid, mtime, size, hashid) rows are the hashes that files had in previous scans."""
+        return self.files if self.get_layout() == "rows" else self.versions
+
+    def set_layout(self, layout):
+        """Convert the completed scans in the database to layout. The scans in progress stay in the files table.
+        Converting to intervals finds runs of consecutive completed scans in which a file was unchanged
+        with a window function, which needs SQLite 3.25 or MySQL 8."""
+        if layout not in self.LAYOUTS:
+            raise ValueError(f"Unknown layout {layout}. Layouts are: {', '.join(self.LAYOUTS)}")
+        if layout == self.get_layout():
+            return
+        completed = f"SELECT scanid FROM {self.scans} WHERE duration IS NOT NULL"
+        if layout == "intervals":
+            self.csfra(f"""INSERT INTO {self.versions} (pathid, mtime, size, hashid, first_scanid, last_scanid)
+                           SELECT pathid, mtime, size, hashid, MIN(scanid), MAX(scanid)
+                           FROM (SELECT pathid, mtime, size, hashid, scanid,
+                                        n - ROW_NUMBER() OVER (PARTITION BY pathid, mtime, size, hashid ORDER BY n)
+                                            AS run
+                                 FROM {self.files}
+                                      JOIN (SELECT scanid, ROW_NUMBER() OVER (ORDER BY scanid) AS n
+                                            FROM {self.scans} WHERE duration IS NOT NULL) AS completed
+                                      USING (scanid)) AS numbered
+                           GROUP BY pathid, mtime, size, hashid, run""")
+            self.csfra(f"DELETE FROM {self.files} WHERE scanid IN ({completed})")
+        else:
+            self.csfra(f"""INSERT INTO {self.files} (pathid, mtime, size, hashid, scanid)
+                           SELECT pathid, mtime, size, hashid, scanid FROM {self.prefix}scan_files
+                           WHERE scanid IN ({completed}) ORDER BY scanid, fileid""")
+            self.csfra(f"DELETE FROM {self.versions}")
+        self.set_metadata("layout", layout)
+        self.layout = layout
+
+    def fold_scan(self, scanid):
+        """In the intervals layout, move the files of scanid, which has just completed, into versions.
+        The versions in the previous completed scan that are unchanged are extended to scanid with one UPDATE,
+        and the rest are inserted. Scans must be folded in order."""
+        prev = self.previous_scan(scanid)
+        if self.csfra(f"SELECT versionid FROM {self.versions} WHERE last_scanid>%s LIMIT 1", (scanid,)):
+            raise RuntimeError(f"Scan {scanid} is older than a completed scan, so it cannot be stored as intervals")
+        if prev is not None:
+            self.csfra(f"""UPDATE {self.versions} SET last_scanid=%s
+                           WHERE last_scanid=%s
+                             AND EXISTS (SELECT 1 FROM {self.files} AS f
+                                         WHERE f.scanid=%s AND f.pathid={self.versions}.pathid
+                                           AND f.mtime={self.versions}.mtime AND f.size={self.versions}.size
+                                           AND f.hashid={self.versions}.hashid)""", (scanid, prev, scanid))
+        self.csfra(f"""INSERT INTO {self.versions} (pathid, mtime, size, hashid, first_scanid, last_scanid)
+                       SELECT pathid, mtime, size, hashid, scanid, scanid FROM {self.files} AS f
+                       WHERE scanid=%s AND NOT EXISTS (SELECT 1 FROM {self.versions} AS v
+                                                       WHERE v.last_scanid=%s AND v.pathid=f.pathid)""",
+                   (scanid, scanid))
+        self.csfra(f"DELETE FROM {self.files} WHERE scanid=%s", (scanid,))
+
+    def clear_caches(self):
+        """Forget all cached ids. Must be called whenever rows are deleted from the id tables."""
+        for cache in self.caches.values():
+            cache.clear()
+
+    def print_cache_stats(self):
+        for (name, cache) in self.caches.items():
+            print("Cache {:10} {}".format(name + ":", cache))
+
+    def begin_bulk_load(self, initial):
+        """Prepare the database for a scan that writes as fast as possible. The default does nothing.
+        @param initial - True if the database has no files yet, so indexes can be built once at the end."""
+        pass
+
+    def end_bulk_load(self):
+        """Undo begin_bulk_load(). Called when the scan finishes or fails."""
+        pass
+
+    def restore_indexes(self):
+        """Re-create any indexes left dropped by a bulk load that was killed. The default does nothing."""
+        pass
+
+    def query_name(self, cmd):
+        """The name that self.stats counts and times cmd as: "query" and the table it is mostly about."""
+        m = QUERY_TABLE.search(cmd)
+        return "query " + (m.group(1)[len(self.prefix):] if m and m.group(1).startswith(self.prefix) else
+                           m.group(1) if m else "other")
+
     def csfra(self, cmd, vals=[]):
         """Call the db csfr method with the object's auth."""
-        return self.db.csfr(self.auth, cmd, vals)
+        with self.stats.timer(self.query_name(cmd)):
+            return self.db.csfr(self.auth, cmd, vals)
+
+    def commit(self):
+        with self.stats.timer("commit"):
+            self.db.commit()
+
+    @abstractmethod
+    def iter_select(self, cmd, vals=[]):
+        """Run a SELECT and return an iterator over its rows, without fetching them all into memory first."""
+        pass
 
     # Manipulate roots
 
     def add_root(self, root):
         "Add a root, ignore if it is already there. "
         self.csfra(f"INSERT IGNORE INTO {self.roots} (rootdir) VALUES ( %s )", [root])
-        self.db.commit()
+        self.commit()
 
     def get_enabled_roots( self ):
         """Return a set of the roots in the database (we use a set so the order doesn't matter)."""
@@ -206,21 +770,39 @@ class ScanDatabase(ABC):
     def del_root(self, root):
         """We never delete roots, but we make them not enabled"""
         self.csfra(f"UPDATE {self.roots} SET enabled=0 WHERE rootdir=%s", (root,))
-        self.db.commit()        
+        self.commit()        
+
+    def set_trusted(self, root, trusted):
+        """Set whether a fast rescan of root may carry forward the files of a directory whose mtime and inode
+        have not changed without looking at them (see scanner.FileScanner)."""
+        self.csfra(f"UPDATE {self.roots} SET trusted=%s WHERE rootdir=%s", (int(trusted), root))
+        self.commit()
+
+    def get_trusted_roots(self):
+        """Return a set of the enabled roots that are trusted."""
+        return set(row[0] for row in self.csfra(f"SELECT rootdir FROM {self.roots} WHERE enabled > 0 AND trusted > 0"))
         
     # Database manipulation routines for scanner class
-    def get_hashid_for_hexdigest(self, hexdigest):
-        """Given a hex hash code, return the hashid (an integer)"""
-        self.csfra(f"INSERT IGNORE INTO {self.hashes} (hash) VALUES (%s);", (hexdigest,))
-        self.db.commit()
-        return self.csfra(f"SELECT hashid FROM {self.hashes} WHERE hash=%s LIMIT 1", (hexdigest,))[0][0]
+    def get_hashid_for_hexdigest(self, hexdigest, algorithm=None):
+        """Given a hex hash code, return the hashid (an integer)
+        @param algorithm - the algorithm that produced the hash. Defaults to the database's algorithm."""
+        algorithm = algorithm or self.get_hash_algorithm()
+        key = hash_to_db(hexdigest)
+        hashid = self.caches['hashes'].get((key, algorithm, 0))
+        if hashid is None:
+            self.csfra(f"INSERT IGNORE INTO {self.hashes} (hash,algorithm) VALUES (%s,%s);", (key, algorithm))
+            self.commit()
+            hashid = self.csfra(f"SELECT hashid FROM {self.hashes} WHERE hash=%s AND algorithm=%s AND partial=0 LIMIT 1",
+                                (key, algorithm))[0][0]
+            self.caches['hashes'].put((key, algorithm, 0), hashid)
+        return hashid
 
     def get_scanid(self, now):
         """Get or create a scanid for a given time"""
         # NOW is a timet; need to change it to ISO-8061
         iso8601 = datetime.datetime.utcfromtimestamp(int(now)).isoformat()
         self.csfra(f"INSERT IGNORE INTO {self.scans} (time) VALUES (%s);", (iso8601,))
-        self.db.commit()
+        self.commit()
         return self.csfra(f"SELECT scanid FROM {self.scans} WHERE time=%s LIMIT 1", (iso8601,))[0][0]
 
     # Get the pathid for a given posix path
@@ -228,27 +810,36 @@ class ScanDatabase(ABC):
         (dirname, filename) = os.path.split(path)
 
         # dirname
-        self.csfra(f"INSERT IGNORE INTO {self.dirnames} (dirname) VALUES (%s);", (dirname,))
-        self.db.commit()
-        dirnameid = self.csfra(f"SELECT dirnameid from {self.dirnames} where dirname=%s",(dirname,))[0][0]
+        dirnameid = self.caches['dirnames'].get(dirname)
+        if dirnameid is None:
+            self.csfra(f"INSERT IGNORE INTO {self.dirnames} (dirname) VALUES (%s);", (dirname,))
+            self.commit()
+            dirnameid = self.csfra(f"SELECT dirnameid from {self.dirnames} where dirname=%s",(dirname,))[0][0]
+            self.caches['dirnames'].put(dirname, dirnameid)
 
         # filename
-        self.csfra(f"INSERT IGNORE INTO {self.filenames} (filename) VALUES (%s);", (filename,))
-        self.db.commit()
-        filenameid = self.csfra(f"SELECT filenameid from {self.filenames} where filename=%s",(filename,))[0][0]
+        filenameid = self.caches['filenames'].get(filename)
+        if filenameid is None:
+            self.csfra(f"INSERT IGNORE INTO {self.filenames} (filename) VALUES (%s);", (filename,))
+            self.commit()
+            filenameid = self.csfra(f"SELECT filenameid from {self.filenames} where filename=%s",(filename,))[0][0]
+            self.caches['filenames'].put(filename, filenameid)
 
         # pathid
-        self.csfra(f"""INSERT IGNORE INTO {self.paths} (dirnameid,filenameid) VALUES (%s,%s)""",
-                   (dirnameid,filenameid))
-        self.db.commit()
-        pathid = self.csfra(f"""SELECT pathid FROM {self.paths} where (dirnameid=%s and filenameid=%s)""",
-                            (dirnameid,filenameid))[0][0]
+        pathid = self.caches['paths'].get((dirnameid, filenameid))
+        if pathid is None:
+            self.csfra(f"""INSERT IGNORE INTO {self.paths} (dirnameid,filenameid) VALUES (%s,%s)""",
+                       (dirnameid,filenameid))
+            self.commit()
+            pathid = self.csfra(f"""SELECT pathid FROM {self.paths} where (dirnameid=%s and filenameid=%s)""",
+                                (dirnameid,filenameid))[0][0]
+            self.caches['paths'].put((dirnameid, filenameid), pathid)
         return pathid
 
 
     def get_hashid_for_pms(self, pathid, mtime, file_size):
         """Search the database and return any hashids for files that have a given pathid, mtime and size"""
-        for row in self.csfra(f"SELECT hashid FROM {self.files} WHERE pathid=%s AND mtime=%s AND size=%s LIMIT 1",
+        for row in self.csfra(f"SELECT hashid FROM {self.file_history} WHERE pathid=%s AND mtime=%s AND size=%s LIMIT 1",
                                      (pathid, mtime, file_size)):
             return row[0]
         return None
@@ -257,37 +848,813 @@ class ScanDatabase(ABC):
         self.csfra(f"INSERT INTO {self.files} (pathid,mtime,size,hashid,scanid) VALUES (%s,%s,%s,%s,%s)",
                        (pathid, mtime, file_size, hashid, self.scanid))
 
+    # Batched ingest.
+    # Each of these methods resolves a whole batch with a few multi-row INSERT IGNORE and SELECT ... IN
+    # statements, rather than three statements and a commit per file. Multi-row VALUES lists are used
+    # instead of executemany() so that everything still goes through csfra() on both backends.
+
+    def _bulk_ids(self, table, idcol, keycol, keys, tags=()):
+        """Return a dictionary mapping each key to its id in table, inserting the keys that are not there.
+        The table's cache is consulted first and updated with whatever the database returns.
+        @param tags - (column, value) pairs that are stored with new keys and required of existing ones.
+        """
+        ret   = {}
+        keys  = list(dict.fromkeys(keys))   # new keys are inserted in the order given, so that ids are repeatable
+        cache = self.caches[table[len(self.prefix):]]
+        tagvals  = [val for (col, val) in tags]
+        ckey     = (lambda key: key) if not tags else (lambda key: tuple([key] + tagvals))
+        tagcols  = "".join(f",{col}" for (col, val) in tags)
+        tagmarks = ",%s" * len(tags)
+        tagwhere = "".join(f" AND {col}=%s" for (col, val) in tags)
+
+        for key in keys:
+            rowid = cache.get(ckey(key))
+            if rowid is not None:
+                ret[key] = rowid
+        for chunk in chunks([key for key in keys if key not in ret], MAX_SQL_VARS - len(tags)):
+            marks = ",".join(["%s"] * len(chunk))
+            for (rowid, key) in self.csfra(f"SELECT {idcol}, {keycol} FROM {table} WHERE {keycol} IN ({marks}){tagwhere}",
+                                           chunk + tagvals):
+                ret.setdefault(key, rowid)
+            missing = [key for key in chunk if key not in ret]
+            if not missing:
+                continue
+            self.csfra(f"INSERT IGNORE INTO {table} ({keycol}{tagcols}) VALUES "
+                       + ",".join([f"(%s{tagmarks})"] * len(missing)),
+                       [val for key in missing for val in [key] + tagvals])
+            marks = ",".join(["%s"] * len(missing))
+            for (rowid, key) in self.csfra(f"SELECT {idcol}, {keycol} FROM {table} WHERE {keycol} IN ({marks}){tagwhere}",
+                                           missing + tagvals):
+                ret.setdefault(key, rowid)
+            # MySQL compares TEXT with the column collation, so the returned key may not be byte-identical.
+            # Fall back to one lookup per key, which matches exactly what get_pathid() would have found.
+            for key in missing:
+                if key not in ret:
+                    ret[key] = self.csfra(f"SELECT {idcol} FROM {table} WHERE {keycol}=%s{tagwhere} LIMIT 1",
+                                          [key] + tagvals)[0][0]
+            for key in chunk:
+                cache.put(ckey(key), ret[key])
+        return ret
+
+    def get_pathids(self, paths):
+        """Given an iterable of posix paths, return a dictionary mapping each path to its pathid."""
+        splits      = {path: os.path.split(path) for path in paths}
+        dirnameids  = self._bulk_ids(self.dirnames, "dirnameid", "dirname", [d for (d, f) in splits.values()])
+        filenameids = self._bulk_ids(self.filenames, "filenameid", "filename", [f for (d, f) in splits.values()])
+        pairs       = {path: (dirnameids[d], filenameids[f]) for (path, (d, f)) in splits.items()}
+
+        # paths has no unique constraint, so look before inserting. When a pair appears more than once,
+        # use the lowest pathid, which is the one that get_pathid() returns.
+        pathids = {}
+        for pair in dict.fromkeys(pairs.values()):
+            pathid = self.caches['paths'].get(pair)
+            if pathid is not None:
+                pathids[pair] = pathid
+        def lookup(wanted):
+            dids = list(set(d for (d, f) in wanted))
+            fids = list(set(f for (d, f) in wanted))
+            dmarks = ",".join(["%s"] * len(dids))
+            fmarks = ",".join(["%s"] * len(fids))
+            for (pathid, dirnameid, filenameid) in self.csfra(
+                    f"""SELECT pathid, dirnameid, filenameid FROM {self.paths}
+                        WHERE dirnameid IN ({dmarks}) AND filenameid IN ({fmarks})""", dids + fids):
+                pair = (dirnameid, filenameid)
+                if pair in wanted and (pair not in pathids or pathid < pathids[pair]):
+                    pathids[pair] = pathid
+
+        for chunk in chunks([pair for pair in dict.fromkeys(pairs.values()) if pair not in pathids], MAX_SQL_VARS // 2):
+            lookup(set(chunk))
+            missing = [pair for pair in chunk if pair not in pathids]
+            if missing:
+                self.csfra(f"INSERT INTO {self.paths} (dirnameid,filenameid) VALUES " + ",".join(["(%s,%s)"] * len(missing)),
+                           [val for pair in missing for val in pair])
+                lookup(set(missing))
+            for pair in chunk:
+                self.caches['paths'].put(pair, pathids[pair])
+        return {path: pathids[pair] for (path, pair) in pairs.items()}
+
+    def get_hashids_for_hexdigests(self, hexdigests, algorithm=None, partial=0):
+        """Given an iterable of hex hash codes, return a dictionary mapping each to its hashid.
+        @param algorithm - the algorithm that produced the hashes. Defaults to the database's algorithm.
+        @param partial   - 1 if the hashes cover only part of each file (see scanner.hash_file_partial)."""
+        keys = {hexdigest: hash_to_db(hexdigest) for hexdigest in hexdigests}
+        hashids = self._bulk_ids(self.hashes, "hashid", "hash", keys.values(),
+                                 tags=[("algorithm", algorithm or self.get_hash_algorithm()), ("partial", partial)])
+        return {hexdigest: hashids[key] for (hexdigest, key) in keys.items()}
+
+    def get_hashids_for_pmss(self, pmss, algorithm=None):
+        """Given an iterable of (pathid, mtime, size) tuples, return a dictionary mapping each tuple
+        that matches a file in any previous scan to that file's hashid.
+        Only full hashes made with algorithm (by default the database's algorithm) are returned."""
+        wanted = set(pmss)
+        ret    = {}
+        algorithm = algorithm or self.get_hash_algorithm()
+        for chunk in chunks(list(set(pathid for (pathid, mtime, size) in wanted)), MAX_SQL_VARS - 1):
+            marks = ",".join(["%s"] * len(chunk))
+            for (pathid, mtime, size, hashid) in self.csfra(
+                    f"""SELECT pathid, mtime, size, {self.file_history}.hashid FROM {self.file_history}
+                        JOIN {self.hashes} ON {self.file_history}.hashid={self.hashes}.hashid
+                        WHERE pathid IN ({marks}) AND algorithm=%s AND partial=0""", chunk + [algorithm]):
+                if (pathid, mtime, size) in wanted:
+                    ret.setdefault((pathid, mtime, size), hashid)
+        return ret
+
+    def get_hashids_for_crcs(self, pcss, algorithm=None):
+        """Given an iterable of (pathid, crc32, size) tuples for zipfile members, return a dictionary mapping
+        each tuple that matches a file in any previous scan to that file's hashid. Like get_hashids_for_pmss(),
+        but members are matched by the CRC32 stored in their zipfile rather than by mtime."""
+        wanted = set(pcss)
+        ret    = {}
+        algorithm = algorithm or self.get_hash_algorithm()
+        for chunk in chunks(list(set(pathid for (pathid, crc, size) in wanted)), MAX_SQL_VARS - 1):
+            marks = ",".join(["%s"] * len(chunk))
+            for (pathid, crc, size, hashid) in self.csfra(
+                    f"""SELECT pathid, crc32, size, {self.file_history}.hashid FROM {self.file_history}
+                        JOIN {self.crcs} ON {self.file_history}.hashid={self.crcs}.hashid
+                        JOIN {self.hashes} ON {self.file_history}.hashid={self.hashes}.hashid
+                        WHERE pathid IN ({marks}) AND algorithm=%s AND partial=0""", chunk + [algorithm]):
+                if (pathid, crc, size) in wanted:
+                    ret.setdefault((pathid, crc, size), hashid)
+        return ret
+
+    def add_crcs(self, rows):
+        """Record (hashid, crc32) rows for zipfile members. They are committed by the next add_pmshs()."""
+        for chunk in chunks(list(set(rows)), MAX_SQL_VARS // 2):
+            self.csfra(f"INSERT IGNORE INTO {self.crcs} (hashid,crc32) VALUES " + ",".join(["(%s,%s)"] * len(chunk)),
+                       [val for row in chunk for val in row])
+
+    def add_pmshs(self, rows):
+        """Add (pathid, mtime, size, hashid) rows to the current scan and commit once."""
+        for chunk in chunks(list(rows), MAX_SQL_VARS // 5):
+            self.csfra(f"INSERT INTO {self.files} (pathid,mtime,size,hashid,scanid) VALUES "
+                       + ",".join(["(%s,%s,%s,%s,%s)"] * len(chunk)),
+                       [val for (pathid, mtime, size, hashid) in chunk for val in (pathid, mtime, size, hashid, self.scanid)])
+        self.commit()
+
+    def add_files(self, records):
+        """Add a batch of (path, mtime, size, hexdigest) records to the current scan.
+        Resolves dirnames, filenames, paths and hashes in bulk and commits once."""
+        records = list(records)
+        pathids = self.get_pathids([path for (path, mtime, size, hexdigest) in records])
+        hashids = self.get_hashids_for_hexdigests([hexdigest for (path, mtime, size, hexdigest) in records])
+        self.add_pmshs([(pathids[path], mtime, size, hashids[hexdigest]) for (path, mtime, size, hexdigest) in records])
+
     def ingest_done(self, duration):
-        self.csfra(f"UPDATE {self.scans} SET duration=%s WHERE scanid=%s", (self.scanid, duration))
+        """Mark the current scan complete. Until then its duration is NULL, and reports do not use it.
+        In the intervals layout, the scan is folded into versions (see fold_scan)."""
+        if self.get_layout() == "intervals":
+            with self.stats.timer("fold scan"):
+                self.fold_scan(self.scanid)
+        self.csfra(f"UPDATE {self.scans} SET duration=%s WHERE scanid=%s", (int(duration), self.scanid))
+        self.csfra(f"DELETE FROM {self.checkpoints} WHERE scanid=%s", (self.scanid,))
+        self.commit()
+
+    def previous_scan(self, scanid):
+        """Return the completed scan before scanid, or None if there is none"""
+        return self.csfra(f"SELECT MAX(scanid) FROM {self.scans} WHERE scanid<%s AND duration IS NOT NULL",
+                          (scanid,))[0][0]
+
+    def unfinished_scan(self):
+        """Return the latest scan that was interrupted, or None if there is none"""
+        return self.csfra(f"SELECT MAX(scanid) FROM {self.scans} WHERE duration IS NULL")[0][0]
+
+    def check_complete(self, *scanids):
+        """Raise an error if any of scanids was interrupted and has not been resumed to the end."""
+        for scanid in scanids:
+            if self.csfra(f"SELECT scanid FROM {self.scans} WHERE scanid=%s AND duration IS NULL", (scanid,)):
+                raise RuntimeError(f"Scan {scanid} is incomplete. Run fchange.py --scan --resume to finish it")
+
+    def add_checkpoints(self, rows):
+        """Record (dirname, subtree) rows for the current scan, meaning that every file in dirname, and if subtree
+        is true every file below it, is in the database. Each row also records the highest fileid at that moment,
+        so that a resumed scan can remove the files written after it (see resume_scan). Commits."""
+        fileid = self.csfra(f"SELECT MAX(fileid) FROM {self.files}")[0][0]
+        for chunk in chunks(list(rows), MAX_SQL_VARS // 4):
+            self.csfra(f"INSERT INTO {self.checkpoints} (scanid,dirname,subtree,fileid) VALUES "
+                       + ",".join(["(%s,%s,%s,%s)"] * len(chunk)),
+                       [val for (dirname, subtree) in chunk for val in (self.scanid, dirname, int(subtree), fileid)])
+        self.commit()
+
+    def resume_scan(self, scanid):
+        """Prepare to continue the interrupted scan scanid. The files it wrote after its last checkpoint, which
+        belong to directories that it had not finished, are removed. Return its checkpoints as a dictionary
+        mapping each dirname to True if the whole subtree is done, or False if only the files in it are."""
+        last = self.csfra(f"SELECT MAX(fileid) FROM {self.checkpoints} WHERE scanid=%s", (scanid,))[0][0]
+        self.csfra(f"DELETE FROM {self.files} WHERE scanid=%s AND fileid>%s", (scanid, last or 0))
+        self.commit()
+        done = {}
+        for (dirname, subtree) in self.iter_select(
+                f"SELECT dirname, subtree FROM {self.checkpoints} WHERE scanid=%s", (scanid,)):
+            done[dirname] = done.get(dirname, False) or bool(subtree)
+        return done
+
+    def load_snapshot(self, scanid, mmap_threshold=snapshot.MMAP_THRESHOLD):
+        """Stream the files of scanid into a snapshot index that maps each full path to (pathid, mtime, size, hashid)."""
+        count = self.csfra(f"SELECT COUNT(*) FROM {self.scan_files} WHERE scanid=%s", (scanid,))[0][0]
+        # Only full hashes made with the current algorithm are carried forward
+        rows = self.iter_select(f"""SELECT dirname, filename, pathid, mtime, size, hashid
+                                    FROM {self.scan_files}
+                                          NATURAL JOIN {self.paths}
+                                          NATURAL JOIN {self.dirnames}
+                                          NATURAL JOIN {self.filenames}
+                                          JOIN {self.hashes} USING (hashid)
+                                    WHERE scanid=%s AND algorithm=%s AND partial=0""", (scanid, self.get_hash_algorithm()))
+        dirnames = set()
+        def paths():
+            for (dirname, filename, pathid, mtime, size, hashid) in rows:
+                dirnames.add(dirname)
+                yield (os.path.join(dirname, filename), pathid, mtime, size, hashid)
+        index = snapshot.make_index(count, paths(), mmap_threshold=mmap_threshold)
+        index.archives = snapshot.find_archives(index, dirnames)
+        return index
+
+    def load_s3_snapshot(self, scanid, root, mmap_threshold=snapshot.MMAP_THRESHOLD):
+        """Stream the objects under root (s3://bucket/prefix) in scanid into a snapshot index that maps each
+        full path (s3://bucket/key) to (pathid, mtime, size, hashid, digest_key(ETag))."""
+        bucket = scanner.S3_PREFIX + root[len(scanner.S3_PREFIX):].split("/")[0]
+        # Objects are in the directory named by the bucket, or below it. '0' follows '/'.
+        where = "scanid=%s AND (dirname=%s OR (dirname>=%s AND dirname<%s))"
+        vals  = (scanid, bucket, bucket + "/", bucket + "0")
+        count = self.csfra(f"""SELECT COUNT(*) FROM {self.scan_files} NATURAL JOIN {self.paths} NATURAL JOIN {self.dirnames}
+                               WHERE {where}""", vals)[0][0]
+        rows = self.iter_select(f"""SELECT dirname, filename, pathid, mtime, size, hashid, hash, algorithm
+                                    FROM {self.scan_files}
+                                          NATURAL JOIN {self.paths}
+                                          NATURAL JOIN {self.dirnames}
+                                          NATURAL JOIN {self.filenames}
+                                          JOIN {self.hashes} USING (hashid)
+                                    WHERE {where}""", vals)
+        def objects():
+            for (dirname, filename, pathid, mtime, size, hashid, etag, algorithm) in rows:
+                path = os.path.join(dirname, filename)
+                if path.startswith(root):
+                    yield (path, pathid, mtime, size, hashid, snapshot.digest_key(hash_from_db(etag, algorithm)))
+        return snapshot.make_index(count, objects(), mmap_threshold=mmap_threshold, digests=True)
+
+    def copy_archive_members(self, path, pathid, mtime, size, scanid):
+        """Copy the files inside the archive at path from scanid to the current scan, provided the archive
+        itself, whose pathid is pathid, was in scanid with the same mtime and size.
+        Return the number of files copied, or None if the archive was not in scanid unchanged."""
+        if (mtime, size) not in [tuple(row) for row in self.csfra(
+                f"SELECT mtime, size FROM {self.scan_files} WHERE scanid=%s AND pathid=%s", (scanid, pathid))]:
+            return None
+        # Members are in the directory named by the archive's path, or below it. '0' follows '/'.
+        rows = self.csfra(f"""SELECT pathid, mtime, size, hashid
+                              FROM {self.scan_files} NATURAL JOIN {self.paths} NATURAL JOIN {self.dirnames}
+                              WHERE scanid=%s AND (dirname=%s OR (dirname>=%s AND dirname<%s))""",
+                          (scanid, path, path + "/", path + "0"))
+        self.add_pmshs([tuple(row) for row in rows])
+        return len(rows)
+
+    # Directory signatures, for fast rescans. Each directory that a fast rescan lists or carries forward is
+    # recorded with the mtime (in nanoseconds) and inode that it had just before, and the number of files and
+    # subdirectories that the scan recorded in it.
+
+    def add_dirscans(self, rows):
+        """Record (dirname, mtime, inode, entries) rows for the current scan and commit once.
+        A directory that is already recorded keeps its first row, which can only make it look changed."""
+        rows = list(rows)
+        dirnameids = self._bulk_ids(self.dirnames, "dirnameid", "dirname", [row[0] for row in rows])
+        for chunk in chunks(rows, MAX_SQL_VARS // 5):
+            self.csfra(f"INSERT IGNORE INTO {self.dirscans} (scanid,dirnameid,mtime,inode,entries) VALUES "
+                       + ",".join(["(%s,%s,%s,%s,%s)"] * len(chunk)),
+                       [val for (dirname, mtime, inode, entries) in chunk
+                        for val in (self.scanid, dirnameids[dirname], mtime, inode, entries)])
+        self.commit()
+
+    def load_dirscans(self, scanid, root):
+        """Return a dictionary mapping each directory at or below root recorded in scanid to (mtime, inode, entries)."""
+        top = root.rstrip("/")
+        return {dirname: (mtime, inode, entries) for (dirname, mtime, inode, entries) in self.csfra(
+            f"""SELECT dirname, mtime, inode, entries FROM {self.dirscans} NATURAL JOIN {self.dirnames}
+                WHERE scanid=%s AND (dirname=%s OR (dirname>=%s AND dirname<%s))""",
+            (scanid, root, top + "/", top + "0"))}
+
+    def files_in_directories(self, scanid, where, vals):
+        """Return (filename, pathid, mtime, size, hashid, algorithm, partial) for each file in scanid whose dirname
+        matches where. The paths are found first and then their files, so that the query cannot start from
+        every file in the scan."""
+        filenames = dict(self.csfra(f"""SELECT pathid, filename
+                                        FROM {self.paths} NATURAL JOIN {self.dirnames} NATURAL JOIN {self.filenames}
+                                        WHERE {where}""", vals))
+        ret = []
+        for chunk in chunks(list(filenames), MAX_SQL_VARS - 1):
+            ret.extend((filenames[row[0]],) + tuple(row) for row in self.csfra(
+                f"""SELECT pathid, mtime, size, {self.scan_files}.hashid, algorithm, partial
+                    FROM {self.scan_files} JOIN {self.hashes} ON {self.scan_files}.hashid={self.hashes}.hashid
+                    WHERE scanid=%s AND pathid IN ({",".join(["%s"] * len(chunk))})""", [scanid] + chunk))
+        return ret
+
+    def directory_files(self, scanid, dirname):
+        """Return a dictionary mapping the name of each file directly in dirname in scanid to
+        (pathid, mtime, size, hashid, carryable, members). carryable is True if the hash is a full hash made
+        with the database's algorithm. members are the (pathid, mtime, size, hashid) rows of the files inside it,
+        if it is an archive. These are found from dirtree, so scanid must have been rolled up (see rollup_scan)."""
+        algorithm = self.get_hash_algorithm()
+        files = {filename: (pathid, mtime, size, hashid, algorithm == algo and not partial, [])
+                 for (filename, pathid, mtime, size, hashid, algo, partial)
+                 in self.files_in_directories(scanid, "dirname=%s", (dirname,))}
+        children = self.csfra(f"""SELECT d.dirname FROM {self.dirtree} AS t
+                                  JOIN {self.dirnames} AS d ON d.dirnameid=t.dirnameid
+                                  JOIN {self.dirnames} AS p ON p.dirnameid=t.parent_dirnameid
+                                  WHERE p.dirname=%s""", (dirname,))
+        for (archive,) in children:
+            name = os.path.basename(archive)
+            if name not in files:
+                continue
+            # Members are in the directory named by the archive's path, or below it. '0' follows '/'.
+            files[name][5].extend(row[1:5] for row in self.files_in_directories(
+                scanid, "dirname=%s OR (dirname>=%s AND dirname<%s)", (archive, archive + "/", archive + "0")))
+        return files
+
+    def previous_archives(self, scanid, files):
+        """Given (path, pathid, mtime, size) tuples of files, return the set of their paths that have files below
+        them in scanid, i.e. the archives whose members scanid holds, and the set of the paths of those that were
+        in scanid with the same mtime and size. The first comes from the rollups (see rollup_scan)."""
+        self.ensure_rollups(scanid)
+        archives  = set()
+        unchanged = set()
+        for chunk in chunks(list(files), MAX_SQL_VARS - 1):
+            marks = ",".join(["%s"] * len(chunk))
+            archives.update(row[0] for row in self.csfra(
+                f"""SELECT dirname FROM {self.rollups} NATURAL JOIN {self.dirnames}
+                    WHERE scanid=%s AND dirname IN ({marks})""", [scanid] + [path for (path, pathid, mtime, size) in chunk]))
+            prior = set(tuple(row) for row in self.csfra(
+                f"SELECT pathid, mtime, size FROM {self.scan_files} WHERE scanid=%s AND pathid IN ({marks})",
+                [scanid] + [pathid for (path, pathid, mtime, size) in chunk]))
+            unchanged.update(path for (path, pathid, mtime, size) in chunk if (pathid, mtime, size) in prior)
+        return (archives, unchanged)
 
     # Perform scans
-    def scan_enabled_roots(self):
+    def scan_enabled_roots(self, preload=False, jobs=1, bufsize=scanner.HASH_BUFSIZE, dedup=False,
+                           bulk=False, batch_size=scanner.BATCH_SIZE,
+                           archive_depth=scanner.ARCHIVE_DEPTH, archive_formats=None,
+                           archive_max_size=scanner.ARCHIVE_MAX_SIZE, resume=False, progress=0, stats_json=None,
+                           fast_rescan=False):
+        """Scan every enabled root.
+        @param preload - if True, load the previous scan into memory first, so that unchanged files
+                         are carried forward without any per-file queries. S3 roots load their own
+                         bucket's objects (see S3Scanner).
+        @param jobs    - number of threads hashing files on local file systems, or listing shards of S3 buckets.
+        @param bufsize - bytes read at a time when hashing.
+        @param dedup   - if True, only fully hash local files that might be duplicates (see Scanner.hash_by_size).
+        @param bulk    - if True, use the backend's bulk-load profile (see begin_bulk_load).
+        @param batch_size - files written in each transaction.
+        @param archive_depth - levels of archives inside archives whose members are scanned on local file systems.
+        @param archive_formats - the archive formats to open (see scanner.ARCHIVE_READERS). By default, all of them.
+        @param archive_max_size - archives larger than this many bytes are scanned as ordinary files.
+        @param resume  - if True, continue the latest interrupted scan, if there is one, from its last checkpoint.
+                         Directories it completed are not scanned again (see Scanner.checkpoint).
+        @param progress - if not 0, print a progress line to stderr this often, in seconds.
+        @param stats_json - if given, write the scan's counters and timers (see scanner.ScanStats) to this file.
+        @param fast_rescan - if True, record the signature of each local directory, and do not list the directories
+                         whose signature is unchanged since the previous scan. In trusted roots their files are
+                         carried forward without being looked at; in others they are stat()ed by name
+                         (see scanner.FileScanner and set_trusted).
+        """
+        self.stats = scanner.ScanStats(progress)
+        self.check_schema()
+        self.restore_indexes()
         self.t0 = time.time()
-        self.scanid = self.get_scanid( self.t0 )
-        for root in self.get_enabled_roots():
-            if root.startswith("s3://"):
-                s = scanner.S3Scanner(self)
-            else:
-                s = scanner.FileScanner(self)
-            s.ingest_walk( root )
-            self.db.commit()
+        self.scanid = self.unfinished_scan() if resume else None
+        if self.scanid is not None:
+            if self.get_layout() == "intervals" and self.scanid < (self.last_scan() or 0):
+                raise RuntimeError(f"Scan {self.scanid} is older than scan {self.last_scan()}, "
+                                   "so it cannot be resumed in the intervals layout")
+            self.resumed = self.resume_scan(self.scanid)
+            print("Resuming scan {} with {:,} directories done".format(self.scanid, len(self.resumed)))
+        else:
+            self.scanid = self.get_scanid( self.t0 )
+        prev = self.previous_scan(self.scanid) if preload else None
+        # The archive options of the last completed scan. If it opened every archive this scan would, the unchanged
+        # files that it found no members in are not archives, and need not be opened (see Scanner.classify_archives).
+        options = {"depth": archive_depth, "formats": sorted(archive_formats or scanner.ARCHIVE_READERS),
+                   "max_size": archive_max_size}
+        prior = json.loads(self.get_metadata("archive_options", "null"))
+        self.archives_known = (prior is not None and prior["depth"] >= archive_depth and
+                               (prior["formats"], prior["max_size"]) == (options["formats"], archive_max_size))
+        if prev is not None:
+            self.snapshot = self.load_snapshot(prev)
+            print("Preloaded {:,} files from scan {} in {:.1f} seconds".format(len(self.snapshot), prev, time.time() - self.t0))
+        filecount = 0
+        dircount  = 0
+        carried   = 0
+        skipped   = 0
+        syscalls  = Counter()
+        trusted   = self.get_trusted_roots() if fast_rescan else set()
+        if bulk:
+            self.begin_bulk_load(initial=not self.csfra(f"SELECT fileid FROM {self.files} LIMIT 1"))
+        # In a dedup scan one scanner walks every local root, so that file sizes are compared across roots
+        # (see Scanner.hash_by_size). Its roots are finished, and checkpointed, together after the last one.
+        shared = None
+        shared_roots = []
+        scanners = []
+        try:
+            for root in self.get_enabled_roots():
+                if self.resumed and self.resumed.get(root):
+                    continue
+                if root.startswith("s3://"):
+                    s = scanner.S3Scanner(self, batch_size=batch_size, jobs=jobs, incremental=preload)
+                elif shared is not None:
+                    s = shared
+                    s.trusted = root in trusted
+                else:
+                    s = scanner.FileScanner(self, jobs=jobs, bufsize=bufsize, dedup=dedup, batch_size=batch_size,
+                                            archive_depth=archive_depth, archive_formats=archive_formats,
+                                            archive_max_size=archive_max_size,
+                                            fast_rescan=fast_rescan, trusted=root in trusted)
+                    shared = s if dedup else None
+                s.ingest_walk( root )
+                if s is shared:
+                    shared_roots.append(root)
+                    continue
+                s.finish()
+                self.add_checkpoints([(root, True)])
+                scanners.append(s)
+            if shared is not None:
+                shared.finish()
+                self.add_checkpoints([(root, True) for root in shared_roots])
+                scanners.append(shared)
+            for s in scanners:
+                filecount += s.filecount
+                dircount  += s.dircount
+                carried   += s.carried
+                skipped   += s.skipped
+                syscalls.update(s.syscalls)
+        finally:
+            if bulk:
+                self.end_bulk_load()
+        if self.snapshot is not None:
+            self.snapshot.close()
+            self.snapshot = None
+        self.resumed = None
+        self.ingest_done(time.time() - self.t0)
+        self.set_metadata("archive_options", json.dumps(options))
+        self.archives_known = False
+        with self.stats.timer("rollup"):
+            rolled = self.rollup_scan(self.scanid)
         self.t1 = time.time()
-        self.ingest_done(self.t1 - self.t0)
-        print("Total files added to database: {}".format(s.filecount))
-        print("Total directories scanned:     {}".format(s.dircount))
+        print("Total files added to database: {}".format(filecount))
+        print("Total directories scanned:     {}".format(dircount))
+        print("Directories rolled up:         {}".format(rolled))
+        if fast_rescan:
+            print("Directories skipped unchanged: {}".format(skipped))
+        if prev is not None or fast_rescan:
+            print("Carried forward unchanged:     {}".format(carried))
+        if filecount:
+            print("File system calls per file:    {:.2f} ({})".format(
+                sum(syscalls.values()) / filecount,
+                ", ".join("{} {:,}".format(name, count) for (name, count) in sorted(syscalls.items()))))
         print("Total time: {}".format(int(self.t1 - self.t0)))
+        print("Files per second: {:,.0f}".format(filecount / max(self.t1 - self.t0, 0.001)))
+        self.print_cache_stats()
+        if stats_json:
+            report = self.stats.report(scanid=self.scanid, files=filecount, directories=dircount, carried=carried,
+                                       skipped=skipped,
+                                       syscalls=dict(syscalls),
+                                       caches={name: {"hits": cache.hits, "misses": cache.misses}
+                                               for (name, cache) in self.caches.items()})
+            with open(stats_json, "w") as f:
+                json.dump(report, f, indent=4)
             
     def get_scans(self):
         return self.csfra(f"SELECT scanid, time, duration FROM {self.scans} NATURAL JOIN {self.roots}")
 
     def last_scan(self):
-        return self.csfra(f"SELECT MAX(scanid) FROM {self.scans}")[0][0]
+        """Return the latest completed scan, or None if there is none"""
+        return self.csfra(f"SELECT MAX(scanid) FROM {self.scans} WHERE duration IS NOT NULL")[0][0]
+
+    # Retention. compact() deletes old scans in batches of COMPACT_BATCH_SIZE rows, each its own transaction,
+    # and then the paths, dirnames, filenames and hashes that nothing refers to any more.
+
+    def delete_in_batches(self, table, key, where, vals=(), batch_size=COMPACT_BATCH_SIZE):
+        """Delete the rows of table that match where, batch_size at a time in order of key, committing each batch.
+        Return the number of rows deleted."""
+        count = 0
+        last  = None
+        while True:
+            after = f"{key}>%s AND " if last is not None else ""
+            ids = [row[0] for row in self.csfra(f"SELECT {key} FROM {table} WHERE {after}{where} ORDER BY {key} "
+                                                f"LIMIT {int(batch_size)}", ((last,) if after else ()) + tuple(vals))]
+            for chunk in chunks(ids, MAX_SQL_VARS):
+                self.csfra(f"DELETE FROM {table} WHERE {key} IN ({','.join(['%s'] * len(chunk))})", chunk)
+            self.commit()
+            count += len(ids)
+            if len(ids) < batch_size:
+                return count
+            last = ids[-1]
+
+    def expired_scans(self, keep=None, before=None):
+        """Return the scans that compact() would delete: the completed scans other than the latest keep ones,
+        and those that started before the datetime before, but never the latest completed scan. Interrupted scans
+        older than the latest completed scan are included too, as they can no longer be resumed usefully."""
+        scans = [row[0] for row in self.csfra(
+            f"SELECT scanid FROM {self.scans} WHERE duration IS NOT NULL ORDER BY scanid DESC")]
+        expired = set(scans[max(keep, 1):]) if keep is not None else set()
+        if before is not None:
+            expired.update(row[0] for row in self.csfra(
+                f"SELECT scanid FROM {self.scans} WHERE duration IS NOT NULL AND time<%s AND scanid<%s",
+                (before.replace(microsecond=0).isoformat(), scans[0] if scans else 0)))
+        if scans:
+            expired.update(row[0] for row in self.csfra(
+                f"SELECT scanid FROM {self.scans} WHERE duration IS NULL AND scanid<%s", (scans[0],)))
+        return sorted(expired)
+
+    def compact(self, keep=None, before=None, batch_size=COMPACT_BATCH_SIZE):
+        """Delete the expired_scans() and everything that only they refer to, and reclaim the space.
+        The scans disappear from reports at once; their files then go in batches of batch_size rows.
+        While a scan is running, the paths, dirnames, filenames and hashes that nothing refers to are kept,
+        as the scan may be about to refer to them again, and the tables are not rebuilt.
+        Return a dictionary of the rows deleted from each table, the bytes used before and after, and the seconds taken.
+        """
+        t0 = time.time()
+        bytes_before = self.database_bytes()
+        scanids = self.expired_scans(keep=keep, before=before)
+        deleted = Counter()
+        for chunk in chunks(scanids, MAX_SQL_VARS):
+            marks = ",".join(["%s"] * len(chunk))
+            deleted[self.scans] += len(chunk)
+            self.csfra(f"DELETE FROM {self.checkpoints} WHERE scanid IN ({marks})", chunk)
+            self.csfra(f"DELETE FROM {self.rollups} WHERE scanid IN ({marks})", chunk)
+            self.csfra(f"DELETE FROM {self.dirscans} WHERE scanid IN ({marks})", chunk)
+            self.csfra(f"DELETE FROM {self.scans} WHERE scanid IN ({marks})", chunk)
+        self.commit()
+        # Files of scans that no longer exist, including any left by a compaction that was interrupted
+        for scanid in [row[0] for row in self.csfra(f"""SELECT DISTINCT scanid FROM {self.files}
+                                                        WHERE scanid NOT IN (SELECT scanid FROM {self.scans})""")]:
+            deleted[self.files] += self.delete_in_batches(self.files, "fileid", "scanid=%s", (scanid,), batch_size)
+        # Versions that end before the oldest scan left. Scans are only ever deleted oldest first.
+        oldest = self.csfra(f"SELECT MIN(scanid) FROM {self.scans} WHERE duration IS NOT NULL")[0][0]
+        if oldest is not None:
+            deleted[self.versions] += self.delete_in_batches(self.versions, "versionid", "last_scanid<%s",
+                                                              (oldest,), batch_size)
+        running = self.unfinished_scan() is not None
+        if not running:
+            def unused(table, key, *referrers):
+                return " AND ".join(f"NOT EXISTS (SELECT 1 FROM {referrer} AS r WHERE r.{column}={table}.{key})"
+                                    for (referrer, column) in referrers)
+            for (table, key, referrers) in [(self.paths, "pathid", ((self.files, "pathid"), (self.versions, "pathid"))),
+                                            (self.filenames, "filenameid", ((self.paths, "filenameid"),)),
+                                            (self.crcs, "hashid", ((self.files, "hashid"), (self.versions, "hashid"))),
+                                            (self.hashes, "hashid", ((self.files, "hashid"), (self.versions, "hashid")))]:
+                deleted[table] += self.delete_in_batches(table, key, unused(table, key, *referrers),
+                                                         batch_size=batch_size)
+            # A directory that is the parent of another in dirtree is kept, so this frees a level at a time
+            while True:
+                count = self.delete_in_batches(self.dirnames, "dirnameid",
+                                               unused(self.dirnames, "dirnameid", (self.paths, "dirnameid"),
+                                                      (self.rollups, "dirnameid"), (self.dirscans, "dirnameid"),
+                                                      (self.dirtree, "parent_dirnameid")),
+                                               batch_size=batch_size)
+                deleted[self.dirtree] += self.delete_in_batches(
+                    self.dirtree, "dirnameid", unused(self.dirtree, "dirnameid", (self.dirnames, "dirnameid")),
+                    batch_size=batch_size)
+                deleted[self.dirnames] += count
+                if not count:
+                    break
+            self.clear_caches()
+        self.reclaim_space(rebuild=not running)
+        return {"scans": scanids,
+                "deleted": {table: count for (table, count) in deleted.items() if count},
+                "deferred": running,
+                "bytes_before": bytes_before,
+                "bytes_after": self.database_bytes(),
+                "seconds": round(time.time() - t0, 3)}
+
+    # The directory tree. Each directory in dirtree points to its parent, which is in dirnames too, up to
+    # a top directory whose parent is NULL. The rollup of a directory in a scan covers every file below it.
+    # Its hash is a Merkle hash of the names and hashes of the files in it and the names and rollup hashes
+    # of its subdirectories, so it changes exactly when something below it does. The members of an archive
+    # have their own rollup, but are not counted in the archive's directory, which counts the archive itself.
+
+    def update_dirtree(self, dirnames):
+        """Add the directories in dirnames, a dictionary mapping each to its dirnameid, and their ancestors
+        to dirtree. Return a dictionary mapping the dirname of each of them and their ancestors to its
+        (dirnameid, parent dirname or None)."""
+        tree = {}
+        todo = dict(dirnames)
+        while todo:
+            parents = {dirname: parent_dirname(dirname) for dirname in todo}
+            missing = set(parent for parent in parents.values()
+                          if parent is not None and parent not in tree and parent not in todo)
+            for (dirname, dirnameid) in todo.items():
+                tree[dirname] = (dirnameid, parents[dirname])
+            todo = self._bulk_ids(self.dirnames, "dirnameid", "dirname", list(missing)) if missing else {}
+        rows = [(dirnameid, tree[parent][0] if parent is not None else None)
+                for (dirnameid, parent) in tree.values()]
+        for chunk in chunks(rows, MAX_SQL_VARS // 2):
+            self.csfra(f"INSERT IGNORE INTO {self.dirtree} (dirnameid,parent_dirnameid) VALUES "
+                       + ",".join(["(%s,%s)"] * len(chunk)), [val for row in chunk for val in row])
+        self.commit()
+        return tree
+
+    def rollup_scan(self, scanid):
+        """Compute the rollups of every directory in the completed scan scanid, replacing any it had.
+        The files are streamed in one query, a directory at a time, so only the directories are held in memory.
+        Directories are then completed longest first, so each one's subdirectories are done before it.
+        Return the number of directories."""
+        dirnames = dict(self.csfra(f"""SELECT DISTINCT dirname, dirnameid
+                                      FROM {self.scan_files} NATURAL JOIN {self.paths} NATURAL JOIN {self.dirnames}
+                                      WHERE scanid=%s""", (scanid,)))
+        tree = self.update_dirtree(dirnames)
+        # dirname -> [files, bytes, digest of the files directly in it, [(name, hash) of subdirectories]]
+        totals = {dirname: [0, 0, rollup_hash().digest(), []] for dirname in tree}
+        archives = set()
+        rows = self.iter_select(f"""SELECT dirname, filename, size, hash
+                                    FROM {self.scan_files}
+                                         NATURAL JOIN {self.paths}
+                                         NATURAL JOIN {self.dirnames}
+                                         NATURAL JOIN {self.filenames}
+                                         JOIN {self.hashes} USING (hashid)
+                                    WHERE scanid=%s ORDER BY dirname, filename""", (scanid,))
+        for (dirname, files) in itertools.groupby(rows, key=lambda row: row[0]):
+            total = totals[dirname]
+            digest = rollup_hash()
+            for (dirname, filename, size, value) in files:
+                total[0] += 1
+                total[1] += size
+                digest.update(rollup_entry(filename, value))
+                if os.path.join(dirname, filename) in dirnames:
+                    archives.add(os.path.join(dirname, filename))
+            total[2] = digest.digest()
+        rollups = []
+        for dirname in sorted(tree, key=len, reverse=True):
+            (files, size, filedigest, subdirs) = totals[dirname]
+            digest = rollup_hash(filedigest)
+            for (name, value) in sorted(subdirs):
+                digest.update(rollup_entry(name, value))
+            (dirnameid, parent) = tree[dirname]
+            rollups.append((scanid, dirnameid, files, size, digest.digest(), int(dirname in archives)))
+            if parent is not None and dirname not in archives:
+                totals[parent][0] += files
+                totals[parent][1] += size
+                totals[parent][3].append((os.path.basename(dirname), rollups[-1][4]))
+        self.csfra(f"DELETE FROM {self.rollups} WHERE scanid=%s", (scanid,))
+        for chunk in chunks(rollups, MAX_SQL_VARS // 6):
+            self.csfra(f"INSERT INTO {self.rollups} (scanid,dirnameid,files,bytes,hash,archive) VALUES "
+                       + ",".join(["(%s,%s,%s,%s,%s,%s)"] * len(chunk)), [val for row in chunk for val in row])
+        self.commit()
+        return len(rollups)
+
+    def ensure_rollups(self, *scanids):
+        """Compute the rollups of any of scanids that has none, such as scans made before schema version 9."""
+        for scanid in scanids:
+            self.check_complete(scanid)
+            if not self.csfra(f"SELECT scanid FROM {self.rollups} WHERE scanid=%s LIMIT 1", (scanid,)):
+                self.rollup_scan(scanid)
+
+    def subtree(self, scanid, dirname):
+        """Return the rollup of dirname in scanid as a dictionary of its files, bytes and hash,
+        or None if there were no files below it."""
+        self.ensure_rollups(scanid)
+        for (files, size, value) in self.csfra(f"""SELECT files, bytes, hash FROM {self.rollups}
+                                                   NATURAL JOIN {self.dirnames}
+                                                   WHERE scanid=%s AND dirname=%s""", (scanid, dirname.rstrip("/") or "/")):
+            return {"files": files, "bytes": size, "hash": bytes(value)}
+        return None
+
+    def changed_directories(self, scan0, scan1, dirname=None):
+        """Yield a dictionary for each directory that is "new" in scan1, "deleted" from scan0, or "changed"
+        between them, at or below dirname (by default, everywhere), parents before children.
+        Each has the directory's change, dirname, and files and bytes in each scan (None where absent).
+        The subdirectories of new and deleted directories are not reported, and only the subdirectories of
+        changed directories are read, so the time taken grows with the changes rather than with the scans."""
+        self.ensure_rollups(scan0, scan1)
+        select = f"""SELECT t.dirnameid, dirname, a.files, a.bytes, a.hash, b.files, b.bytes, b.hash
+                     FROM {self.dirtree} AS t
+                          JOIN {self.dirnames} AS d ON d.dirnameid=t.dirnameid
+                          LEFT JOIN {self.rollups} AS a ON a.scanid=%s AND a.dirnameid=t.dirnameid
+                          LEFT JOIN {self.rollups} AS b ON b.scanid=%s AND b.dirnameid=t.dirnameid
+                     WHERE (a.dirnameid IS NOT NULL OR b.dirnameid IS NOT NULL) AND """
+        if dirname is None:
+            level = self.csfra(select + "t.parent_dirnameid IS NULL", (scan0, scan1))
+        else:
+            level = self.csfra(select + "d.dirname=%s", (scan0, scan1, dirname.rstrip("/") or "/"))
+        while level:
+            changed = []
+            for (dirnameid, name, files0, bytes0, hash0, files1, bytes1, hash1) in sorted(level, key=lambda row: row[1]):
+                if hash0 == hash1:
+                    continue
+                change = "new" if hash0 is None else "deleted" if hash1 is None else "changed"
+                if change == "changed":
+                    changed.append(dirnameid)
+                yield {"change": change, "dirname": name,
+                       "files0": files0, "bytes0": bytes0, "files1": files1, "bytes1": bytes1}
+            level = []
+            for chunk in chunks(changed, MAX_SQL_VARS - 2):
+                level += self.csfra(select + f"t.parent_dirnameid IN ({','.join(['%s'] * len(chunk))})",
+                                    [scan0, scan1] + chunk)
+
+    # Duplicate directories, from the rollups. A duplicate is reported at the highest level at which it occurs:
+    # the subdirectories of identical directories are identical too, but are only reported where they
+    # have a copy that the identical directories above them do not account for.
+
+    def duplicate_directories(self, scanid=None, min_bytes=0):
+        """Yield a dictionary for each set of identical directories with at least min_bytes in scanid, largest first.
+        Each has the files and bytes of one copy, the dirnames of the copies, and the bytes that deleting
+        all but one copy would reclaim. A copy inside a set of identical directories stands for all of them.
+        Only the directories with duplicates are held in memory, not their files."""
+        scanid = scanid or self.last_scan()
+        self.ensure_rollups(scanid)
+        rows = self.csfra(f"""SELECT r.hash, r.files, r.bytes, r.dirnameid, t.parent_dirnameid, d.dirname
+                              FROM {self.rollups} AS r
+                                   JOIN (SELECT hash FROM {self.rollups}
+                                         WHERE scanid=%s AND bytes>=%s AND files>0 AND archive=0
+                                         GROUP BY hash HAVING COUNT(*)>1) AS dups ON dups.hash=r.hash
+                                   JOIN {self.dirtree}  AS t ON t.dirnameid=r.dirnameid
+                                   JOIN {self.dirnames} AS d ON d.dirnameid=r.dirnameid
+                              WHERE r.scanid=%s AND r.archive=0
+                              ORDER BY r.bytes DESC, r.hash, d.dirname""", (scanid, min_bytes, scanid))
+        group = {dirnameid: bytes(value) for (value, files, size, dirnameid, parent, dirname) in rows}
+        for ((value, files, size), members) in itertools.groupby(rows, key=lambda row: (bytes(row[0]), row[1], row[2])):
+            copies = {}
+            for (value, files, size, dirnameid, parent, dirname) in members:
+                # Copies at the same place in identical parents are one copy
+                key = (group[parent], os.path.basename(dirname)) if parent in group else dirnameid
+                copies.setdefault(key, dirname)
+            if len(copies) > 1:
+                yield {"files": files, "bytes": size, "reclaimable": size * (len(copies) - 1),
+                       "dirnames": sorted(copies.values())}
+
+    def similar_directories(self, scanid=None, similarity=0.8, min_bytes=0):
+        """Yield a dictionary for each pair of directories in scanid with at least min_bytes and two files that
+        are at least similarity alike but not identical, most alike and then largest first. Likeness is the
+        estimated Jaccard similarity of the sets of file contents below them, whatever the files are called.
+        Each has the similarity and the dirnames, files and bytes of the pair. Pairs whose parents are
+        alike too are not reported, nor are directories and their own subdirectories, nor more than one
+        pair with the same contents.
+        The MinHash signatures are built in one pass over the scan's files, a directory at a time,
+        and passed up the tree, so only the directories are held in memory."""
+        scanid = scanid or self.last_scan()
+        self.ensure_rollups(scanid)
+        dirs = {dirname: (files, size, bytes(value), archive, parent)
+                for (dirname, files, size, value, archive, parent) in self.iter_select(
+                        f"""SELECT d.dirname, r.files, r.bytes, r.hash, r.archive, p.dirname
+                            FROM {self.rollups} AS r
+                                 JOIN {self.dirnames} AS d ON d.dirnameid=r.dirnameid
+                                 JOIN {self.dirtree}  AS t ON t.dirnameid=r.dirnameid
+                                 LEFT JOIN {self.dirnames} AS p ON p.dirnameid=t.parent_dirnameid
+                            WHERE r.scanid=%s""", (scanid,))}
+        signatures = {}
+        rows = self.iter_select(f"""SELECT dirname, hash
+                                    FROM {self.scan_files}
+                                         NATURAL JOIN {self.paths}
+                                         NATURAL JOIN {self.dirnames}
+                                         JOIN {self.hashes} USING (hashid)
+                                    WHERE scanid=%s ORDER BY dirname""", (scanid,))
+        for (dirname, files) in itertools.groupby(rows, key=lambda row: row[0]):
+            signature = [MINHASH_PRIME] * MINHASH_PERMUTATIONS
+            for (dirname, value) in files:
+                signature = list(map(min, signature, minhash(value)))
+            signatures[dirname] = signature
+        direct  = set(signatures)
+        subdirs = Counter()
+        for dirname in sorted(dirs, key=len, reverse=True):
+            (files, size, value, archive, parent) = dirs[dirname]
+            if parent is not None and not archive and dirname in signatures:
+                subdirs[parent] += 1
+                signatures[parent] = list(map(min, signatures.get(parent, signatures[dirname]), signatures[dirname]))
+
+        eligible = [dirname for (dirname, (files, size, value, archive, parent)) in dirs.items()
+                    if files > 1 and size >= min_bytes and not archive and dirname in signatures
+                    # a directory with no files of its own and one subdirectory is represented by the subdirectory
+                    and (dirname in direct or subdirs[dirname] != 1)]
+        width = MINHASH_PERMUTATIONS // MINHASH_BANDS
+        buckets = {}
+        for dirname in eligible:
+            for band in range(MINHASH_BANDS):
+                buckets.setdefault((band, tuple(signatures[dirname][band * width:(band + 1) * width])), []).append(dirname)
+        pairs = {}
+        for members in buckets.values():
+            if len(members) > MINHASH_MAX_BUCKET:
+                continue
+            for (a, b) in itertools.combinations(sorted(members), 2):
+                if (a, b) in pairs or dirs[a][2] == dirs[b][2] or b.startswith(a.rstrip("/") + "/"):
+                    continue
+                if min(dirs[a][0], dirs[b][0]) < similarity * max(dirs[a][0], dirs[b][0]):
+                    continue        # too different in size to be that alike
+                alike = sum(x == y for (x, y) in zip(signatures[a], signatures[b])) / MINHASH_PERMUTATIONS
+                if alike >= similarity:
+                    pairs[(a, b)] = alike
+        reported = set()
+        for ((a, b), alike) in sorted(pairs.items(), key=lambda item: (-item[1], -max(dirs[item[0][0]][1],
+                                                                                          dirs[item[0][1]][1]))):
+            (pa, pb) = sorted((dirs[a][4] or "", dirs[b][4] or ""))
+            if (pa, pb) in pairs or (pa in dirs and pb in dirs and pa != pb and dirs[pa][2] == dirs[pb][2]):
+                continue
+            # Only one pair is reported for identical copies of the pair
+            contents = tuple(sorted((dirs[a][2], dirs[b][2])))
+            if contents in reported:
+                continue
+            reported.add(contents)
+            yield {"similarity": alike, "dirnames": [a, b],
+                   "files": [dirs[a][0], dirs[b][0]], "bytes": [dirs[a][1], dirs[b][1]]}
 
     # Set math on the files
     def all_files(self, scan0):
         # Generating crash on SQLite3 but not MySQL
         results = self.csfra(f"""SELECT pathid, fileid, size, dirnameid, dirname, filenameid, filename, mtime 
-                               FROM {self.files}
+                               FROM {self.scan_files}
                                           NATURAL JOIN {self.paths} 
                                           NATURAL JOIN {self.dirnames} 
                                           NATURAL JOIN {self.filenames} 
@@ -299,13 +1666,14 @@ class ScanDatabase(ABC):
 
     def new_files(self, scan0, scan1):
         """Files in scan scan1 that are not in scan scan0"""
-        results = self.csfra(f"""SELECT fileid, pathid, size,  dirnameid, dirname, filenameid, filename, mtime 
-                               FROM {self.files} 
+        results = self.iter_select(f"""SELECT fileid, pathid, size,  dirnameid, dirname, filenameid, filename, mtime 
+                               FROM {self.scan_files} AS b
                                           NATURAL JOIN {self.paths} 
                                           NATURAL JOIN {self.dirnames} 
                                           NATURAL JOIN {self.filenames} 
-                               WHERE scanid={scan1} AND pathid NOT IN (SELECT pathid FROM {prefix}files WHERE scanid={scan0})
-                               """)
+                               WHERE scanid=%s AND NOT EXISTS (SELECT 1 FROM {self.scan_files} AS a
+                                                               WHERE a.scanid=%s AND a.pathid=b.pathid)
+                               """, (scan1, scan0))
         for fileid, pathid, size, dirnameid, dirname, filenameid, filename, mtime in results:
             yield {"fileid": fileid, "pathid": pathid, "size": size,
                    "dirnameid": dirnameid, "dirname": dirname, "filenameid": filenameid, "filename": filename,
@@ -316,75 +1684,110 @@ class ScanDatabase(ABC):
 
     def changed_files(self, scan0, scan1):
         """Files that were changed between scan0 and scan1.
-        The second select could (should) be done with a join.
+        Files in scan1 are matched to scan0 through the files(scanid,pathid) index. Hashes are only compared
+        if they were made the same way, so a change of algorithm or a dedup scan does not show every file as changed.
         """
-        ret = []
-        results = self.csfra(f"""SELECT a.pathid as pathid, a.hashid, b.hashid FROM 
-                               (SELECT pathid, hashid, scanid FROM {self.files} WHERE scanid={scan0}) as a 
-                               JOIN (SELECT pathid, hashid, scanid FROM {self.files} WHERE scanid={scan1}) as b 
-                               ON a.pathid=b.pathid WHERE a.hashid != b.hashid""")
-        for pathid, ahashid, bhashid in results:
-            dirnameid, filenameid = self.csfra(f"SELECT dirnameid, filenameid FROM {self.paths} WHERE pathid={pathid}")[0]
-            dirname = self.csfra(f"SELECT dirname FROM {self.dirnames} WHERE dirnameid={dirnameid}")[0][0]
-            filename = self.csfra(f"SELECT filename FROM {self.filenames} WHERE filenameid={filenameid}")[0][0]
+        results = self.iter_select(f"""SELECT dirname, filename
+                                       FROM {self.scan_files} AS b
+                                            JOIN {self.scan_files}  AS a  ON a.scanid=%s AND a.pathid=b.pathid
+                                            JOIN {self.hashes} AS ha ON ha.hashid=a.hashid
+                                            JOIN {self.hashes} AS hb ON hb.hashid=b.hashid
+                                            JOIN {self.paths}  AS p  ON p.pathid=b.pathid
+                                            JOIN {self.dirnames}  AS d ON d.dirnameid=p.dirnameid
+                                            JOIN {self.filenames} AS f ON f.filenameid=p.filenameid
+                                       WHERE b.scanid=%s AND a.hashid != b.hashid
+                                             AND ha.algorithm=hb.algorithm AND ha.partial=hb.partial""",
+                                    (scan0, scan1))
+        for (dirname, filename) in results:
             yield {"dirname": dirname, "filename": filename}
 
+    # Bulk export. Each method streams tuples from single queries rather than building a dict per file.
+
+    SCAN_ROW_ORDERS = {None: "", "path": "ORDER BY dirname, filename", "hash": "ORDER BY hash, dirname, filename"}
+
+    def scan_rows(self, scanid, order=None):
+        """Return an iterator over (dirname, filename, size, mtime, hash) for every file in scanid.
+        @param order - None for the database's order, or "path" or "hash" to have the database sort the rows."""
+        rows = self.iter_select(f"""SELECT dirname, filename, size, mtime, hash, algorithm
+                                    FROM {self.scan_files}
+                                         NATURAL JOIN {self.paths}
+                                         NATURAL JOIN {self.dirnames}
+                                         NATURAL JOIN {self.filenames}
+                                         JOIN {self.hashes} USING (hashid)
+                                    WHERE scanid=%s {self.SCAN_ROW_ORDERS[order]}""", (scanid,))
+        return ((dirname, filename, size, mtime, hash_from_db(value, algorithm))
+                for (dirname, filename, size, mtime, value, algorithm) in rows)
+
+    def delta_rows(self, scan0, scan1):
+        """Yield (change, dirname, filename, size, mtime, hash) for each file that is "new" in scan1, "changed"
+        between the scans, or "deleted" from scan0, as new_files(), changed_files() and deleted_files() find them.
+        New and changed files have their size, mtime and hash in scan1, and deleted ones those in scan0."""
+        select = f"""SELECT dirname, filename, b.size, b.mtime, hb.hash, hb.algorithm
+                     FROM {self.scan_files} AS b
+                          JOIN {self.paths}     AS p  ON p.pathid=b.pathid
+                          JOIN {self.dirnames}  AS d  ON d.dirnameid=p.dirnameid
+                          JOIN {self.filenames} AS f  ON f.filenameid=p.filenameid
+                          JOIN {self.hashes}    AS hb ON hb.hashid=b.hashid"""
+        absent = f"NOT EXISTS (SELECT 1 FROM {self.scan_files} AS a WHERE a.scanid=%s AND a.pathid=b.pathid)"
+        for (change, cmd, vals) in [
+                ("new",     f"{select} WHERE b.scanid=%s AND {absent}", (scan1, scan0)),
+                ("changed", f"""{select} JOIN {self.scan_files}  AS a  ON a.scanid=%s AND a.pathid=b.pathid
+                                         JOIN {self.hashes} AS ha ON ha.hashid=a.hashid
+                                WHERE b.scanid=%s AND a.hashid != b.hashid
+                                      AND ha.algorithm=hb.algorithm AND ha.partial=hb.partial""", (scan0, scan1)),
+                ("deleted", f"{select} WHERE b.scanid=%s AND {absent}", (scan0, scan1))]:
+            for (dirname, filename, size, mtime, value, algorithm) in self.iter_select(cmd, vals):
+                yield (change, dirname, filename, size, mtime, hash_from_db(value, algorithm))
+
     def duplicate_files(self, scanid=None, min_dupsize=0):
         """Return a generator for the duplicate files at scanid.
-        Returns a list of a list of File objects, sorted by size.
-        This should probabe be done with a subselect.
+        Yields a list of File objects for each set of duplicates, largest files first.
+        The files of every set come from one query, ordered so that each set's rows are consecutive,
+        so only one set is held in memory at a time.
         """
         if scanid is None:
             scanid = self.last_scan()
 
-        cresult = self.csfra(f"""SELECT hashid, ct, size FROM 
-                                        (SELECT hashid, count(hashid) AS ct, size FROM {self.files} 
-                                         WHERE scanid=%s GROUP BY hashid, size) as T 
-                                 WHERE ct>1 AND size>%s ORDER BY 3 DESC""", (scanid,min_dupsize))
-        for hashid, ct, size in cresult:
-            ret = []
-            dresult = self.csfra(f"""SELECT fileid,pathid,size,dirnameid,dirname,filenameid,filename,mtime 
-                                   FROM {self.files} 
-                                         NATURAL JOIN {self.paths} 
-                                         NATURAL JOIN {self.dirnames} 
-                                         NATURAL JOIN {self.filenames} 
-                                   WHERE scanid=%s AND hashid=%s""",(scanid,hashid))
-            for fileid, pathid, size, dirnameid, dirname, filenameid, filename, mtime in dresult:
-                ret.append({"fileid": fileid, "pathid": pathid, "size": size,
-                            "dirnameid": dirnameid, "dirname": dirname, "filenameid": filenameid,
-                            "filename": filename, "mtime": mtime})
-            yield ret
+        results = self.iter_select(f"""SELECT hashid,fileid,pathid,size,dirnameid,dirname,filenameid,filename,mtime
+                                       FROM {self.scan_files}
+                                            NATURAL JOIN {self.paths}
+                                            NATURAL JOIN {self.dirnames}
+                                            NATURAL JOIN {self.filenames}
+                                            JOIN (SELECT hashid, size FROM {self.scan_files}
+                                                  WHERE scanid=%s AND size>%s
+                                                  GROUP BY hashid, size HAVING COUNT(*)>1) AS dups USING (hashid, size)
+                                       WHERE scanid=%s
+                                       ORDER BY size DESC, hashid, fileid""", (scanid, min_dupsize, scanid))
+        for (key, rows) in itertools.groupby(results, key=lambda row: (row[0], row[3])):
+            yield [{"fileid": fileid, "pathid": pathid, "size": size,
+                    "dirnameid": dirnameid, "dirname": dirname, "filenameid": filenameid,
+                    "filename": filename, "mtime": mtime}
+                   for (hashid, fileid, pathid, size, dirnameid, dirname, filenameid, filename, mtime) in rows]
 
 
     def renamed_files(self, scan0, scan1):
-        """Return a generator for the duplicate files at scan0.
-        The generator returns pairs of (F_old,F_new)
+        """Return a generator for the files in scan1 whose contents were in scan0 under another path.
+        The generator returns dicts of the old and new dirname and filename.
 
-        TODO: renamed files only tracks last scanned file. Will consider
+        TODO: renamed files only tracks one file per hash. Will consider
         any file containing the same information as renamed if they have
-        different names.
+        different names. The old name is the one with the highest pathid.
         """
-
-        def get_singletons(scanid):
-            return self.csfra(f"""SELECT hashID, pathid, count(*) AS ct 
-                                  FROM {self.files} WHERE scanid={scanid} GROUP BY hashid, pathid HAVING ct=1""")
-
-        pairs_in_scan0 = set()
-        path1_for_hash = {}
-        for (hashID, path1, count) in get_singletons(scan0):
-            pairs_in_scan0.add((hashID, path1))
-            path1_for_hash[hashID] = path1
-
-        for (hashID, path2, count) in get_singletons(scan1):
-            if hashID in path1_for_hash and (hashID, path2) not in pairs_in_scan0:
-                dirnameid1, filenameid1 = self.csfra(f"SELECT dirnameid, filenameid FROM {self.paths} WHERE pathid={path1_for_hash[hashID]}")[0]
-                dirname1  = self.csfra(f"SELECT dirname FROM {self.dirnames} WHERE dirnameid={dirnameid1}")[0][0]
-                filename1 = self.csfra(f"SELECT filename FROM {self.filenames} WHERE filenameid={filenameid1}")[0][0]
-                dirnameid2, filenameid2 = self.csfra(f"SELECT dirnameid, filenameid FROM {self.paths} WHERE pathid={path2}")[0]
-                dirname2 = self.csfra(f"SELECT dirname FROM {self.dirnames} WHERE dirnameid={dirnameid2}")[0][0]
-                filename2 = self.csfra(f"SELECT filename FROM {self.filenames} WHERE filenameid={filenameid2}")[0][0]
-                yield {"dirname1": dirname1, "filename1": filename1, "dirname2": dirname2, "filename2": filename2}
-                # yield ({"hashid":hashID, "pathid":path1_for_hash[hashID]}, {"hashid": hashID, "pathid": path2})
+        results = self.iter_select(f"""SELECT d1.dirname, f1.filename, d2.dirname, f2.filename
+                                       FROM {self.scan_files} AS b
+                                            JOIN (SELECT hashid, MAX(pathid) AS pathid FROM {self.scan_files}
+                                                  WHERE scanid=%s GROUP BY hashid) AS a ON a.hashid=b.hashid
+                                            JOIN {self.paths}     AS p1 ON p1.pathid=a.pathid
+                                            JOIN {self.dirnames}  AS d1 ON d1.dirnameid=p1.dirnameid
+                                            JOIN {self.filenames} AS f1 ON f1.filenameid=p1.filenameid
+                                            JOIN {self.paths}     AS p2 ON p2.pathid=b.pathid
+                                            JOIN {self.dirnames}  AS d2 ON d2.dirnameid=p2.dirnameid
+                                            JOIN {self.filenames} AS f2 ON f2.filenameid=p2.filenameid
+                                       WHERE b.scanid=%s AND NOT EXISTS (SELECT 1 FROM {self.scan_files} AS c
+                                                WHERE c.scanid=%s AND c.pathid=b.pathid AND c.hashid=b.hashid)""",
+                                    (scan0, scan1, scan0))
+        for (dirname1, filename1, dirname2, filename2) in results:
+            yield {"dirname1": dirname1, "filename1": filename1, "dirname2": dirname2, "filename2": filename2}
 
     def report(self, a, b, doc=None):
         """Generate a report from time a to time b. 
@@ -392,6 +1795,7 @@ class ScanDatabase(ABC):
         """
         if doc is None:
             doc = Ignore()
+        self.check_complete(a, b)
 
         atime = self.db.execselect(
             "SELECT time FROM {prefix}scans WHERE scanid={scanid}"
@@ -514,29 +1918,210 @@ class ScanDatabase(ABC):
 
 class SQLite3ScanDatabase(ScanDatabase):
     """ScanDatabase for SQLite3"""
-    def __init__(self, *, fname, prefix="", debug=None):
-        super().__init__(db = dbfile.DBSqlite3(fname=fname, debug=debug), prefix=prefix)
+    def __init__(self, *, fname, prefix="", debug=None, cache_sizes=None):
+        super().__init__(db = dbfile.DBSqlite3(fname=fname, debug=debug), prefix=prefix, cache_sizes=cache_sizes)
+
+    VERSIONS_SCHEMA = SQLITE3_VERSIONS_SCHEMA
+    DIRTREE_SCHEMA  = SQLITE3_DIRTREE_SCHEMA
+    DIRSCANS_SCHEMA = SQLITE3_DIRSCANS_SCHEMA
 
     def create_database(self):
         self.db.create_schema(SQLITE3_SCHEMA)
+        self.clear_caches()
+        self.hash_algorithm = None
+        self.layout = None
+        self.upgrade_database()
+
+    def get_columns(self, table):
+        return [row[1] for row in self.csfra(f"PRAGMA table_info({table})")]
+
+    def get_indexes(self, table):
+        return [row[1] for row in self.csfra(f"PRAGMA index_list({table})")]
+
+    def database_bytes(self):
+        """The pages in use. Pages freed by deletions stay in the file, to be reused, until VACUUM."""
+        (pages, free, page_size) = [self.csfra(f"PRAGMA {pragma}")[0][0]
+                                    for pragma in ("page_count", "freelist_count", "page_size")]
+        return (pages - free) * page_size
+
+    def reclaim_space(self, rebuild):
+        """VACUUM rewrites the whole file, so it shrinks, and ANALYZE updates sqlite_stat1."""
+        self.commit()
+        if rebuild:
+            self.csfra("VACUUM")
+        self.csfra("ANALYZE")
+        self.commit()
+
+    def convert_hashes(self):
+        """The table is rebuilt from the schema, converting each hash with hash_to_db() inside SQLite.
+        The UNIQUE constraint's index is the only one on hash; the old hashes_idx2 duplicated it."""
+        if [row[2] for row in self.csfra(f"PRAGMA table_info({self.hashes})") if row[1] == "hash"] == ["BLOB"]:
+            return
+        self.db.conn.create_function("hash_to_db", 1, hash_to_db, deterministic=True)
+        self.csfra(SQLITE3_HASHES_TABLE.replace(" hashes ", " new_hashes ", 1))
+        self.csfra(f"""INSERT INTO new_hashes (hashid, hash, algorithm, partial)
+                       SELECT hashid, hash_to_db(hash), algorithm, partial FROM {self.hashes}""")
+        self.csfra(f"DROP TABLE {self.hashes}")
+        self.csfra(f"ALTER TABLE new_hashes RENAME TO {self.hashes}")
+        self.csfra(SQLITE3_INDEXES["hashes_idx1"])
+        self.commit()
+
+    def widen_hash_key(self):
+        """The table is rebuilt from the schema, as a UNIQUE constraint cannot be changed in place."""
+        for (seq, name, unique, *rest) in self.csfra(f"PRAGMA index_list({self.hashes})"):
+            if unique and [row[2] for row in self.csfra(f"PRAGMA index_info({name})")] == ["hash"]:
+                break
+        else:
+            return
+        self.csfra(SQLITE3_HASHES_TABLE.replace(" hashes ", " new_hashes ", 1))
+        self.csfra(f"""INSERT INTO new_hashes (hashid, hash, algorithm, partial)
+                       SELECT hashid, hash, algorithm, partial FROM {self.hashes}""")
+        self.csfra(f"DROP TABLE {self.hashes}")
+        self.csfra(f"ALTER TABLE new_hashes RENAME TO {self.hashes}")
+        self.csfra(SQLITE3_INDEXES["hashes_idx1"])
+        self.commit()
+
+    def begin_bulk_load(self, initial):
+        """Switch to SQLITE3_BULK_PRAGMAS for the scan, remembering the previous settings.
+        In an initial scan the files indexes in SQLITE3_DEFERRED_INDEXES are dropped, to be built once
+        by end_bulk_load(). If the scan is killed, the next scan rebuilds them (see restore_indexes)."""
+        self.commit()                # journal_mode cannot be changed inside a transaction
+        self.saved_pragmas = {name: self.csfra(f"PRAGMA {name}")[0][0] for name in SQLITE3_BULK_PRAGMAS}
+        for (name, value) in SQLITE3_BULK_PRAGMAS.items():
+            self.csfra(f"PRAGMA {name}={value}")
+        if initial:
+            for name in SQLITE3_DEFERRED_INDEXES:
+                self.csfra(f"DROP INDEX IF EXISTS {name}")
+            self.commit()
+
+    def end_bulk_load(self):
+        t0 = time.time()
+        if self.restore_indexes():
+            print("Built indexes in {:.1f} seconds".format(time.time() - t0))
+        self.commit()
+        for (name, value) in self.saved_pragmas.items():
+            self.csfra(f"PRAGMA {name}={value}")
+
+    def restore_indexes(self):
+        """Create the indexes in SQLITE3_DEFERRED_INDEXES that are missing. Return how many were."""
+        present = set(row[0] for row in self.csfra("SELECT name FROM sqlite_master WHERE type='index'"))
+        missing = [name for name in SQLITE3_DEFERRED_INDEXES if name not in present]
+        for name in missing:
+            self.csfra(SQLITE3_INDEXES[name])
+        self.commit()
+        return len(missing)
+
+    def iter_select(self, cmd, vals=[]):
+        c = self.db.conn.cursor()
+        with self.stats.timer(self.query_name(cmd)):
+            c.execute(cmd.replace("%s", "?"), vals)
+        return iter(c)
 
 
 class MySQLScanDatabase(ScanDatabase):
     """ScanDatabase for MySQL. Can learn connection info from a config.ini file."""
-    def __init__(self, *, auth, prefix="", debug=None):
-        super().__init__(db = dbfile.DBMySQL(auth, debug=debug), auth=auth, prefix=prefix)
+    METADATA_KEY = "name"
+
+    def __init__(self, *, auth, prefix="", debug=None, cache_sizes=None):
+        super().__init__(db = dbfile.DBMySQL(auth, debug=debug), auth=auth, prefix=prefix, cache_sizes=cache_sizes)
     
     @classmethod
-    def FromConfigFile(self, config_file, prefix="", debug=None):
+    def FromConfigFile(self, config_file, prefix="", debug=None, cache_sizes=None):
         config = configparser.ConfigParser()
         config.read(config_file)
         auth   = dbfile.DBMySQLAuth.FromConfig(config[MYSQL_SERVER_SECTION], debug=debug)
         if prefix=="":
             prefix = config[FCHANGE_SECTION][TABLE_PREFIX]
-        fcm    = MySQLScanDatabase(auth=auth, prefix=prefix, debug=debug)
+        fcm    = MySQLScanDatabase(auth=auth, prefix=prefix, debug=debug, cache_sizes=cache_sizes)
         fcm.config = config
         return fcm
     
+    VERSIONS_SCHEMA = MYSQL_VERSIONS_SCHEMA
+    DIRTREE_SCHEMA  = MYSQL_DIRTREE_SCHEMA
+    DIRSCANS_SCHEMA = MYSQL_DIRSCANS_SCHEMA
+
     def create_database(self):
         self.db.create_schema(MYSQL_SCHEMA.format(prefix=self.prefix))
+        self.clear_caches()
+        self.hash_algorithm = None
+        self.layout = None
+        self.upgrade_database()
+
+    def get_columns(self, table):
+        return [row[0] for row in self.csfra("""SELECT column_name FROM information_schema.columns
+                                                 WHERE table_schema=DATABASE() AND table_name=%s""", (table,))]
+
+    def get_indexes(self, table):
+        return [row[0] for row in self.csfra("""SELECT DISTINCT index_name FROM information_schema.statistics
+                                                 WHERE table_schema=DATABASE() AND table_name=%s""", (table,))]
+
+    def tables(self):
+        return [self.metadata, self.roots, self.scans, self.dirnames, self.filenames, self.paths, self.hashes,
+                self.files, self.crcs, self.checkpoints, self.versions, self.dirtree, self.rollups,
+                self.dirscans]
+
+    def database_bytes(self):
+        """InnoDB's estimate of the data and indexes of this database's tables, which ANALYZE TABLE refreshes."""
+        tables = self.tables()
+        return int(self.csfra(f"""SELECT COALESCE(SUM(data_length + index_length), 0) FROM information_schema.tables
+                                  WHERE table_schema=DATABASE() AND table_name IN ({','.join(['%s'] * len(tables))})""",
+                              tables)[0][0])
+
+    def reclaim_space(self, rebuild):
+        """OPTIMIZE TABLE rebuilds each InnoDB table online, and analyzes it. Otherwise only ANALYZE TABLE runs."""
+        self.commit()
+        self.csfra(("OPTIMIZE TABLE " if rebuild else "ANALYZE TABLE ") + ",".join(self.tables()))
+        self.commit()
+
+    def convert_hashes(self):
+        """The hex is converted with UNHEX() in a new column. Duplicate hashes, which the old non-unique
+        prefix index allowed, are merged into the one with the lowest hashid so that the new index can be unique."""
+        if self.csfra("""SELECT data_type FROM information_schema.columns
+                         WHERE table_schema=DATABASE() AND table_name=%s AND column_name='hash'""",
+                      (self.hashes,))[0][0].lower() == "varbinary":
+            return
+        self.add_column(self.hashes, "hash_bin", "VARBINARY(64)")
+        self.csfra(f"""UPDATE {self.hashes}
+                       SET hash_bin=IF(hash COLLATE utf8_bin REGEXP '^([0-9a-f][0-9a-f])+$', UNHEX(hash),
+                                       CAST(hash AS BINARY))""")
+        dups = f"""(SELECT hash_bin, algorithm, partial, MIN(hashid) AS keep FROM {self.hashes}
+                    GROUP BY hash_bin, algorithm, partial HAVING COUNT(*)>1) AS dups"""
+        same = "dups.hash_bin=h.hash_bin AND dups.algorithm=h.algorithm AND dups.partial=h.partial"
+        self.csfra(f"""UPDATE {self.files} JOIN {self.hashes} AS h ON h.hashid={self.files}.hashid
+                              JOIN {dups} ON {same}
+                       SET {self.files}.hashid=dups.keep""")
+        self.csfra(f"""DELETE c FROM {self.crcs} AS c JOIN {self.hashes} AS h ON h.hashid=c.hashid
+                              JOIN {dups} ON {same} AND h.hashid!=dups.keep""")
+        self.csfra(f"""DELETE h FROM {self.hashes} AS h
+                              JOIN {dups} ON {same} AND h.hashid!=dups.keep""")
+        self.csfra(f"ALTER TABLE {self.hashes} DROP INDEX hashes_idx2, DROP COLUMN hash")
+        self.csfra(f"ALTER TABLE {self.hashes} CHANGE hash_bin hash VARBINARY(64) NOT NULL")
+        self.csfra(f"CREATE UNIQUE INDEX hashes_idx2 ON {self.hashes}(hash, algorithm, partial)")
+        self.commit()
+
+    def widen_hash_key(self):
+        if [row[0] for row in self.csfra("""SELECT column_name FROM information_schema.statistics
+                                            WHERE table_schema=DATABASE() AND table_name=%s AND index_name='hashes_idx2'
+                                            ORDER BY seq_in_index""", (self.hashes,))] != ["hash"]:
+            return
+        self.csfra(f"""ALTER TABLE {self.hashes} DROP INDEX hashes_idx2,
+                       ADD UNIQUE INDEX hashes_idx2 (hash, algorithm, partial)""")
+        self.commit()
+
+    def iter_select(self, cmd, vals=[]):
+        """Uses a server-side cursor, so the result set is not buffered in the client."""
+        import pymysql.cursors
+        c = self.db.conn.cursor(pymysql.cursors.SSCursor)
+        with self.stats.timer(self.query_name(cmd)):
+            c.execute(cmd, vals)
+        def rows():
+            try:
+                while True:
+                    batch = c.fetchmany(10000)
+                    if not batch:
+                        return
+                    yield from batch
+            finally:
+                c.close()
+        return rows()
 
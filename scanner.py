@@ -5,27 +5,138 @@ Part of the file system change detector.
 Implements the scanner. Database agnostic.
 """
 
+import calendar
+import contextlib
+import hashlib
+import os
+import queue
+import shutil
+import stat
+import lzma
 import sqlite3
+import sys
+import tarfile
+import tempfile
+import threading
+import time
 import zipfile
+import zlib
+
+import snapshot
 from datetime import datetime
 
-import fchange
 from ctools.dbfile import *
 from ctools.s3 import *
 
 DIR_COMMIT_RATE  =  10  # commit every 10 directories
 FILE_COMMIT_RATE = 100  # commit every 100 files
+BATCH_SIZE       = 1000 # files handed to the database at once; the database commits once per batch
+MAX_INFLIGHT     =    2 # batches prepared, and perhaps hashing, while the walk continues
+CHECKPOINT_SECONDS = 60 # how often a scan records the directories it has completed, so that it can be resumed
+PROGRESS_SECONDS =   10 # how often a scan prints a progress line, if it prints them
+HASH_BUFSIZE     = 65536 # bytes read at a time when hashing
+PARTIAL_HASH_BYTES = 4096 # bytes read from each end of a file for a partial hash
+MAGIC_BYTES      =    4 # bytes at the start of a file that identify it as an archive
+ZIP_MAGIC        = (b'PK\x03\x04', b'PK\x05\x06')  # a zipfile with members, and an empty one
+SEVENZIP_MAGIC   = b'7z\xbc\xaf'
+TAR_SUFFIXES     = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+ARCHIVE_DEPTH    =    1 # levels of archives whose members are scanned: 1 is archives, 2 adds archives inside them...
+ARCHIVE_MAX_SIZE = None # by default, archives are opened whatever their size
+NESTED_ARCHIVE_SPOOL = 64 * 1024 * 1024  # nested archives larger than this are copied to a temporary file to be read
+S3_PREFIX        = "s3://"
+S3_DELIMITER     =  "/" # S3 keys are split into shards at this character
+# Multipart uploads have ETags of the form <md5 of the part md5s>-<number of parts>, which are not the MD5 of
+# the object. They are stored under this algorithm so that they never match real MD5s.
+S3_MULTIPART_ALGORITHM = 's3-multipart'
+S3_SHARD_DEPTH   =    1 # levels of the S3 keyspace that are split into shards
+S3_PAGE_SIZE     = 1000 # objects handed from a listing thread to the database writer at once
+S3_QUEUED_PAGES  =   64 # pages that may wait for the database writer
+
+# Hash algorithms that a database can use, by the name recorded in its metadata and hashes tables.
+# Each value is a function returning a new object with update() and hexdigest().
+# MD5 remains the default so that existing databases, and S3 ETags, keep matching.
+HASH_ALGORITHMS = {
+    'md5':         hashlib.md5,
+    'sha1':        hashlib.sha1,
+    'sha256':      hashlib.sha256,
+    'blake2b-256': lambda: hashlib.blake2b(digest_size=32),
+}
+DEFAULT_HASH_ALGORITHM = 'md5'
+
+# Faster algorithms from optional packages
+try:
+    import blake3
+    HASH_ALGORITHMS['blake3'] = blake3.blake3
+except ImportError:
+    pass
+
+try:
+    import xxhash
+    HASH_ALGORITHMS['xxh3-128'] = xxhash.xxh3_128
+except ImportError:
+    pass
 
-def hash_file(f):
-    """High performance file hasher. Hash a file and return the MD5 hexdigest."""
-    from hashlib import md5
-    m = md5()
+def register_hash_algorithm(name, factory):
+    """Make another hash algorithm available to scans. @param factory - returns a new hash object"""
+    HASH_ALGORITHMS[name] = factory
+
+def hash_file(f, algorithm=DEFAULT_HASH_ALGORITHM, bufsize=HASH_BUFSIZE):
+    """High performance file hasher. Hash a file and return the hexdigest (MD5 unless algorithm is specified)."""
+    m = HASH_ALGORITHMS[algorithm]()
     while True:
-        buf = f.read(65535)
+        buf = f.read(bufsize)
         if not buf:
             return m.hexdigest()
         m.update(buf)
 
+def hash_file_magic(f, algorithm=DEFAULT_HASH_ALGORITHM, bufsize=HASH_BUFSIZE):
+    """Hash a file like hash_file(). Return (hexdigest, magic), where magic is the first MAGIC_BYTES of the file,
+    taken from the buffers that were hashed rather than read separately."""
+    m = HASH_ALGORITHMS[algorithm]()
+    magic = b""
+    while True:
+        buf = f.read(bufsize)
+        if not buf:
+            return (m.hexdigest(), magic)
+        if len(magic) < MAGIC_BYTES:
+            magic += buf[:MAGIC_BYTES - len(magic)]
+        m.update(buf)
+
+def is_zip(path, magic):
+    """Return True if a file at path that starts with magic should be scanned as a zipfile."""
+    return magic in ZIP_MAGIC and not path.lower().endswith(".jar")      # Don't peek inside jar files
+
+def is_tar(path, magic):
+    """Return True if a file at path should be scanned as a tarfile. Tarfiles are recognized by name,
+    since their only magic number is 257 bytes in and compressed ones start with the compressor's."""
+    return path.lower().endswith(TAR_SUFFIXES)
+
+def is_7z(path, magic):
+    return magic == SEVENZIP_MAGIC
+
+def hash_file_partial(f, file_size, algorithm=DEFAULT_HASH_ALGORITHM, nbytes=PARTIAL_HASH_BYTES):
+    """Hash the size and the first and last nbytes of a file.
+    Files with different partial hashes cannot be duplicates. Files with the same one might be."""
+    m = HASH_ALGORITHMS[algorithm]()
+    m.update(b"partial:%d:" % file_size)
+    m.update(f.read(nbytes))
+    if file_size > 2 * nbytes:
+        f.seek(file_size - nbytes)
+    m.update(f.read(nbytes))
+    return m.hexdigest()
+
+def hash_size(file_size, algorithm=DEFAULT_HASH_ALGORITHM):
+    """The partial hash of a file whose size no other file has. It is made without reading the file."""
+    m = HASH_ALGORITHMS[algorithm]()
+    m.update(b"size:%d" % file_size)
+    return m.hexdigest()
+
+@contextlib.contextmanager
+def open_zip_member(path, zi):
+    """Open a member of the zipfile at path, closing the zipfile with it."""
+    with zipfile.ZipFile(path, mode="r") as zf, zf.open(zi, "r") as f:
+        yield f
+
 
 def open_zipfile(path):
     """Check to see if path is a zipfile.
@@ -41,17 +152,354 @@ def open_zipfile(path):
     except IOError:
         return None
 
+def zip_mtime(zi):
+    return int(time.mktime(zi.date_time + (0,0,0)))
+
+def read_zip_members(f, path, algorithm=DEFAULT_HASH_ALGORITHM, bufsize=HASH_BUFSIZE, archive=1, options=None):
+    """Hash every member of the zipfile that is open as f and whose path is path.
+    Members that are archives themselves are read too, while archive > 1 (see archive_format).
+    Return a list of PendingFiles with their hexdigests. Members that cannot be read are skipped."""
+    members = []
+    try:
+        zf = zipfile.ZipFile(f, mode="r")          # f stays open when zf is closed
+    except (zipfile.BadZipfile, zipfile.LargeZipFile):
+        return members
+    with zf:
+        for zi in zf.infolist():
+            mpath = path + "/" + zi.filename
+            try:
+                with zf.open(zi, "r") as mf:
+                    (hexdigest, magic) = hash_file_magic(mf, algorithm, bufsize)
+                fmt = archive_format(mpath, magic, zi.file_size, options) if archive > 1 else None
+                if fmt is not None:
+                    members.extend(read_nested_archive(lambda zi=zi: zf.open(zi, "r"), mpath, fmt,
+                                                       algorithm, bufsize, archive - 1, options))
+            except ARCHIVE_ERRORS:
+                continue                            # encrypted, corrupt, or an unsupported compression method
+            members.append(PendingFile(mpath, zip_mtime(zi), zi.file_size, None, hexdigest, algorithm, 0, 0, zi.CRC))
+    return members
+
+def read_tar_members(f, path, algorithm=DEFAULT_HASH_ALGORITHM, bufsize=HASH_BUFSIZE, archive=1, options=None):
+    """Hash every regular file in the tarfile that is open as f and whose path is path.
+    The tarfile is read once from the start as a stream, so a compressed one is decompressed once.
+    Members that are archives themselves are read too, while archive > 1; they are copied as they are hashed.
+    Return a list of PendingFiles with their hexdigests. Reading stops at the first error."""
+    members = []
+    try:
+        f.seek(0)
+        with tarfile.open(fileobj=f, mode="r|*") as tf:
+            for ti in tf:
+                if not ti.isfile():
+                    continue                        # directories, links and devices
+                mpath = path + "/" + os.path.normpath(ti.name).lstrip("/")
+                mf = tf.extractfile(ti)
+                if archive > 1:
+                    with tempfile.SpooledTemporaryFile(max_size=NESTED_ARCHIVE_SPOOL) as spool:
+                        shutil.copyfileobj(mf, spool, bufsize)
+                        spool.seek(0)
+                        (hexdigest, magic) = hash_file_magic(spool, algorithm, bufsize)
+                        fmt = archive_format(mpath, magic, ti.size, options)
+                        if fmt is not None:
+                            members.extend(ARCHIVE_READERS[fmt].read(spool, mpath, algorithm, bufsize,
+                                                                     archive - 1, options))
+                else:
+                    hexdigest = hash_file(mf, algorithm, bufsize)
+                members.append(PendingFile(mpath, int(ti.mtime), ti.size, None, hexdigest, algorithm, 0))
+    except ARCHIVE_ERRORS:
+        pass                                        # corrupt or truncated; the members before the error are kept
+    return members
+
+def read_nested_archive(opener, path, fmt, algorithm, bufsize, archive, options):
+    """Hash the members of an archive in format fmt that is inside another one. opener opens the inner
+    archive, which is copied so that it can be read with seeks; small ones stay in memory."""
+    with tempfile.SpooledTemporaryFile(max_size=NESTED_ARCHIVE_SPOOL) as spool:
+        with opener() as f:
+            shutil.copyfileobj(f, spool, bufsize)
+        return ARCHIVE_READERS[fmt].read(spool, path, algorithm, bufsize, archive, options)
+
+class ZipSource():
+    """A zipfile on disk whose members are hashed by worker threads. A ZipFile cannot be read by two threads
+    at once, so each thread opens its own the first time it reads a member. All of them are closed when
+    the last member has been written (see Scanner.write_batch)."""
+    def __init__(self, path):
+        self.path = path
+        self.remaining = 0      # members not yet written
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.zipfiles = []
+
+    def open(self, zi):
+        zf = getattr(self.local, 'zf', None)
+        if zf is None:
+            zf = zipfile.ZipFile(self.path, mode="r")
+            with self.lock:
+                self.zipfiles.append(zf)
+            self.local.zf = zf
+        return zf.open(zi, "r")
+
+    def done(self):
+        """Called as each member is written or skipped."""
+        self.remaining -= 1
+        if self.remaining == 0:
+            for zf in self.zipfiles:
+                zf.close()
+            self.zipfiles = []
+
+def archive_members(pf, f, fmt, algorithm, bufsize, options=None):
+    """Return PendingFiles for the members of pf, an archive in format fmt that is open as f.
+    The members of a zipfile on disk are returned unhashed, to be hashed in parallel through a ZipSource;
+    their CRC32s let unchanged members be skipped (see Scanner.prepare_batch).
+    The members of other archives, and of archives inside zipfiles, are hashed here."""
+    if pf.source is not None:
+        return read_nested_archive(pf.opener, pf.path, fmt, algorithm, bufsize, pf.archive, options)
+    if fmt != 'zip':
+        return ARCHIVE_READERS[fmt].read(f, pf.path, algorithm, bufsize, pf.archive, options)
+    try:
+        with zipfile.ZipFile(f, mode="r") as zf:    # f stays open when zf is closed
+            infolist = zf.infolist()
+    except (zipfile.BadZipfile, zipfile.LargeZipFile):
+        return []
+    source = ZipSource(pf.path)
+    source.remaining = len(infolist)
+    return [PendingFile(pf.path + "/" + zi.filename, zip_mtime(zi), zi.file_size, lambda zi=zi: source.open(zi),
+                        None, DEFAULT_HASH_ALGORITHM, 0, pf.archive - 1, zi.CRC, source)
+            for zi in infolist]
+
 from abc import ABC, abstractmethod
+from collections import namedtuple, deque, defaultdict, Counter
+from concurrent.futures import ThreadPoolExecutor, Future
+
+# Archive formats whose members can be scanned, by name. detect(path, magic) tells from a file's path and
+# first MAGIC_BYTES whether it is in the format, and read(f, path, algorithm, bufsize, archive, options)
+# hashes the members of an open file that is, as read_zip_members() does.
+ArchiveReader = namedtuple('ArchiveReader', 'detect read')
+ARCHIVE_READERS = {
+    'zip': ArchiveReader(is_zip, read_zip_members),
+    'tar': ArchiveReader(is_tar, read_tar_members),
+}
+
+# Errors from reading a damaged or unsupported archive, or a member of one
+ARCHIVE_ERRORS = (OSError, EOFError, zipfile.BadZipfile, zipfile.LargeZipFile, tarfile.TarError,
+                  RuntimeError, NotImplementedError, zlib.error, lzma.LZMAError)
+
+# 7z archives, from an optional package
+try:
+    import py7zr
+
+    class SevenZipHasher(py7zr.io.Py7zIO):
+        """Hashes a member of a 7z archive as py7zr decompresses it, rather than keeping it."""
+        def __init__(self, algorithm):
+            self.m = HASH_ALGORITHMS[algorithm]()
+            self.length = 0
+
+        def write(self, s):
+            self.m.update(s)
+            self.length += len(s)
+            return len(s)
+
+        def read(self, size=None):
+            return b""
+
+        def seek(self, offset, whence=0):
+            return 0
+
+        def flush(self):
+            pass
+
+        def size(self):
+            return self.length
+
+    class SevenZipHashers(py7zr.io.WriterFactory):
+        def __init__(self, algorithm):
+            self.algorithm = algorithm
+            self.hashers = {}   # member name -> SevenZipHasher
+
+        def create(self, filename):
+            self.hashers[filename] = SevenZipHasher(self.algorithm)
+            return self.hashers[filename]
+
+    def read_7z_members(f, path, algorithm=DEFAULT_HASH_ALGORITHM, bufsize=HASH_BUFSIZE, archive=1, options=None):
+        """Hash every file in the 7z archive that is open as f and whose path is path.
+        py7zr decompresses each solid block once, in order. Archives inside 7z archives are not opened."""
+        try:
+            f.seek(0)
+            with py7zr.SevenZipFile(f, mode="r") as sz:
+                infos = [fi for fi in sz.list() if not fi.is_directory]
+                hashers = SevenZipHashers(algorithm)
+                sz.extractall(factory=hashers)
+        except ARCHIVE_ERRORS:
+            return []
+        return [PendingFile(path + "/" + fi.filename, int(fi.creationtime.timestamp()) if fi.creationtime else 0,
+                            fi.uncompressed, None, hashers.hashers[fi.filename].m.hexdigest(), algorithm, 0)
+                for fi in infos if fi.filename in hashers.hashers]
+
+    ARCHIVE_READERS['7z'] = ArchiveReader(is_7z, read_7z_members)
+    ARCHIVE_ERRORS += (py7zr.exceptions.ArchiveError, py7zr.exceptions.PasswordRequired)
+except ImportError:
+    pass
+
+def register_archive_reader(name, detect, read):
+    """Make another archive format available to scans. See ARCHIVE_READERS."""
+    ARCHIVE_READERS[name] = ArchiveReader(detect, read)
+
+# Which archives a scan opens: the names of the formats in ARCHIVE_READERS to open, and the size in bytes
+# above which archives are scanned as ordinary files, or None to open them whatever their size.
+ArchiveOptions = namedtuple('ArchiveOptions', 'formats max_size')
+DEFAULT_ARCHIVE_OPTIONS = ArchiveOptions(tuple(ARCHIVE_READERS), ARCHIVE_MAX_SIZE)
+
+def archive_format(path, magic, file_size, options=None):
+    """Return the name of the format that a file at path that starts with magic is in, if it is an archive
+    that options (by default DEFAULT_ARCHIVE_OPTIONS) say to open. Otherwise return None."""
+    options = options or DEFAULT_ARCHIVE_OPTIONS
+    if options.max_size is not None and file_size > options.max_size:
+        return None
+    for name in options.formats:
+        if ARCHIVE_READERS[name].detect(path, magic):
+            return name
+    return None
+
+# A file waiting to be written to the database.
+# opener is a function that returns an open file, or None if hexdigest is already known.
+# algorithm is the algorithm of hexdigest, when it is known, and partial is 1 if hexdigest is a partial hash.
+# archive is the number of levels of archives that may be opened, starting with this file. If it is not 0,
+# the file is checked for being an archive, whose members are then scanned too.
+# crc is the CRC32 of a zipfile member, and source is the ZipSource its opener reads from.
+PendingFile = namedtuple('PendingFile', 'path mtime file_size opener hexdigest algorithm partial archive crc source',
+                         defaults=(0, None, None))
+
+# A batch whose paths have been resolved and whose hashes are being computed.
+# known maps an index in files to the hashid of a file that is already in the database.
+# digests maps an index in files to an (algorithm, partial, hexdigest, members) tuple, or to a Future that
+# returns one (or None if the file could not be read). members are the PendingFiles inside an archive.
+# archives lists (PendingFile, pathid, known_archive) for unchanged files that are archives,
+# or that may be if not known_archive.
+PreparedBatch = namedtuple('PreparedBatch', 'rows files pathids known digests archives')
+
+def hash_pending(pf, algorithm, bufsize, options=None, stats=None):
+    """Open and hash a PendingFile. Return (algorithm, 0, hexdigest, members), or None if it cannot be read.
+    If the file may be an archive, its first bytes are checked while it is hashed, and its members are
+    read through the same open file (see archive_members), timed as "archive members" in stats if given.
+    Runs on worker threads."""
+    timer = stats.timer if stats is not None else lambda name: contextlib.nullcontext()
+    try:
+        with pf.opener() as f:
+            if not pf.archive:
+                return (algorithm, 0, hash_file(f, algorithm, bufsize), ())
+            (hexdigest, magic) = hash_file_magic(f, algorithm, bufsize)
+            fmt = archive_format(pf.path, magic, pf.file_size, options)
+            if fmt is None:
+                return (algorithm, 0, hexdigest, ())
+            if pf.source is None:
+                with timer("archive members"):
+                    return (algorithm, 0, hexdigest, archive_members(pf, f, fmt, algorithm, bufsize, options))
+        # An archive inside a zipfile is read again once this stream is closed
+        with timer("archive members"):
+            return (algorithm, 0, hexdigest, archive_members(pf, None, fmt, algorithm, bufsize, options))
+    except ARCHIVE_ERRORS:
+        return None             # includes PermissionError, and members that cannot be read; the file is skipped
+
+def hash_pending_partial(pf, algorithm):
+    """Open and partially hash a PendingFile. Return the hexdigest, or None if it cannot be read."""
+    try:
+        with pf.opener() as f:
+            return hash_file_partial(f, pf.file_size, algorithm)
+    except OSError as e:
+        return None
+
+class ScanStats():
+    """Counters and cumulative timers for a scan, shared by its ScanDatabase and Scanners.
+    counts holds numbers of events and bytes by name, and seconds the time spent in each timed section.
+    Worker threads add to them too, so the seconds of a section can add up to more than the scan took.
+    The database counts and times its queries by table, as "query <table>", and its commits as "commit".
+    With progress set, the scanners print a line to out every progress seconds (see progress())."""
+    def __init__(self, progress=0, out=None):
+        self.t0 = time.time()
+        self.counts  = Counter()
+        self.seconds = Counter()
+        self.lock = threading.Lock()
+        self.progress_seconds = progress
+        self.last_progress = self.t0
+        self.out = out
+
+    def add(self, name, n=1, seconds=None):
+        """Count n of name, and if seconds is given add them to its time"""
+        with self.lock:
+            self.counts[name] += n
+            if seconds is not None:
+                self.seconds[name] += seconds
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """Count and time the body of a with statement as name"""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, seconds=time.perf_counter() - t0)
+
+    def progress(self, scanner):
+        """Print a line about scanner's progress if progress seconds have passed since the last one."""
+        now = time.time()
+        if not self.progress_seconds or now - self.last_progress < self.progress_seconds:
+            return
+        self.last_progress = now
+        elapsed = now - self.t0
+        print("{:,.0f}s: {:,} files in {:,} directories, {:,} unchanged, {:,} hashed ({:,.1f} MiB); "
+              "{:,.0f} files/s, {:,.1f} MiB/s hashed".format(
+                  elapsed, scanner.filecount, scanner.dircount, scanner.carried, self.counts['hash'],
+                  self.counts['hash bytes'] / 1024 / 1024, scanner.filecount / elapsed,
+                  self.counts['hash bytes'] / 1024 / 1024 / elapsed),
+              file=self.out or sys.stderr, flush=True)
+
+    def report(self, **extra):
+        """Return the counters and timers, with each of the extra items, as a dict that can be written as JSON."""
+        with self.lock:
+            sections = {name: {"count": self.counts[name], "seconds": round(self.seconds[name], 6)}
+                        for name in sorted(self.seconds)}
+            counts = {name: self.counts[name] for name in sorted(self.counts) if name not in self.seconds}
+        return dict(extra, elapsed=round(time.time() - self.t0, 3), counts=counts, sections=sections)
+
+
 class Scanner(ABC):
     """Abstract Base Class to scan a directory and store the results in the database specified by the provided scandb class.."""
-    def __init__(self, sdm, *, debug=False ):
+    def __init__(self, sdm, *, debug=False, batch_size=BATCH_SIZE, jobs=1, bufsize=HASH_BUFSIZE, dedup=False,
+                 archive_depth=ARCHIVE_DEPTH, archive_formats=None, archive_max_size=ARCHIVE_MAX_SIZE):
+        """@param jobs - number of threads that hash files, including the members of zipfiles. Whatever the value,
+                         only the calling thread uses the database, and the database ends up with the same rows.
+        @param bufsize - bytes read at a time when hashing.
+        @param dedup - only hash files fully if they might be duplicates. See hash_by_size().
+        @param archive_depth - levels of archives whose members are scanned. 0 does not look inside archives.
+        @param archive_formats - names of the formats in ARCHIVE_READERS to open. By default, all of them.
+        @param archive_max_size - archives larger than this many bytes are scanned as ordinary files.
+        Files are hashed with the algorithm recorded in the database."""
         self.sdm   = sdm        # scan database manager (a subclass of ScanDatabase(ABC))
+        self.stats = sdm.stats  # the scan's ScanStats
         self.debug = debug
+        self.algorithm = sdm.get_hash_algorithm()
+        self.bufsize = bufsize
+        self.batch_size = batch_size
+        self.archive_depth = archive_depth
+        self.archive_options = ArchiveOptions(tuple(archive_formats or ARCHIVE_READERS), archive_max_size)
+        for name in self.archive_options.formats:
+            if name not in ARCHIVE_READERS:
+                raise ValueError(f"Unknown archive format {name}. Formats are: {', '.join(ARCHIVE_READERS)}")
+        self.pending = []       # PendingFile objects not yet in the database
+        self.inflight = deque() # PreparedBatch objects waiting for their hashes, oldest first
+        self.max_inflight = MAX_INFLIGHT
+        self.pool = ThreadPoolExecutor(max_workers=jobs) if jobs > 1 else None
+        self.sized = defaultdict(list) if dedup else None  # file_size -> PendingFiles, in a dedup scan
+        self.carried = 0        # files found unchanged in sdm.snapshot, or in a directory that was not listed
+        self.skipped = 0        # directories found unchanged, whose files were carried forward without listing them
         self.filecount = 0
         self.dircount = 0
+        self.syscalls = Counter()   # file system calls made by the scan, by kind. read is estimated from sizes.
+        self.prev_scanid = None     # the scan that unchanged zipfiles copy their members from; see scan_archive()
+        self.completed = []         # (dirname, subtree) done since the last checkpoint; see checkpoint()
+        self.signatures = []        # (dirname, mtime, inode, entries) of directories done since then, in a fast rescan
+        self.last_checkpoint = time.time()
 
     def get_file_hashid(self, *, f=None, pathname=None, file_size, pathid=None, mtime, hexdigest=None):
-        """Given an open file or a filename, Return the MD5 hexdigest."""
+        """Given an open file or a filename, Return the hashid of its contents."""
         if pathid is None:
             if pathname is None:
                 raise RuntimeError("pathid and pathname are both None")
@@ -66,33 +514,288 @@ class Scanner(ABC):
             return hashid
 
         # Hashid is not in the database. Hash the file if we don't have the hash
-        if hexdigest is None:
-            if f is None:
-                f = open(pathname,'rb')
-
-            from hashlib import md5
-            m = md5()
-            while True:
-                buf = f.read(65535)
-                if not buf:
-                    break
-                m.update(buf)
-            hexdigest = m.hexdigest()
+        if hexdigest is not None:
+            return self.sdm.get_hashid_for_hexdigest( hexdigest, DEFAULT_HASH_ALGORITHM )
+        if f is None:
+            f = open(pathname,'rb')
         # Put the hash into the database and return it
-        return self.sdm.get_hashid_for_hexdigest( hexdigest )
+        return self.sdm.get_hashid_for_hexdigest( hash_file(f, self.algorithm, self.bufsize), self.algorithm )
         
 
-    def insert_file(self, *, path, mtime, file_size, handle=None, hexdigest=None):
-        """@mtime in time_t"""
-        pathid = self.sdm.get_pathid(path)
+    def insert_file(self, *, path, mtime, file_size, handle=None, opener=None, hexdigest=None,
+                    algorithm=DEFAULT_HASH_ALGORITHM, archive=0):
+        """Queue a file for the database. It is written when the batch fills or when flush() is called.
+        @mtime in time_t. Stored as an integer, which is what the files table holds.
+        @handle - an open file to hash if needed. Prefer opener, which does not hold a descriptor while queued.
+        @opener - a function that opens the file to hash if needed.
+        @hexdigest - the hash of the file, if it is already known (e.g. an S3 ETag), computed with algorithm.
+        @archive - levels of zipfiles to look inside, starting with this file. See PendingFile.
+        """
+        if handle is not None:
+            opener = lambda: handle
+        pf = PendingFile(path, int(mtime), file_size, opener, hexdigest, algorithm, 0, archive)
+        if self.sized is not None and hexdigest is None:
+            self.sized[file_size].append(pf)
+        else:
+            self.queue(pf)
+
+    def queue(self, pf):
+        self.pending.append(pf)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Send the queued files on their way to the database.
+        Paths and previously-seen (pathid, mtime, size) hashes are resolved for the whole batch at once,
+        so only files that are new or have changed are opened and hashed.
+        The batch is written by a later flush() once more than max_inflight batches are waiting, so that a worker
+        pool can hash it while the walk keeps going. This bounds memory and open files. Without a pool the batch is
+        hashed here, but it waits just the same: the members of its archives are queued when it is written, and
+        must land among the same walk files whatever the number of jobs, so that the database gets the same ids."""
+        batch, self.pending = self.pending, []
+        if batch:
+            with self.stats.timer("prepare batch"):
+                self.inflight.append(self.prepare_batch(batch))
+        while len(self.inflight) > self.max_inflight:
+            with self.stats.timer("write batch"):
+                self.write_batch(self.inflight.popleft())
+        self.stats.progress(self)
+
+    def drain(self):
+        """Write everything that is queued or being hashed, including the zipfile members found on the way."""
+        while self.pending or self.inflight:
+            self.flush()
+            while self.inflight:
+                with self.stats.timer("write batch"):
+                    self.write_batch(self.inflight.popleft())
+
+    def finish(self):
+        """Write everything and stop the worker threads. Called once the walk is complete."""
+        if self.sized is not None:
+            self.hash_by_size()
+        self.drain()
+        if self.signatures:
+            self.sdm.add_dirscans(self.signatures)
+            self.signatures = []
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def checkpoint(self, dirname, subtree):
+        """Note that every file in dirname has been queued, and if subtree is True every file below it.
+        Every CHECKPOINT_SECONDS the queue is drained, including the members of archives, and the directories
+        noted since the last time are recorded in the database, so that an interrupted scan can be resumed
+        without scanning them again. A dedup scan writes nothing until its walk is over, so it has no checkpoints."""
+        if self.sized is not None:
+            return
+        if subtree:
+            # The directories below dirname were completed just before it, so one row replaces theirs
+            while self.completed and (self.completed[-1][0] == dirname or
+                                      self.completed[-1][0].startswith(dirname.rstrip(os.sep) + os.sep)):
+                self.completed.pop()
+        self.completed.append((dirname, subtree))
+        if time.time() - self.last_checkpoint >= CHECKPOINT_SECONDS:
+            self.drain()
+            self.sdm.add_dirscans(self.signatures)
+            self.signatures = []
+            self.sdm.add_checkpoints(self.completed)
+            self.completed = []
+            self.last_checkpoint = time.time()
+
+    def map(self, func, *iterables):
+        """map() on the worker pool, if there is one."""
+        if self.pool is not None:
+            return list(self.pool.map(func, *iterables))
+        return list(map(func, *iterables))
+
+    def hash_by_size(self):
+        """Second pass of a dedup scan. The walk recorded each file's size without reading it.
+        Only files whose size collides with another file's are read at all. Their first and last
+        PARTIAL_HASH_BYTES are hashed, and only files whose partial hashes also collide are hashed fully.
+        Every other file is stored with a partial hash (hashes.partial=1), which is enough to show that
+        it has no duplicate. The sizes of every file are held in memory until the walk is complete."""
+        sized, self.sized = self.sized, None
+        for file_size in sorted(sized):
+            pfs = sized.pop(file_size)
+            if len(pfs) == 1:
+                self.queue(pfs[0]._replace(hexdigest=hash_size(file_size, self.algorithm),
+                                           algorithm=self.algorithm, partial=1))
+                continue
+            if file_size <= 2 * PARTIAL_HASH_BYTES:
+                # A partial hash would read the whole file anyway
+                suspects = pfs
+            else:
+                self.syscalls['open'] += len(pfs)
+                self.syscalls['read'] += 2 * len(pfs)
+                by_partial = defaultdict(list)
+                with self.stats.timer("partial hash"):
+                    partials = self.map(hash_pending_partial, pfs, [self.algorithm] * len(pfs))
+                for (pf, hexdigest) in zip(pfs, partials):
+                    if hexdigest is not None:
+                        by_partial[hexdigest].append(pf)
+                suspects = []
+                for (hexdigest, group) in by_partial.items():
+                    if len(group) > 1:
+                        suspects.extend(group)
+                    else:
+                        self.queue(group[0]._replace(hexdigest=hexdigest, algorithm=self.algorithm, partial=1))
+            for pf in suspects:
+                self.count_hash(pf)
+            for (pf, digest) in zip(suspects, self.map(self.hash_timed, suspects)):
+                if digest is not None:
+                    self.queue(pf._replace(hexdigest=digest[2], algorithm=self.algorithm))
+
+    def count_hash(self, pf):
+        """Count the calls that hashing pf makes: an open, and reads until one returns nothing."""
+        self.syscalls['open'] += 1
+        self.syscalls['read'] += pf.file_size // self.bufsize + 1
+        self.stats.add('hash bytes', pf.file_size)
+
+    def hash_timed(self, pf):
+        """hash_pending() with the scan's settings, timed as "hash". Runs on worker threads."""
+        with self.stats.timer("hash"):
+            return hash_pending(pf, self.algorithm, self.bufsize, self.archive_options, self.stats)
+
+    def prepare_batch(self, batch):
+        """Resolve the batch against the database and start hashing the files that need it."""
+
+        # Files that are unchanged since the preloaded previous scan are copied forward as they are.
+        # Files that arrive with their hash already known are stored with that hash.
+        # The members of a zipfile that changed are compared by CRC32 instead of by mtime.
+        rows = []
+        archives = []
+        if self.sdm.snapshot is not None:
+            changed = []
+            for pf in batch:
+                prior = self.sdm.snapshot.get(pf.path) if pf.hexdigest is None and pf.crc is None else None
+                if prior is not None and prior[1:3] == (pf.mtime, pf.file_size):
+                    rows.append(prior)
+                    if pf.archive and pf.path in self.sdm.snapshot.archives:
+                        archives.append((pf, prior[0], True))
+                else:
+                    changed.append(pf)
+            self.carried += len(rows)
+            batch = changed
+
+        pathids = self.sdm.get_pathids([pf.path for pf in batch])
+        by_pms  = self.sdm.get_hashids_for_pmss([(pathids[pf.path], pf.mtime, pf.file_size)
+                                                 for pf in batch if pf.crc is None], self.algorithm)
+        by_crc  = self.sdm.get_hashids_for_crcs([(pathids[pf.path], pf.crc, pf.file_size)
+                                                 for pf in batch if pf.crc is not None and pf.hexdigest is None],
+                                                self.algorithm)
+
+        known   = {}            # index in batch -> hashid of files that are already in the database
+        unopened = []           # (pf, pathid) of files already in the database that may be archives
+        digests = {}            # index in batch -> digest (or Future) of files that were not in the database
+        for (i, pf) in enumerate(batch):
+            if pf.hexdigest is not None:
+                digests[i] = (pf.algorithm, pf.partial, pf.hexdigest, ())
+                continue
+            if pf.crc is None:
+                hashid = by_pms.get((pathids[pf.path], pf.mtime, pf.file_size))
+            else:
+                hashid = by_crc.get((pathids[pf.path], pf.crc, pf.file_size))
+            if hashid is not None:
+                known[i] = hashid
+                if pf.archive:
+                    unopened.append((pf, pathids[pf.path]))
+                continue
+            self.count_hash(pf)
+            if self.pool is not None:
+                digests[i] = self.pool.submit(self.hash_timed, pf)
+            else:
+                digests[i] = self.hash_timed(pf)
+        archives.extend(self.classify_archives(unopened))
+        return PreparedBatch(rows, batch, pathids, known, digests, archives)
+
+    def classify_archives(self, unopened):
+        """Return (pf, pathid, known_archive) for each (pf, pathid) of a file already in the database that scan_archive
+        must look at, as snapshot.archives does for a preloaded scan. If the previous scan opened every archive
+        that this one would (see ScanDatabase.archives_known), a file that was in it unchanged is an archive if it
+        has members below it there, and otherwise is not opened at all. The others, which are back or were last
+        seen in an older scan, are opened to read their first bytes (see peek_archive)."""
+        if not unopened:
+            return []
+        if self.prev_scanid is None:
+            self.prev_scanid = self.sdm.previous_scan(self.sdm.scanid)
+        if self.prev_scanid is None or not self.sdm.archives_known:
+            return [(pf, pathid, False) for (pf, pathid) in unopened]
+        (members, unchanged) = self.sdm.previous_archives(
+            self.prev_scanid, [(pf.path, pathid, pf.mtime, pf.file_size) for (pf, pathid) in unopened])
+        return [(pf, pathid, pf.path in members) for (pf, pathid) in unopened
+                if pf.path in members or pf.path not in unchanged]
+
+    def write_batch(self, prepared):
+        """Wait for the batch's hashes and write it to the database.
+        The members of zipfiles are queued, to be written with a later batch, and the CRC32s of
+        the members that were hashed are recorded so that the next scan need not hash them again."""
+        (rows, batch, pathids, known, digests, archives) = prepared
+        hexdigests = {}
+        for (i, digest) in digests.items():
+            if isinstance(digest, Future):
+                with self.stats.timer("hash wait"):
+                    digest = digest.result()
+            if digest is not None:
+                hexdigests[i] = digest[:3]
+                self.pending.extend(digest[3])
+
+        hashids = {}
+        for (algorithm, partial) in sorted(set((a, p) for (a, p, h) in hexdigests.values())):
+            for (hexdigest, hashid) in self.sdm.get_hashids_for_hexdigests(
+                    [h for (a, p, h) in hexdigests.values() if (a, p) == (algorithm, partial)], algorithm, partial).items():
+                hashids[(algorithm, partial, hexdigest)] = hashid
+        crcs = []
+        for (i, pf) in enumerate(batch):
+            pms = (pathids[pf.path], pf.mtime, pf.file_size)
+            if i in hexdigests:
+                rows.append(pms + (hashids[hexdigests[i]],))
+                if pf.crc is not None:
+                    crcs.append((hashids[hexdigests[i]], pf.crc))
+            elif i in known:
+                rows.append(pms + (known[i],))
+        self.sdm.add_crcs(crcs)
+        self.sdm.add_pmshs(rows)
+        for (pf, pathid, known_archive) in archives:
+            with self.stats.timer("scan archive"):
+                self.scan_archive(pf, pathid, known_archive)
+        for pf in batch:
+            if pf.source is not None:
+                pf.source.done()
+
+    def peek_archive(self, pf):
+        """Return the format of pf, from its first bytes, if it is an archive to open. Otherwise return None."""
+        self.syscalls['open'] += 1
+        self.syscalls['read'] += 1
         try:
-            hashid = self.get_file_hashid(pathid=pathid,mtime=mtime,file_size=file_size,f=handle, hexdigest=hexdigest)
-        except PermissionError as e:
+            with pf.opener() as f:
+                return archive_format(pf.path, f.read(MAGIC_BYTES), pf.file_size, self.archive_options)
+        except ARCHIVE_ERRORS:
+            return None
+
+    def scan_archive(self, pf, pathid, known_archive):
+        """Record the members of pf, an unchanged file that is an archive if known_archive is True and may be one
+        otherwise. If the file was in the previous scan with the same mtime and size, its members are copied from
+        that scan in the database. Otherwise the archive is read and its members are queued (see archive_members).
+        The members of an archive that may hold more archives to open are always queued, since the previous scan
+        may not have gone as deep; zipfile members are matched by CRC32, so only the zipfile's directory is read."""
+        if not known_archive and self.peek_archive(pf) is None:
             return
-        except OSError as e:
+        if self.prev_scanid is None:
+            self.prev_scanid = self.sdm.previous_scan(self.sdm.scanid)
+        # Nothing is copied from a scan that did not open this archive, or if it is empty; it is read then
+        if (pf.archive == 1 and self.prev_scanid is not None and
+            self.sdm.copy_archive_members(pf.path, pathid, pf.mtime, pf.file_size, self.prev_scanid)):
             return
-
-        self.sdm.add_pmsh(pathid, mtime, file_size, hashid)
+        self.count_hash(pf)
+        try:
+            with pf.opener() as f:
+                fmt = archive_format(pf.path, f.read(MAGIC_BYTES), pf.file_size, self.archive_options)
+                if fmt is not None and pf.source is None:
+                    self.pending.extend(archive_members(pf, f, fmt, self.algorithm, self.bufsize, self.archive_options))
+            if fmt is not None and pf.source is not None:
+                self.pending.extend(archive_members(pf, None, fmt, self.algorithm, self.bufsize, self.archive_options))
+        except ARCHIVE_ERRORS:
+            pass
 
     def process_filepath(self, path):
         """ Add the file to the database database.
@@ -102,14 +805,44 @@ class Scanner(ABC):
             st = os.stat(path)
         except FileNotFoundError as e:
             return
-        self.insert_file(path=path, mtime=st.st_mtime, file_size=st.st_size, handle=open(path,"rb"))
+        self.insert_file(path=path, mtime=st.st_mtime, file_size=st.st_size, opener=lambda: open(path,"rb"))
 
     def process_zipfile(self, path, zf):
-        """Scan a zip file and insert it into the database"""
-        for zi in zf.infolist():
-            mtime = time.mktime(zi.date_time + (0,0,0))
-            self.insert_file(path=path+"/"+zi.filename, mtime=mtime,
-                             file_size=zi.file_size, handle=zf.open(zi.filename,"r"))
+        """Scan a zip file and insert it into the database.
+        The batch is drained at the end so that the zipfile can be closed."""
+        with zf:
+            for zi in zf.infolist():
+                mtime = time.mktime(zi.date_time + (0,0,0))
+                if self.sized is not None:
+                    # In a dedup scan members are hashed after the walk, when this zipfile is closed
+                    opener = lambda zi=zi: open_zip_member(path, zi)
+                else:
+                    opener = lambda zi=zi: zf.open(zi,"r")
+                self.insert_file(path=path+"/"+zi.filename, mtime=mtime, file_size=zi.file_size, opener=opener)
+            self.drain()
+
+    def process_archive(self, path, file_size):
+        """In a dedup scan, scan the members of the file at path if it is an archive.
+        The members of a zipfile are sized like other files (see process_zipfile). Other archives can only
+        be read from the start, so their members are hashed now."""
+        if not self.archive_depth:
+            return
+        pf = PendingFile(path, 0, file_size, lambda: open(path, "rb"), None, self.algorithm, 0, self.archive_depth)
+        fmt = self.peek_archive(pf)
+        if fmt == 'zip':
+            zf = open_zipfile(path)
+            if zf:
+                self.process_zipfile(path, zf)
+        elif fmt is not None:
+            self.count_hash(pf)
+            try:
+                with pf.opener() as f:
+                    members = ARCHIVE_READERS[fmt].read(f, path, self.algorithm, self.bufsize,
+                                                        self.archive_depth, self.archive_options)
+            except ARCHIVE_ERRORS:
+                return
+            for member in members:
+                self.queue(member)
 
     @abstractmethod
     def ingest_walk(self, start_path):
@@ -117,45 +850,312 @@ class Scanner(ABC):
         
 class FileScanner(Scanner):
     """Scanner for native file system.that Extends the Scanner class and implements MySQL db storage"""
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, fast_rescan=False, trusted=False, **kwargs):
+        """@param fast_rescan - if True, record the signature of each directory: its mtime and inode before it is
+                                listed, and the number of files and subdirectories recorded in it. A directory
+                                whose mtime and inode are the same as in the previous scan is not listed (see
+                                carry_directory).
+        @param trusted - if True, the files in such a directory are carried forward without being looked at.
+                         A file written in place does not change its directory's mtime, so only roots whose files
+                         are added, removed or replaced, never modified, should be trusted."""
         super().__init__(*args,**kwargs)
+        self.fast_rescan = fast_rescan
+        self.trusted = trusted
+        self.prior = {}             # dirname -> (mtime, inode, entries) in the previous scan, in a fast rescan
+        self.prior_subdirs = {}     # dirname -> its subdirectories in the previous scan
+
+    def scan_file(self, path, st):
+        """Queue the regular file at path, whose stat is st."""
+        if self.sized is not None:
+            # A dedup scan does not read most files, so archives are found by opening each one
+            self.insert_file(path=path, mtime=st.st_mtime, file_size=st.st_size,
+                             opener=lambda: open(path,"rb"))
+            with self.stats.timer("scan archive"):
+                self.process_archive(path, st.st_size)
+        else:
+            self.insert_file(path=path, mtime=st.st_mtime, file_size=st.st_size,
+                             opener=lambda: open(path,"rb"), archive=self.archive_depth)
+        self.filecount += 1
+
+    def load_prior(self, start_path):
+        """Load the directory signatures under start_path from the previous scan, for a fast rescan."""
+        if self.prev_scanid is None:
+            self.prev_scanid = self.sdm.previous_scan(self.sdm.scanid)
+        if self.prev_scanid is None:
+            return
+        self.prior = self.sdm.load_dirscans(self.prev_scanid, start_path)
+        for dirname in sorted(self.prior):
+            parent = os.path.dirname(dirname)
+            if parent != dirname and parent in self.prior:
+                self.prior_subdirs.setdefault(parent, []).append(dirname)
+
+    def carry_directory(self, dirpath, st):
+        """If the directory dirpath, whose stat is st, has the mtime and inode that it had in the previous scan,
+        record its files without listing it and return its subdirectories in the previous scan. Otherwise,
+        or if the previous scan did not record as many files and subdirectories in it as it counted, return None.
+        In a trusted root the files' rows, and those of the members of archives, are copied from the previous scan.
+        Otherwise each file is stat()ed by name, and only those with the same mtime and size are copied; the others
+        are queued like any file, and those that are gone are dropped. A file hashed with another algorithm, or
+        only partially, is always stat()ed and queued. Archives' members are copied as the previous scan found them."""
+        prior = self.prior.get(dirpath)
+        if prior is None or prior[:2] != (st.st_mtime_ns, st.st_ino):
+            return None
+        subdirs = self.prior_subdirs.get(dirpath, [])
+        with self.stats.timer("carry directory"):
+            files = self.sdm.directory_files(self.prev_scanid, dirpath)
+        if len(files) + len(subdirs) != prior[2]:
+            return None
+        rows = []
+        for (filename, (pathid, mtime, size, hashid, carryable, members)) in files.items():
+            if not self.trusted or not carryable:
+                path = os.path.join(dirpath, filename)
+                self.syscalls['stat'] += 1
+                try:
+                    fst = os.stat(path)
+                except OSError:
+                    continue
+                if not stat.S_ISREG(fst.st_mode):
+                    continue
+                if not carryable or (int(fst.st_mtime), fst.st_size) != (mtime, size):
+                    self.scan_file(path, fst)
+                    continue
+            rows.append((pathid, mtime, size, hashid))
+            if self.archive_depth:
+                rows.extend(members)
+            self.carried += 1
+            self.filecount += 1
+        self.sdm.add_pmshs(rows)
+        self.skipped += 1
+        return subdirs
 
     def ingest_walk(self, start_path):
-        """Walk the local file system and go inside ZIP files"""
-        for (dirpath, dirnames, filenames) in os.walk(start_path):
-            for filename in filenames:
-                #
-                # Get full path and process
-                filename_path = os.path.join(dirpath, filename)
-                self.process_filepath(filename_path)
-
-                # See if this is a zipfile. If so, process it
-                zf = open_zipfile(filename_path)
-                if zf:
-                    self.process_zipfile(filename_path, zf)
-                self.filecount += 1
-            self.dircount  += 1
+        """Walk the local file system and go inside archives.
+        Directories are listed with os.scandir() in the order os.walk() would visit them, and each file is
+        stat()ed once through its DirEntry. A file is only opened if it has to be hashed, and archives are
+        recognized from the first bytes that are hashed (see hash_pending and scan_archive).
+        Only regular files are scanned; symbolic links to directories are not followed.
+        Each directory is checkpointed once its files are queued, and again once its subdirectories are done.
+        When a scan is resumed, the directories that it checkpointed are skipped (see ScanDatabase.resume_scan).
+        In a fast rescan, each directory is stat()ed first, and unchanged directories are not listed (see carry_directory)."""
+        resumed = self.sdm.resumed or {}
+        if self.fast_rescan:
+            self.load_prior(start_path)
+        stack = [(start_path, False)]
+        while stack:
+            (dirpath, leaving) = stack.pop()
+            if leaving:
+                self.checkpoint(dirpath, True)
+                continue
+            if resumed.get(dirpath):
+                continue
+            dirstat = None
+            if self.fast_rescan and dirpath not in resumed:
+                self.syscalls['stat'] += 1
+                try:
+                    dirstat = os.stat(dirpath)
+                except OSError:
+                    continue
+                before = self.filecount
+                subdirs = self.carry_directory(dirpath, dirstat)
+                if subdirs is not None:
+                    self.signatures.append((dirpath, dirstat.st_mtime_ns, dirstat.st_ino,
+                                            self.filecount - before + len(subdirs)))
+                    self.checkpoint(dirpath, False)
+                    stack.append((dirpath, True))
+                    stack.extend((subdir, False) for subdir in reversed(subdirs))
+                    continue
+            self.syscalls['scandir'] += 1
+            try:
+                with self.stats.timer("scandir"), os.scandir(dirpath) as it:
+                    entries = list(it)
+            except OSError:
+                continue                # os.walk() skips directories that cannot be listed
+            self.dircount += 1
+            before = self.filecount
+            subdirs = []
+            stats = 0
+            stat_seconds = 0.0      # timed here and added once per directory, to keep the loop cheap
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            subdirs.append(entry.path)
+                        continue
+                    if not entry.is_file() or dirpath in resumed:
+                        continue        # a broken link, a fifo or a device, or already in the resumed scan
+                    self.syscalls['stat'] += 1
+                    stats += 1
+                    t0 = time.perf_counter()
+                    st = entry.stat()
+                    stat_seconds += time.perf_counter() - t0
+                except OSError:
+                    continue
+                self.scan_file(entry.path, st)
+            self.stats.add("stat", stats, stat_seconds)
+            if dirstat is not None:
+                self.signatures.append((dirpath, dirstat.st_mtime_ns, dirstat.st_ino,
+                                        self.filecount - before + len(subdirs)))
+            self.checkpoint(dirpath, False)
+            stack.append((dirpath, True))
+            stack.extend((subdir, False) for subdir in reversed(subdirs))
+
+def boto3_list_objects(bucket, prefix, delimiter=None):
+    """List the objects in bucket whose keys start with prefix, a page at a time, with boto3.
+    With a delimiter, the keys that contain it after prefix are returned as {'Prefix': common_prefix}
+    dicts instead, as S3 returns them. This is the interface that S3Scanner expects of list_objects."""
+    import boto3
+    kwargs = {'Bucket': bucket, 'Prefix': prefix}
+    if delimiter is not None:
+        kwargs['Delimiter'] = delimiter
+    for page in boto3.client('s3').get_paginator('list_objects_v2').paginate(**kwargs):
+        yield from page.get('CommonPrefixes', [])
+        yield from page.get('Contents', [])
+
+def s3_mtime(last_modified):
+    """Convert an S3 LastModified, either a datetime or an ISO 8601 UTC string, to a time_t."""
+    if isinstance(last_modified, str):
+        return calendar.timegm(time.strptime(last_modified[:19], "%Y-%m-%dT%H:%M:%S"))
+    return last_modified.timestamp()
 
 class S3Scanner(Scanner):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args,**kwargs)
+    """Scanner for S3.
+    The keyspace is split into shards at the delimiter, shard_depth levels down, and the shards are listed
+    concurrently by a thread pool. Pages of objects are handed to the calling thread, which is the only
+    one that writes to the database.
+    Objects are stored as s3://bucket/key with their ETag as the hash."""
+    def __init__(self, sdm, *, list_objects=None, jobs=1, shard_depth=S3_SHARD_DEPTH, limit=None, incremental=False,
+                 **kwargs):
+        """@param list_objects - a function(bucket, prefix, delimiter=None) that lists objects like boto3_list_objects.
+                                 By default boto3 is used if it is installed, and otherwise ctools.s3,
+                                 which lists the bucket sequentially.
+        @param jobs - number of shards listed at once.
+        @param shard_depth - number of delimiter levels that are split into shards.
+        @param limit - stop after this many objects.
+        @param incremental - if True, the bucket's objects in the previous scan are loaded first, and objects
+                             with the same LastModified, size and ETag are copied forward in bulk."""
+        super().__init__(sdm, **kwargs)
+        if list_objects is None:
+            try:
+                import boto3
+                list_objects = boto3_list_objects
+            except ImportError:
+                from ctools import s3
+                list_objects = lambda bucket, prefix, delimiter=None: s3.list_objects(bucket, prefix)
+                shard_depth = 0
+        self.list_objects = list_objects
+        self.jobs = jobs
+        self.shard_depth = shard_depth
+        self.limit = limit
+        self.incremental = incremental
+        self.prior = None       # snapshot of the bucket in the previous scan, with ETag digests
+        self.matched = 0        # objects found in prior, changed or not
+        self.carried_rows = []  # unchanged (pathid, mtime, size, hashid) rows waiting to be written
+
+    def insert_object(self, obj):
+        # {'LastModified': '2019-03-28T21:36:51.000Z',
+        #   'ETag': '"46610609053db79a94c4bd29cad8f4ff"',
+        #   'StorageClass': 'STANDARD',
+        #   'Key': 'a/b/c/whatever.txt',
+        #   'Size': 31838630}
+        # (ETag is the MD5, unless the object was uploaded in parts.)
+        path  = S3_PREFIX + self.bucket + "/" + obj['Key']
+        mtime = int(s3_mtime(obj['LastModified']))
+        etag  = obj['ETag'].strip('"')
+        self.filecount += 1
+        if self.prior is not None:
+            prior = self.prior.get(path)
+            if prior is not None:
+                self.matched += 1
+                if prior[1:3] == (mtime, obj['Size']) and prior[4] == snapshot.digest_key(etag):
+                    self.carry(prior[:4])
+                    return
+        algorithm = S3_MULTIPART_ALGORITHM if '-' in etag else 'md5'
+        self.insert_file( path=path, mtime=mtime, file_size=obj['Size'], hexdigest=etag, algorithm=algorithm )
+
+    def carry(self, row):
+        """Copy an unchanged object's row forward. The rows are written in batches, without lookups."""
+        self.carried += 1
+        self.carried_rows.append(row)
+        if len(self.carried_rows) >= self.batch_size:
+            self.sdm.add_pmshs(self.carried_rows)
+            self.carried_rows = []
+
+    def finish(self):
+        self.sdm.add_pmshs(self.carried_rows)
+        self.carried_rows = []
+        super().finish()
+
+    def limit_reached(self):
+        return self.limit is not None and self.filecount >= self.limit
+
+    def shards(self, pool, bucket, prefix):
+        """Split the keys under prefix into prefixes that can be listed independently, inserting the objects
+        found on the way. Each level is listed with the delimiter, all of its prefixes at once."""
+        shards = [prefix]
+        for depth in range(self.shard_depth):
+            listings = pool.map(lambda shard: list(self.list_objects(bucket, shard, delimiter=S3_DELIMITER)), shards)
+            shards = []
+            for listing in listings:
+                for obj in listing:
+                    if 'Prefix' in obj:
+                        shards.append(obj['Prefix'])
+                    elif not self.limit_reached():
+                        self.insert_object(obj)
+            self.dircount += len(shards)
+        return shards
 
     def ingest_walk(self, root):
         """Walk S3 bucket. Do not go inside ZIP files"""
         from ctools import s3
         (bucket,key) = s3.get_bucket_key(root)
-        for obj in s3.list_objects(bucket,key):
-            # {'LastModified': '2019-03-28T21:36:51.000Z', 
-            #   'ETag': '"46610609053db79a94c4bd29cad8f4ff"', 
-            #   'StorageClass': 'STANDARD', 
-            #   'Key': 'a/b/c/whatever.txt', 
-            #   'Size': 31838630}
-            # (ETag is the MD5.)
-
-            self.insert_file( path=obj['Key'], mtime=obj['LastModified'], file_size=obj['Size'], hexdigest=obj['ETag'] )
-            self.filecount += 1
-            if (self.args.limit is not None) and (self.filecount > self.args.limit):
-                return
-            if self.filecount % FILE_COMMIT_RATE==0:
-                self.conn.commit()
+        self.bucket = bucket
+        if self.incremental:
+            prev = self.sdm.previous_scan(self.sdm.scanid)
+            if prev is not None:
+                self.prior = self.sdm.load_s3_snapshot(prev, S3_PREFIX + bucket + "/" + key)
+        pages = queue.Queue(maxsize=S3_QUEUED_PAGES)
+        stop  = threading.Event()
+
+        def list_shard(shard):
+            try:
+                page = []
+                for obj in self.list_objects(bucket, shard):
+                    if stop.is_set():
+                        return
+                    page.append(obj)
+                    if len(page) == S3_PAGE_SIZE:
+                        pages.put(page)
+                        page = []
+                pages.put(page)
+            finally:
+                pages.put(None)         # this shard is done
 
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            shards  = self.shards(pool, bucket, key)
+            futures = [pool.submit(list_shard, shard) for shard in shards]
+            running = len(futures)
+            try:
+                while running:
+                    page = pages.get()
+                    if page is None:
+                        running -= 1
+                        continue
+                    for obj in page:
+                        if self.limit_reached():
+                            stop.set()      # keep taking pages until every shard has stopped
+                            break
+                        self.insert_object(obj)
+            finally:
+                # If writing failed, the listing threads would otherwise block on the full queue for ever,
+                # and the pool would wait for them instead of the error being raised
+                stop.set()
+                while running:
+                    if pages.get() is None:
+                        running -= 1
+            for future in futures:
+                future.result()         # raise any listing error
+        if self.prior is not None:
+            print("{}: {:,} objects unchanged, {:,} new or changed, {:,} deleted".format(
+                root, self.carried, self.filecount - self.carried, len(self.prior) - self.matched))
+            self.prior.close()
+            self.prior = None
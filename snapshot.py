@@ -0,0 +1,132 @@
+"""
+snapshot.py
+
+Part of the file system change detector.
+In-memory and mmap-backed indexes of a previous scan, so that a rescan can recognize unchanged files
+with a lookup rather than a database query per file.
+
+Both index classes map a full path to (pathid, mtime, size, hashid) and have the same interface.
+Their archives attribute holds the paths of the files in the scan whose members were scanned too.
+An index made with digests=True also holds the digest_key() of each file's hash, for comparing S3 ETags.
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+
+# Above this many files the index is kept in a temporary file rather than in Python objects.
+MMAP_THRESHOLD = 1000000
+
+def path_key(path):
+    """Return a compact 16-byte key for path."""
+    return hashlib.blake2b(path.encode('utf-8', 'surrogateescape'), digest_size=16).digest()
+
+def digest_key(hexdigest):
+    """Return a compact 16-byte key for a hash as stored in the hashes table."""
+    return hashlib.blake2b(hexdigest.encode('utf-8'), digest_size=16).digest()
+
+
+class SnapshotIndex():
+    """A dictionary of the files in a scan, keyed by the 16-byte path_key() of each path."""
+    def __init__(self, rows=(), digests=False):
+        self.data = {}
+        self.archives = set()
+        for row in rows:
+            self.add(*row)
+
+    def add(self, path, pathid, mtime, size, hashid, *digest):
+        self.data[path_key(path)] = (pathid, mtime, size, hashid) + digest
+
+    def get(self, path):
+        """Return (pathid, mtime, size, hashid) for path, followed by its digest if the index has them,
+        or None if it was not in the scan."""
+        return self.data.get(path_key(path))
+
+    def __len__(self):
+        return len(self.data)
+
+    def close(self):
+        self.data = {}
+
+
+class MmapSnapshotIndex():
+    """An open-addressed hash table of the files in a scan, stored in an anonymous temporary file and mmapped.
+    Each slot is a 16-byte path key followed by pathid, mtime, size and hashid as 64-bit integers,
+    and with digests=True, a 16-byte digest_key().
+    An all-zero key marks an empty slot. The table is never more than 3/4 full, so probes are short."""
+    EMPTY = bytes(16)
+
+    def __init__(self, count, rows=(), digests=False):
+        """@param count - an upper bound on the number of rows that will be added."""
+        self.SLOT = struct.Struct('<16sqqqq16s' if digests else '<16sqqqq')
+        self.nslots = 1
+        while self.nslots * 3 < count * 4 + 4:
+            self.nslots *= 2
+        self.count = 0
+        self.archives = set()
+        self.file = tempfile.TemporaryFile()
+        self.file.truncate(self.nslots * self.SLOT.size)
+        self.mm = mmap.mmap(self.file.fileno(), self.nslots * self.SLOT.size)
+        for row in rows:
+            self.add(*row)
+
+    def _probe(self, key):
+        """Return the offset of the slot holding key, or of the empty slot where it belongs."""
+        slot = int.from_bytes(key[:8], 'little') & (self.nslots - 1)
+        while True:
+            offset = slot * self.SLOT.size
+            found = self.mm[offset:offset+16]
+            if found == key or found == self.EMPTY:
+                return offset
+            slot = (slot + 1) & (self.nslots - 1)
+
+    def add(self, path, pathid, mtime, size, hashid, *digest):
+        if (self.count + 1) * 4 > self.nslots * 3:
+            raise RuntimeError("MmapSnapshotIndex is full")
+        key = path_key(path)
+        offset = self._probe(key)
+        if self.mm[offset:offset+16] == self.EMPTY:
+            self.count += 1
+        self.SLOT.pack_into(self.mm, offset, key, pathid, int(mtime), size, hashid, *digest)
+
+    def get(self, path):
+        """Return (pathid, mtime, size, hashid) for path, followed by its digest if the index has them,
+        or None if it was not in the scan."""
+        key = path_key(path)
+        offset = self._probe(key)
+        if self.mm[offset:offset+16] == self.EMPTY:
+            return None
+        return self.SLOT.unpack_from(self.mm, offset)[1:]
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+
+def find_archives(index, dirnames):
+    """Return the paths of the files in index that contain some of dirnames, i.e. the archives whose members
+    are in the scan. Each directory and its parents are checked once."""
+    archives = set()
+    checked = set()
+    for dirname in dirnames:
+        while dirname not in checked:
+            checked.add(dirname)
+            if index.get(dirname) is not None:
+                archives.add(dirname)
+            parent = os.path.dirname(dirname)
+            if parent == dirname:
+                break
+            dirname = parent
+    return archives
+
+def make_index(count, rows, mmap_threshold=MMAP_THRESHOLD, digests=False):
+    """Build the appropriate index for a scan of count files from an iterable of (path, pathid, mtime, size, hashid),
+    or of (path, pathid, mtime, size, hashid, digest_key) with digests=True."""
+    if count > mmap_threshold:
+        return MmapSnapshotIndex(count, rows, digests=digests)
+    return SnapshotIndex(rows, digests=digests)
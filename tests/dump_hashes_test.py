@@ -18,3 +18,25 @@ def test_dump_hashes():
     print("files:")
     return True
 
+
+def test_dump_sorted():
+    import tempfile
+    data = os.path.join(os.path.dirname(__file__), 'data')
+    with tempfile.TemporaryDirectory() as root:
+        dbfile = os.path.join(root, 'dump.db')
+        subprocess.check_call([sys.executable, FCHANGE,'--sqlite3db',dbfile,'--create'])
+        for d in ['DIR1','DIR2']:
+            subprocess.check_call([sys.executable, FCHANGE,'--sqlite3db',dbfile,'--addroot',os.path.join(data,d)])
+        subprocess.check_call([sys.executable, FCHANGE,'--sqlite3db',dbfile,'--scan'])
+        by_path = subprocess.run([sys.executable, FCHANGE,'--sqlite3db',dbfile,'--dump','--sort','path'],
+                                 capture_output=True, text=True, check=True).stdout.splitlines()
+        lines = [line.split('  ') for line in by_path]
+        assert len(lines) == len(os.listdir(os.path.join(data,'DIR1'))) + len(os.listdir(os.path.join(data,'DIR2')))
+        assert [path for (hexdigest, size, mtime, path) in lines] == sorted(path for (hexdigest, size, mtime, path) in lines)
+        assert all(int(size) == os.path.getsize(path) for (hexdigest, size, mtime, path) in lines)
+
+        out = os.path.join(root, 'dump.txt')
+        subprocess.check_call([sys.executable, FCHANGE,'--sqlite3db',dbfile,'--dump','--sort','hash','--out',out])
+        with open(out) as f:
+            by_hash = f.read().splitlines()
+        assert by_hash == sorted(by_path, key=lambda line: (line.split('  ')[0], line.split('  ')[3]))
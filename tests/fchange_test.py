@@ -2,6 +2,7 @@ import py.test
 import subprocess
 import os
 import os.path
+import json
 
 """Test the CLI according to what's in the README.md"""
 
@@ -14,3 +15,61 @@ def test_find_dups():
     output =  subprocess.run("python3 fchange.py --sqlite3db mydb.db --reportdups",shell=True, check=True, capture_output=True, text=True).stdout
     assert "tests/data/DIR2/23456.txt" in output
     assert "tests/data/DIR1/23456.txt" in output
+
+def test_find_dups_json():
+    os.chdir( os.path.join( os.path.dirname(__file__), ".."))
+    if os.path.exists("mydb.db"):
+        os.unlink("mydb.db")
+    subprocess.run("python3 fchange.py --sqlite3db mydb.db --create",shell=True, check=True)
+    subprocess.run("python3 fchange.py --sqlite3db mydb.db --addroot tests/data/DIR1",shell=True, check=True)
+    subprocess.run("python3 fchange.py --sqlite3db mydb.db --addroot tests/data/DIR2",shell=True, check=True)
+    subprocess.run("python3 fchange.py --sqlite3db mydb.db --scan",shell=True, check=True)
+    subprocess.run("python3 fchange.py --sqlite3db mydb.db --reportdups --min_dupsize 0 --fname_json mydups.json",
+                   shell=True, check=True)
+    with open("mydups.json") as f:
+        dups = json.load(f)
+    os.unlink("mydups.json")
+    assert len(dups) == 1
+    assert sorted(os.path.basename(d["dirname"]) for d in dups[0]) == ["DIR1", "DIR2"]
+
+def test_export_parquet():
+    pq = py.test.importorskip("pyarrow.parquet")
+    import tempfile
+    import time
+    os.chdir( os.path.join( os.path.dirname(__file__), ".."))
+    with tempfile.TemporaryDirectory() as root:
+        db = os.path.join(root, "export.db")
+        data = os.path.join(root, "data")
+        os.mkdir(data)
+        for name in ["a.txt", "b.txt"]:
+            with open(os.path.join(data, name), "w") as f:
+                f.write(name)
+        subprocess.run(f"python3 fchange.py --sqlite3db {db} --create",shell=True, check=True)
+        subprocess.run(f"python3 fchange.py --sqlite3db {db} --addroot {data}",shell=True, check=True)
+        subprocess.run(f"python3 fchange.py --sqlite3db {db} --scan",shell=True, check=True)
+        time.sleep(1)           # scans are identified by the second they start
+        with open(os.path.join(data, "a.txt"), "w") as f:
+            f.write("changed")
+        os.unlink(os.path.join(data, "b.txt"))
+        with open(os.path.join(data, "c.txt"), "w") as f:
+            f.write("c.txt")
+        subprocess.run(f"python3 fchange.py --sqlite3db {db} --scan",shell=True, check=True)
+
+        subprocess.run(f"python3 fchange.py --sqlite3db {db} --scanid 1 --export_parquet {root}/scan1.parquet",
+                       shell=True, check=True)
+        table = pq.read_table(os.path.join(root, "scan1.parquet"))
+        assert sorted(table.column("filename").to_pylist()) == ["a.txt", "b.txt"]
+        assert table.column("size").to_pylist() == [5, 5]
+
+        subprocess.run(f"python3 fchange.py --sqlite3db {db} --delta 1-2 --export_parquet {root}/delta.parquet",
+                       shell=True, check=True)
+        table = pq.read_table(os.path.join(root, "delta.parquet"))
+        changes = dict(zip(table.column("filename").to_pylist(), table.column("change").to_pylist()))
+        assert changes == {"a.txt": "changed", "b.txt": "deleted", "c.txt": "new"}
+
+        subprocess.run(f"python3 fchange.py --sqlite3db {db} --export_arrow {root}/scan2.arrow",
+                       shell=True, check=True)
+        import pyarrow
+        with pyarrow.ipc.open_stream(os.path.join(root, "scan2.arrow")) as reader:
+            table = reader.read_all()
+        assert sorted(table.column("filename").to_pylist()) == ["a.txt", "c.txt"]
@@ -1,8 +1,56 @@
 import sys
-from subprocess import call
+import os
+import json
+import shutil
+import tempfile
+from subprocess import check_call
+
+FCHANGE = os.path.join( os.path.dirname(__file__), '../fchange.py')
 
 def test_find_directory_dups_test():
-    call([sys.executable,'../fchange.py','--sqlite3db','mydb.db','--addroot','data/DIR1'])
-    call([sys.executable,'../fchange.py','--sqlite3db','mydb.db','--addroot','data/DIR2'])
-    return True
+    with tempfile.TemporaryDirectory() as root:
+        data = os.path.join(root, 'data')
+        photos = os.path.join(data, 'photos')
+        for (sub, n) in [('a', 6), ('b', 6)]:
+            os.makedirs(os.path.join(photos, sub))
+            for i in range(n):
+                with open(os.path.join(photos, sub, f'{i}.jpg'), 'w') as f:
+                    f.write(f'{sub} {i} ' * 100)
+        shutil.copytree(photos, os.path.join(data, 'backup', 'photos'))
+        shutil.copytree(os.path.join(photos, 'a'), os.path.join(data, 'other', 'a'))
+        # The same pictures under other names, one of them edited
+        shutil.copytree(photos, os.path.join(data, 'renamed'))
+        for sub in ['a', 'b']:
+            for name in os.listdir(os.path.join(data, 'renamed', sub)):
+                os.rename(os.path.join(data, 'renamed', sub, name), os.path.join(data, 'renamed', sub, 'IMG_' + name))
+        with open(os.path.join(data, 'renamed', 'b', 'IMG_0.jpg'), 'a') as f:
+            f.write('edited')
+
+        db = os.path.join(root, 'mydb.db')
+        out = os.path.join(root, 'dirdups.json')
+        check_call([sys.executable, FCHANGE, '--sqlite3db', db, '--create'])
+        check_call([sys.executable, FCHANGE, '--sqlite3db', db, '--addroot', data])
+        check_call([sys.executable, FCHANGE, '--sqlite3db', db, '--scan'])
+        check_call([sys.executable, FCHANGE, '--sqlite3db', db, '--reportdirdups', '--min_dupsize', '0',
+                    '--similarity', '0.75', '--fname_json', out])
+        with open(out) as f:
+            report = json.load(f)
+
+        # photos and its copy are reported once, not with their subdirectories, and other/a has a copy in both
+        identical = [[os.path.relpath(dirname, data) for dirname in dups['dirnames']] for dups in report['identical']]
+        assert identical[0] == ['backup/photos', 'photos']
+        assert identical[1] in (['backup/photos/a', 'other/a'], ['other/a', 'photos/a'])
+        assert len(identical) == 2
+        size = sum(os.path.getsize(os.path.join(photos, sub, name)) for sub in ['a', 'b']
+                   for name in os.listdir(os.path.join(photos, sub)))
+        assert report['identical'][0]['reclaimable'] == size
 
+        similar = [sorted(os.path.relpath(dirname, data) for dirname in pair['dirnames']) for pair in report['similar']]
+        assert ['photos', 'renamed'] in similar or ['backup/photos', 'renamed'] in similar
+        # Their subdirectories are not reported again, but other/a is a copy of renamed/a with other names
+        assert not any(pair[0].endswith('photos/a') for pair in similar)
+        assert ['other/a', 'renamed/a'] in similar
+        # Identical directories are not also reported as similar
+        assert not any(any(p.startswith('backup/photos') for p in pair) and any(p.startswith('photos') for p in pair)
+                       for pair in similar)
+        assert len(similar) == 2
@@ -1,7 +1,10 @@
+import contextlib
 import tempfile
 import sqlite3
 import os
+import shutil
 import sys
+import time
 
 import scandb
 
@@ -27,6 +30,24 @@ def make_database(sdb):
     sdb.add_root( DIR1 )
     sdb.add_root( DIR2 )
 
+@contextlib.contextmanager
+def scanned_root(layout=None):
+    """Yield (root, sdb): an empty directory, and a new SQLite3 database in which it is the only root"""
+    with tempfile.TemporaryDirectory() as root, tempfile.NamedTemporaryFile(suffix='.dbfile') as tf:
+        sdb = scandb.SQLite3ScanDatabase(fname=tf.name)
+        sdb.create_database()
+        if layout is not None:
+            sdb.set_layout(layout)
+        sdb.add_root(root)
+        yield (root, sdb)
+
+def write_file(root, name, contents):
+    """Write contents to the file name under root, making its directory if needed"""
+    path = os.path.join(root, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(contents)
+
 def check_get_enabled_roots(sdb):
     assert sdb.get_enabled_roots() == set([DIR1, DIR2])
 
@@ -56,6 +77,17 @@ def check_hashid(sdb):
     assert h1!=h2
     assert h1==h3
 
+def check_bulk_pathids(sdb):
+    pathids = sdb.get_pathids(["a/b/c", "a/b/e", "a/f/c"])
+    assert pathids["a/b/c"] == sdb.get_pathid("a/b/c")
+    assert len(set(pathids.values())) == 3
+    assert sdb.get_pathids(["a/b/e"]) == {"a/b/e": pathids["a/b/e"]}
+
+def check_bulk_hashids(sdb):
+    hashids = sdb.get_hashids_for_hexdigests(["0123456789", "abcdef"])
+    assert hashids["0123456789"] == sdb.get_hashid_for_hexdigest("0123456789")
+    assert hashids["0123456789"] != hashids["abcdef"]
+
 def check_scan_enabled_roots(sdb):
     sdb.add_root( DIR1 )
     sdb.add_root( DIR2 )
@@ -81,13 +113,32 @@ def check_find_dups_after_scan(sdb):
     assert dups[0][0]['filename']==dups[0][1]['filename']=='23456.txt'
     assert dups[0][0]['dirname'] != dups[0][1]['dirname']
 
+def check_dedup_scan(sdb):
+    """A dedup scan must find the same duplicates as a full scan"""
+    time.sleep(1)
+    sdb.scan_enabled_roots(dedup=True)
+    check_find_dups_after_scan(sdb)
+
+def check_hash_algorithm(sdb):
+    assert sdb.get_schema_version() == scandb.SCHEMA_VERSION
+    assert sdb.get_hash_algorithm() == 'md5'
+    try:
+        sdb.set_hash_algorithm('sha256')
+        raise AssertionError("changed the hash algorithm of a database that has been scanned")
+    except RuntimeError:
+        pass
+
 def check_database(sdb):
     check_get_enabled_roots(sdb)
     check_del_root(sdb)
     check_pathid(sdb)
     check_hashid(sdb)
+    check_bulk_pathids(sdb)
+    check_bulk_hashids(sdb)
     check_scan_enabled_roots(sdb)
     check_find_dups_after_scan(sdb)
+    check_dedup_scan(sdb)
+    check_hash_algorithm(sdb)
 
 def test_sqlite3_schema():
     with tempfile.NamedTemporaryFile(suffix='.dbfile') as tf:
@@ -140,3 +191,436 @@ def test_create_database_mysql_prefix():
     del sdb
 
 
+
+def test_lru_cache():
+    cache = scandb.LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1      # a is now more recent than b
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert (cache.hits, cache.misses) == (3, 1)
+
+def test_upgrade_sqlite3():
+    """A database from before schema versions were recorded must be upgraded before it is scanned"""
+    with tempfile.NamedTemporaryFile(suffix='.dbfile') as tf:
+        conn = sqlite3.connect(tf.name)
+        conn.execute("CREATE TABLE metadata (key VARCHAR(255) PRIMARY KEY,value VARCHAR(255) NOT NULL)")
+        conn.execute("CREATE TABLE hashes (hashid INTEGER PRIMARY KEY,hash TEXT NOT NULL UNIQUE)")
+        conn.execute("INSERT INTO hashes (hash) VALUES ('0123456789')")
+        conn.execute("CREATE TABLE files (fileid INTEGER PRIMARY KEY, pathid INTEGER, mtime INTEGER, size INTEGER, "
+                     "hashid INTEGER, scanid INTEGER)")
+        conn.commit()
+        conn.close()
+        sdb = scandb.SQLite3ScanDatabase(fname=tf.name)
+        assert sdb.get_schema_version() == 1
+        try:
+            sdb.check_schema()
+            raise AssertionError("check_schema() accepted an old database")
+        except RuntimeError:
+            pass
+        sdb.upgrade_database()
+        sdb.check_schema()
+        assert sdb.csfra("SELECT hash, algorithm FROM hashes") == [(bytes.fromhex('0123456789'), 'md5')]
+
+def test_upgrade_scans_sqlite3():
+    """Scans in a database from before schema versions were recorded have no duration, but are not interrupted"""
+    with tempfile.NamedTemporaryFile(suffix='.dbfile') as tf:
+        conn = sqlite3.connect(tf.name)
+        conn.execute("CREATE TABLE metadata (key VARCHAR(255) PRIMARY KEY,value VARCHAR(255) NOT NULL)")
+        conn.execute("CREATE TABLE scans (scanid INTEGER PRIMARY KEY, time DATETIME NOT NULL UNIQUE, duration INTEGER)")
+        conn.execute("INSERT INTO scans (time) VALUES ('2020-01-01T00:00:00')")
+        conn.execute("CREATE TABLE hashes (hashid INTEGER PRIMARY KEY,hash TEXT NOT NULL UNIQUE)")
+        conn.execute("CREATE TABLE files (fileid INTEGER PRIMARY KEY, pathid INTEGER, mtime INTEGER, size INTEGER, "
+                     "hashid INTEGER, scanid INTEGER)")
+        conn.commit()
+        conn.close()
+        sdb = scandb.SQLite3ScanDatabase(fname=tf.name)
+        assert sdb.get_schema_version() == 1
+        sdb.upgrade_database()
+        assert sdb.last_scan() == 1
+        assert sdb.unfinished_scan() is None
+
+def test_hash_tags_sqlite3():
+    """The same digest made by another algorithm, or of part of a file, is a different hash, in new and upgraded databases"""
+    digest = "0123456789abcdef" * 2
+    with tempfile.NamedTemporaryFile(suffix='.dbfile') as tf:
+        sdb = scandb.SQLite3ScanDatabase(fname=tf.name)
+        sdb.create_database()
+        sdb.csfra("DROP TABLE hashes")
+        sdb.csfra("CREATE TABLE hashes (hashid INTEGER PRIMARY KEY, hash BLOB NOT NULL UNIQUE, "
+                  "algorithm VARCHAR(32) NOT NULL DEFAULT 'md5', partial INTEGER NOT NULL DEFAULT 0)")
+        sdb.csfra("INSERT INTO hashes (hashid, hash) VALUES (7, %s)", (bytes.fromhex(digest),))
+        sdb.set_metadata("schema_version", 11)
+        sdb.upgrade_database()
+        for n in range(2):
+            hashids = [sdb.get_hashid_for_hexdigest(digest, 'md5'), sdb.get_hashid_for_hexdigest(digest, 'sha1'),
+                       sdb.get_hashids_for_hexdigests([digest], 'md5', partial=1)[digest],
+                       sdb.get_hashids_for_hexdigests([digest], 'sha1')[digest]]
+            assert hashids[0] == 7 and hashids[1] == hashids[3]
+            assert len(set(hashids)) == 3
+            sdb.clear_caches()
+        assert sdb.csfra("SELECT COUNT(*) FROM hashes")[0][0] == 3
+
+def test_dedup_scan_roots_sqlite3():
+    """In a dedup scan, files of the same size in different roots are compared by their contents"""
+    with tempfile.TemporaryDirectory() as root, tempfile.NamedTemporaryFile(suffix='.dbfile') as tf:
+        for (name, contents) in [('A', 'aaaa'), ('B', 'bbbb'), ('C', 'aaaa')]:
+            write_file(root, os.path.join(name, 'f.txt'), contents)
+        sdb = scandb.SQLite3ScanDatabase(fname=tf.name)
+        sdb.create_database()
+        for name in ['A', 'B']:
+            sdb.add_root(os.path.join(root, name))
+        sdb.scan_enabled_roots(dedup=True)
+        assert list(sdb.duplicate_files()) == []
+        time.sleep(1)
+        sdb.add_root(os.path.join(root, 'C'))
+        sdb.scan_enabled_roots(dedup=True)
+        dups = list(sdb.duplicate_files())
+        assert len(dups) == 1
+        assert sorted(os.path.basename(f['dirname']) for f in dups[0]) == ['A', 'C']
+
+def test_parallel_scan_sqlite3():
+    """A scan with a hashing pool must leave the same rows, with the same ids, as a serial one"""
+    import zipfile
+    with tempfile.TemporaryDirectory() as root:
+        for d in range(3):
+            os.mkdir(os.path.join(root, f'd{d}'))
+            for i in range(6):
+                with open(os.path.join(root, f'd{d}', f'f{i}.txt'), 'w') as f:
+                    f.write(f'{d} {i}')
+            with zipfile.ZipFile(os.path.join(root, f'd{d}', f'z{d}.zip'), 'w') as zf:
+                for m in range(3):
+                    zf.writestr(f'm{m}.txt', f'member {d} {m}')
+        tables = []
+        for jobs in [1, 4]:
+            with tempfile.NamedTemporaryFile(suffix='.dbfile') as tf:
+                sdb = scandb.SQLite3ScanDatabase(fname=tf.name)
+                sdb.create_database()
+                sdb.add_root(root)
+                sdb.scan_enabled_roots(jobs=jobs, batch_size=4)
+                tables.append([sdb.csfra(f"SELECT * FROM {table}")
+                               for table in ['dirnames', 'filenames', 'paths', 'hashes', 'files', 'crcs']])
+        assert len(tables[0][4]) == 30
+        assert tables[0] == tables[1]
+
+def test_rescan_zip_members():
+    """ZIP members must be in every scan, whether the zipfile is hashed, found unchanged, or preloaded"""
+    ZIPFILE = os.path.join( os.path.dirname(__file__), 'hello.zip')
+    with scanned_root() as (root, sdb):
+        shutil.copy(ZIPFILE, os.path.join(root, 'hello.zip'))
+        os.mkdir(os.path.join(root, 'sub'))
+        shutil.copy(ZIPFILE, os.path.join(root, 'sub', 'copy.zip'))
+        def contents():
+            return sorted((f['dirname'], f['filename'], f['size']) for f in sdb.all_files(sdb.last_scan()))
+        sdb.scan_enabled_roots()
+        first = contents()
+        assert (os.path.join(root, 'sub', 'copy.zip'), 'hello.txt', 13) in first
+        assert len(first) == 4
+        for kwargs in [{}, {'preload': True}, {'jobs': 2}]:
+            time.sleep(1)
+            sdb.scan_enabled_roots(**kwargs)
+            assert contents() == first
+
+def test_scan_stats_json():
+    """A scan can write its counters and timers, including each table's queries, to a JSON file"""
+    import json
+    ZIPFILE = os.path.join( os.path.dirname(__file__), 'hello.zip')
+    with scanned_root() as (root, sdb):
+        shutil.copy(ZIPFILE, os.path.join(root, 'hello.zip'))
+        shutil.copy(os.path.join(DIR1, '12345.txt'), root)
+        sdb.scan_enabled_roots(jobs=2, stats_json=os.path.join(root, 'stats.json'))
+        with open(os.path.join(root, 'stats.json')) as f:
+            report = json.load(f)
+        assert report['scanid'] == sdb.last_scan()
+        assert report['files'] == 2
+        assert report['counts']['hash bytes'] == sum(os.path.getsize(os.path.join(root, name))
+                                                     for name in ['hello.zip', '12345.txt']) + 13
+        for section in ['hash', 'archive members', 'stat', 'scandir', 'commit', 'query files', 'query hashes']:
+            assert report['sections'][section]['count'] > 0
+        assert report['caches']['paths']['misses'] >= 0
+
+def test_rescan_opens_nothing():
+    """A rescan of unchanged files opens none of them, but still copies the members of the zipfile among them"""
+    import json
+    ZIPFILE = os.path.join( os.path.dirname(__file__), 'hello.zip')
+    with scanned_root() as (root, sdb), tempfile.NamedTemporaryFile(suffix='.json') as stats:
+        shutil.copy(ZIPFILE, os.path.join(root, 'hello.zip'))
+        for name in ['12345.txt', '23456.txt']:
+            shutil.copy(os.path.join(DIR1, name), root)
+        sdb.scan_enabled_roots()
+        first = sorted(sdb.scan_rows(sdb.last_scan()))
+        time.sleep(1)
+        sdb.scan_enabled_roots(stats_json=stats.name)
+        with open(stats.name) as f:
+            report = json.load(f)
+        assert report['syscalls'].get('open', 0) == 0
+        assert sorted(sdb.scan_rows(sdb.last_scan())) == first
+        assert len(first) == 4
+
+def test_nested_zip_members():
+    """Nested zipfiles are read to archive_depth, and members whose CRC32 is unchanged are not hashed again"""
+    import zipfile
+    import scanner
+    ZIPFILE = os.path.join( os.path.dirname(__file__), 'hello.zip')
+    with scanned_root() as (root, sdb):
+        def make_outer(extra):
+            with zipfile.ZipFile(os.path.join(root, 'outer.zip'), 'w') as zf:
+                zf.write(ZIPFILE, 'hello.zip')
+                zf.writestr('a.txt', b'a' * 1000)
+                if extra:
+                    zf.writestr('b.txt', b'b')
+        make_outer(False)
+        def contents():
+            return sorted(os.path.relpath(os.path.join(f['dirname'], f['filename']), root)
+                          for f in sdb.all_files(sdb.last_scan()))
+        sdb.scan_enabled_roots(jobs=2)
+        assert contents() == ['outer.zip', 'outer.zip/a.txt', 'outer.zip/hello.zip']
+        time.sleep(1)
+        sdb.scan_enabled_roots(archive_depth=2)
+        assert contents() == ['outer.zip', 'outer.zip/a.txt', 'outer.zip/hello.zip', 'outer.zip/hello.zip/hello.txt']
+
+        time.sleep(1)
+        make_outer(True)
+        hashed = []
+        hash_pending = scanner.hash_pending
+        try:
+            scanner.hash_pending = lambda pf, *args: hashed.append(pf.path) or hash_pending(pf, *args)
+            sdb.scan_enabled_roots(jobs=2, archive_depth=2)
+        finally:
+            scanner.hash_pending = hash_pending
+        assert sorted(os.path.relpath(path, root) for path in hashed) == ['outer.zip', 'outer.zip/b.txt']
+        assert contents() == ['outer.zip', 'outer.zip/a.txt', 'outer.zip/b.txt',
+                              'outer.zip/hello.zip', 'outer.zip/hello.zip/hello.txt']
+
+def test_resume_sqlite3():
+    """An interrupted scan is not reported, and resuming it completes it without scanning any file twice"""
+    import scanner
+    with scanned_root() as (root, sdb):
+        for i in range(40):
+            path = os.path.join(root, 'd{}'.format(i % 4), 'e{}'.format(i % 3), 'f{}'.format(i))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(str(i))
+
+        insert_file = scanner.Scanner.insert_file
+        inserted = []
+        def interrupt(self, **kwargs):
+            inserted.append(kwargs['path'])
+            if len(inserted) == 25:
+                raise KeyboardInterrupt
+            return insert_file(self, **kwargs)
+        checkpoint_seconds = scanner.CHECKPOINT_SECONDS
+        try:
+            scanner.CHECKPOINT_SECONDS = 0
+            scanner.Scanner.insert_file = interrupt
+            sdb.scan_enabled_roots(batch_size=4)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            scanner.Scanner.insert_file = insert_file
+            scanner.CHECKPOINT_SECONDS = checkpoint_seconds
+        assert sdb.last_scan() is None
+        scanid = sdb.unfinished_scan()
+        assert scanid is not None
+
+        sdb.scan_enabled_roots(resume=True)
+        assert sdb.last_scan() == scanid
+        assert sdb.unfinished_scan() is None
+        files = [os.path.join(f['dirname'], f['filename']) for f in sdb.all_files(scanid)]
+        assert sorted(files) == sorted(set(files))
+        assert len(files) == 40
+        assert sdb.csfra("SELECT COUNT(*) FROM checkpoints")[0][0] == 0
+
+def test_bulk_load_sqlite3():
+    """A bulk-loading scan must leave the same settings and indexes as it found, even if it was killed"""
+    def indexes(sdb):
+        return set(row[0] for row in sdb.csfra("SELECT name FROM sqlite_master WHERE type='index'"))
+    with tempfile.NamedTemporaryFile(suffix='.dbfile') as tf:
+        sdb = scandb.SQLite3ScanDatabase(fname=tf.name)
+        make_database(sdb)
+        before = indexes(sdb)
+        assert set(scandb.SQLITE3_DEFERRED_INDEXES) <= before
+        sdb.scan_enabled_roots(bulk=True, batch_size=2)
+        assert indexes(sdb) == before
+        assert sdb.csfra("PRAGMA journal_mode")[0][0] == 'delete'
+        assert len(list(sdb.all_files(sdb.last_scan()))) == 4
+
+        # A killed initial scan leaves the deferred indexes dropped; the next scan rebuilds them
+        sdb.begin_bulk_load(initial=True)
+        assert not set(scandb.SQLITE3_DEFERRED_INDEXES) & indexes(sdb)
+        del sdb
+        sdb = scandb.SQLite3ScanDatabase(fname=tf.name)
+        time.sleep(1)
+        sdb.scan_enabled_roots()
+        assert indexes(sdb) == before
+
+def test_compare_scans_sqlite3():
+    """new, deleted, changed and renamed files between two scans"""
+    with scanned_root() as (root, sdb):
+        write_file(root, 'same.txt', 'same')
+        write_file(root, 'changed.txt', 'before')
+        write_file(root, 'old.txt', 'renamed')
+        write_file(root, 'deleted.txt', 'deleted')
+        sdb.scan_enabled_roots()
+        scan0 = sdb.last_scan()
+        time.sleep(1)
+        write_file(root, 'changed.txt', 'after!')
+        os.rename(os.path.join(root, 'old.txt'), os.path.join(root, 'new.txt'))
+        os.unlink(os.path.join(root, 'deleted.txt'))
+        write_file(root, 'added.txt', 'added')
+        sdb.scan_enabled_roots()
+        scan1 = sdb.last_scan()
+        assert sorted(f['filename'] for f in sdb.new_files(scan0, scan1)) == ['added.txt', 'new.txt']
+        assert sorted(f['filename'] for f in sdb.deleted_files(scan0, scan1)) == ['deleted.txt', 'old.txt']
+        assert list(sdb.changed_files(scan0, scan1)) == [{'dirname': root, 'filename': 'changed.txt'}]
+        assert list(sdb.renamed_files(scan0, scan1)) == [{'dirname1': root, 'filename1': 'old.txt',
+                                                          'dirname2': root, 'filename2': 'new.txt'}]
+
+def test_intervals_layout_sqlite3():
+    """Scans stored as intervals, and converted between layouts, must answer every query as rows do"""
+    with scanned_root("intervals") as (root, sdb):
+        write_file(root, 'same.txt', 'same')
+        write_file(root, 'dup.txt', 'same')
+        write_file(root, 'flip.txt', 'before')
+        write_file(root, 'gone.txt', 'gone')
+        for step in range(3):
+            if step:
+                time.sleep(1)       # so that scans, and the mtimes of rewritten files, differ
+                write_file(root, 'flip.txt', ['after!', 'before'][step - 1])
+            if step == 1:
+                os.unlink(os.path.join(root, 'gone.txt'))
+                write_file(root, 'new.txt', 'new')
+            sdb.scan_enabled_roots(preload=step == 2)
+        scans = [scanid for (scanid, when, duration) in sdb.get_scans()]
+        assert len(scans) == 3
+        assert sdb.csfra("SELECT COUNT(*) FROM files")[0][0] == 0
+        # same, dup and new are one version each; flip has three and gone one
+        assert sdb.csfra("SELECT COUNT(*) FROM versions")[0][0] == 7
+
+        def answers():
+            def names(files):
+                return sorted((f['filename'], f['size'], f['mtime']) for f in files)
+            ret = []
+            for (scan0, scan1) in zip(scans, scans[1:]):
+                ret += [names(sdb.all_files(scan1)), names(sdb.new_files(scan0, scan1)),
+                        names(sdb.deleted_files(scan0, scan1)),
+                        sorted(f['filename'] for f in sdb.changed_files(scan0, scan1)),
+                        sorted(names(dups) for dups in sdb.duplicate_files(scan1)),
+                        sorted(sdb.delta_rows(scan0, scan1))]
+            return ret
+        intervals = answers()
+        assert intervals[1:4] == [[('new.txt', 3, intervals[1][0][2])], [('gone.txt', 4, intervals[2][0][2])],
+                                  ['flip.txt']]
+        sdb.set_layout("rows")
+        assert sdb.csfra("SELECT COUNT(*) FROM versions")[0][0] == 0
+        assert answers() == intervals
+        sdb.set_layout("intervals")
+        assert sdb.csfra("SELECT COUNT(*) FROM versions")[0][0] == 7
+        assert answers() == intervals
+
+def test_compact_sqlite3():
+    """Compaction keeps the latest scans intact and removes everything only the older ones used"""
+    for layout in scandb.ScanDatabase.LAYOUTS:
+        with scanned_root(layout) as (root, sdb):
+            write_file(root, 'same.txt', 'same')
+            for step in range(3):
+                if step:
+                    time.sleep(1)
+                write_file(root, 'step.txt', f'step {step}')
+                write_file(root, f'only{step}.txt', f'only {step}')
+                if step:
+                    os.unlink(os.path.join(root, f'only{step - 1}.txt'))
+                sdb.scan_enabled_roots()
+            (scan1, scan2) = [scanid for (scanid, when, duration) in sdb.get_scans()][1:]
+            kept = sorted(sdb.scan_rows(scan2)), sorted(sdb.delta_rows(scan1, scan2))
+
+            result = sdb.compact(keep=2, batch_size=2)
+            assert result["scans"] == [scan1 - 1]
+            assert not result["deferred"]
+            assert [scanid for (scanid, when, duration) in sdb.get_scans()] == [scan1, scan2]
+            assert (sorted(sdb.scan_rows(scan2)), sorted(sdb.delta_rows(scan1, scan2))) == kept
+            # only0.txt, and the contents of it and of step.txt in the first scan, were only in the deleted scan
+            assert sdb.csfra("SELECT filename FROM filenames ORDER BY filename") == [('only1.txt',), ('only2.txt',),
+                                                                                     ('same.txt',), ('step.txt',)]
+            assert sdb.csfra("SELECT COUNT(*) FROM hashes")[0][0] == 5
+            assert sdb.compact(keep=2)["deleted"] == {}
+            assert sdb.compact(keep=0)["scans"] == [scan1]
+            assert sorted(sdb.scan_rows(scan2)) == kept[0]
+            assert sdb.csfra("SELECT COUNT(*) FROM paths")[0][0] == 3
+
+def test_rollups_sqlite3():
+    """Rollups count the files and bytes below each directory, and their hashes find the changed subtrees"""
+    ZIPFILE = os.path.join( os.path.dirname(__file__), 'hello.zip')
+    with scanned_root() as (root, sdb):
+        write_file(root, 'a/x.txt', 'x')
+        write_file(root, 'a/b/y.txt', 'yy')
+        write_file(root, 'c/z.txt', 'zzz')
+        shutil.copy(ZIPFILE, os.path.join(root, 'c', 'hello.zip'))
+        zipsize = os.path.getsize(ZIPFILE)
+        sdb.scan_enabled_roots()
+        scan0 = sdb.last_scan()
+        # The zipfile's members are in its own rollup, not in those of the directories above it
+        assert sdb.subtree(scan0, root) == {"files": 4, "bytes": 6 + zipsize,
+                                            "hash": sdb.subtree(scan0, root + "/")["hash"]}
+        assert sdb.subtree(scan0, os.path.join(root, 'a'))["files"] == 2
+        assert sdb.subtree(scan0, os.path.join(root, 'c', 'hello.zip'))["files"] == 1
+        assert sdb.subtree(scan0, os.path.join(root, 'nothing')) is None
+        assert sdb.subtree(scan0, os.path.dirname(root))["bytes"] == 6 + zipsize
+        time.sleep(1)
+        write_file(root, 'a/b/y.txt', 'yyyy')
+        write_file(root, 'a/b/new.txt', 'new')
+        sdb.scan_enabled_roots()
+        scan1 = sdb.last_scan()
+        changes = list(sdb.changed_directories(scan0, scan1, root))
+        assert [(c["change"], c["dirname"]) for c in changes] == [("changed", root),
+                                                                   ("changed", os.path.join(root, 'a')),
+                                                                   ("changed", os.path.join(root, 'a', 'b'))]
+        assert (changes[-1]["files0"], changes[-1]["bytes0"], changes[-1]["files1"], changes[-1]["bytes1"]) == (1, 2, 2, 7)
+        assert [c["dirname"] for c in sdb.changed_directories(scan0, scan1)][-3:] == [c["dirname"] for c in changes]
+        # Scans made before rollups existed get them when they are first needed
+        sdb.csfra("DELETE FROM rollups")
+        assert list(sdb.changed_directories(scan0, scan1, root)) == changes
+
+def test_fast_rescan_sqlite3():
+    """A fast rescan does not list unchanged directories, but records the same files as a full scan,
+    unless the root is trusted and a file was rewritten in place"""
+    import hashlib
+    import json
+    ZIPFILE = os.path.join( os.path.dirname(__file__), 'hello.zip')
+    for layout in scandb.ScanDatabase.LAYOUTS:
+        with scanned_root(layout) as (root, sdb), tempfile.NamedTemporaryFile(suffix='.json') as stats:
+            write_file(root, 'a/x.txt', 'x')
+            write_file(root, 'a/b/y.txt', 'yy')
+            write_file(root, 'c/z.txt', 'zzz')
+            shutil.copy(ZIPFILE, os.path.join(root, 'c', 'hello.zip'))
+            def scan(**kwargs):
+                time.sleep(1)
+                sdb.scan_enabled_roots(fast_rescan=True, stats_json=stats.name, **kwargs)
+                with open(stats.name) as f:
+                    return json.load(f)['skipped']
+            def contents():
+                return sorted(sdb.scan_rows(sdb.last_scan()))
+            assert scan() == 0
+            assert len(contents()) == 5
+            write_file(root, 'a/b/new.txt', 'new')     # changes the mtime of a/b
+            write_file(root, 'c/z.txt', 'ZZZ')         # rewritten in place, which does not change the mtime of c
+            assert scan() == 3
+            fast = contents()
+            assert scan(preload=True) == 4
+            assert contents() == fast
+            sdb.csfra("DELETE FROM dirscans")
+            sdb.commit()
+            assert scan() == 0
+            assert contents() == fast
+            assert [row[4] for row in fast if row[1] == 'z.txt'] == [hashlib.md5(b'ZZZ').hexdigest()]
+            # A trusted root carries c/z.txt forward without looking at it, and the zipfile's members with it
+            sdb.set_trusted(root, True)
+            write_file(root, 'c/z.txt', 'zz')
+            assert scan() == 4
+            assert contents() == fast
+            sdb.set_trusted(root, False)
+            assert scan() == 4
+            assert contents() != fast
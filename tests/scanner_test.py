@@ -1,7 +1,10 @@
 import py.test
 
 from scanner import *
+import io
+import tarfile
 import zipfile
+import zlib
 
 HELLO_FILENAME = os.path.join( os.path.dirname(__file__), 'hello.txt')
 HELLO_CONTENTS = "Hello World!\n"
@@ -17,6 +20,18 @@ def test_hash_file():
             f.write(HELLO_CONTENTS)
             
     assert hash_file(open(HELLO_FILENAME,"rb")) == HELLO_HASH
+    assert hash_file(open(HELLO_FILENAME,"rb"), 'md5', 4) == HELLO_HASH
+    for algorithm in HASH_ALGORITHMS:
+        assert hash_file(open(HELLO_FILENAME,"rb"), algorithm) != HELLO_HASH or algorithm=='md5'
+    assert hash_file(open(HELLO_FILENAME,"rb"), 'sha256') == \
+        '03ba204e50d126e4674c005e04d82e84c21366780af1f43bd54a37816b6ab340'
+
+def test_hash_file_partial():
+    # Files no longer than two partial blocks are read completely
+    assert hash_file_partial(open(HELLO_FILENAME,"rb"), len(HELLO_CONTENTS), nbytes=4) != \
+        hash_file_partial(open(HELLO_FILENAME,"rb"), len(HELLO_CONTENTS), nbytes=8)
+    assert hash_file_partial(open(HELLO_FILENAME,"rb"), len(HELLO_CONTENTS)) != HELLO_HASH
+    assert hash_size(len(HELLO_CONTENTS)) != hash_size(len(HELLO_CONTENTS)+1)
 
 def test_open_zipfile():
     assert os.path.exists(ZIPFILE_FILENAME)
@@ -25,3 +40,181 @@ def test_open_zipfile():
     assert type(zf) == zipfile.ZipFile
 
 
+
+def test_hash_file_magic():
+    assert hash_file_magic(open(HELLO_FILENAME,"rb")) == (HELLO_HASH, b'Hell')
+    assert hash_file_magic(open(HELLO_FILENAME,"rb"), 'md5', 3) == (HELLO_HASH, b'Hell')
+    (hexdigest, magic) = hash_file_magic(open(ZIPFILE_FILENAME,"rb"))
+    assert hexdigest == hash_file(open(ZIPFILE_FILENAME,"rb"))
+    assert is_zip(ZIPFILE_FILENAME, magic)
+    assert not is_zip("hello.jar", magic)
+
+def test_read_zip_members():
+    with open(ZIPFILE_FILENAME,"rb") as f:
+        members = read_zip_members(f, ZIPFILE_FILENAME)
+        assert not f.closed
+    assert [(pf.path, pf.file_size, pf.hexdigest) for pf in members] == \
+        [(ZIPFILE_FILENAME+"/hello.txt", len(HELLO_CONTENTS), HELLO_HASH)]
+    with open(HELLO_FILENAME,"rb") as f:
+        assert read_zip_members(f, HELLO_FILENAME) == []
+
+def test_read_nested_zip_members():
+    inner = io.BytesIO()
+    with zipfile.ZipFile(inner, "w") as zf:
+        zf.write(ZIPFILE_FILENAME, "hello.zip")
+    for (archive, count) in [(1, 1), (2, 2)]:
+        members = read_zip_members(inner, "outer.zip", archive=archive)
+        assert len(members) == count
+    assert members[0].path == "outer.zip/hello.zip/hello.txt"
+    assert members[0].hexdigest == HELLO_HASH
+    assert members[0].crc == zlib.crc32(HELLO_CONTENTS.encode())
+
+def make_tar(mode, members):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode=mode) as tf:
+        for (name, data) in members:
+            ti = tarfile.TarInfo(name)
+            ti.size = len(data)
+            ti.mtime = 1000
+            tf.addfile(ti, io.BytesIO(data))
+    return buf
+
+def test_read_tar_members():
+    with open(ZIPFILE_FILENAME, "rb") as f:
+        zipdata = f.read()
+    tgz = make_tar("w:gz", [("./dir/hello.txt", HELLO_CONTENTS.encode()), ("hello.zip", zipdata)])
+    members = read_tar_members(tgz, "a.tgz")
+    assert [(pf.path, pf.mtime, pf.file_size) for pf in members] == \
+        [("a.tgz/dir/hello.txt", 1000, len(HELLO_CONTENTS)), ("a.tgz/hello.zip", 1000, len(zipdata))]
+    assert members[0].hexdigest == HELLO_HASH
+    members = read_tar_members(tgz, "a.tgz", archive=2)
+    assert [pf.path for pf in members] == ["a.tgz/dir/hello.txt", "a.tgz/hello.zip/hello.txt", "a.tgz/hello.zip"]
+    assert read_tar_members(io.BytesIO(b"not a tarfile"), "b.tar") == []
+
+def test_archive_format():
+    with open(ZIPFILE_FILENAME, "rb") as f:
+        magic = f.read(MAGIC_BYTES)
+    assert archive_format("a.zip", magic, 100) == "zip"
+    assert archive_format("a.jar", magic, 100) is None
+    assert archive_format("a.tar.gz", b"\x1f\x8b\x08\x00", 100) == "tar"
+    assert archive_format("a.txt", b"\x1f\x8b\x08\x00", 100) is None
+    assert archive_format("a.tar", magic, 100, ArchiveOptions(("tar", "zip"), None)) == "tar"
+    assert archive_format("a.zip", magic, 100, ArchiveOptions(("tar",), None)) is None
+    assert archive_format("a.zip", magic, 100, ArchiveOptions(("zip",), 99)) is None
+
+def test_read_7z_members():
+    py7zr = py.test.importorskip("py7zr")
+    buf = io.BytesIO()
+    with py7zr.SevenZipFile(buf, "w") as sz:
+        sz.writestr(HELLO_CONTENTS.encode(), "dir/hello.txt")
+    assert archive_format("a.7z", buf.getvalue()[:MAGIC_BYTES], 100) == "7z"
+    members = ARCHIVE_READERS["7z"].read(buf, "a.7z")
+    assert [(pf.path, pf.file_size, pf.hexdigest) for pf in members] == \
+        [("a.7z/dir/hello.txt", len(HELLO_CONTENTS), HELLO_HASH)]
+
+
+class FakeS3:
+    """A stand-in for list_objects over a set of keys, with S3's delimiter semantics"""
+    def __init__(self, keys):
+        self.objects = {key: {'Key': key, 'Size': len(key), 'ETag': '"{}"'.format(hashlib.md5(key.encode()).hexdigest()),
+                              'LastModified': '2019-03-28T21:36:51.000Z'}
+                        for key in keys}
+
+    def list_objects(self, bucket, prefix, delimiter=None):
+        prefixes = set()
+        for key in sorted(self.objects):
+            if not key.startswith(prefix):
+                continue
+            if delimiter is not None and delimiter in key[len(prefix):]:
+                common = key[:key.index(delimiter, len(prefix)) + 1]
+                if common not in prefixes:
+                    prefixes.add(common)
+                    yield {'Prefix': common}
+                continue
+            yield dict(self.objects[key])
+
+def test_s3_sharded_listing():
+    import scandb
+    import tempfile
+    keys = ["top.txt"] + ["a{}/b{}/c{}.txt".format(i % 7, i % 3, i) for i in range(2500)] + ["z/only.txt"]
+    fake = FakeS3(keys)
+    with tempfile.NamedTemporaryFile(suffix='.dbfile') as tf:
+        sdb = scandb.SQLite3ScanDatabase(fname=tf.name)
+        sdb.create_database()
+        counts = []
+        for (scanid, kwargs) in enumerate([{'shard_depth': 0}, {'jobs': 4}, {'jobs': 3, 'shard_depth': 3},
+                                           {'jobs': 4, 'limit': 100}]):
+            sdb.scanid = sdb.get_scanid(scanid * 1000)
+            s = S3Scanner(sdb, list_objects=fake.list_objects, **kwargs)
+            s.ingest_walk("s3://bucket/")
+            s.finish()
+            counts.append(sdb.csfra("SELECT COUNT(*) FROM files WHERE scanid=%s", (sdb.scanid,))[0][0])
+        assert counts == [len(keys), len(keys), len(keys), 100]
+    assert s3_mtime('2019-03-28T21:36:51.000Z') == 1553809011
+
+def test_s3_write_error():
+    """An error writing objects is raised, rather than leaving the listing threads blocked on a full queue"""
+    import scandb
+    import scanner
+    import tempfile
+    import threading
+    fake = FakeS3(["k{}/obj{}".format(i % 4, i) for i in range(400)])
+    saved = (scanner.S3_PAGE_SIZE, scanner.S3_QUEUED_PAGES)
+    (scanner.S3_PAGE_SIZE, scanner.S3_QUEUED_PAGES) = (1, 2)
+    try:
+        with tempfile.NamedTemporaryFile(suffix='.dbfile') as tf:
+            sdb = scandb.SQLite3ScanDatabase(fname=tf.name)
+            sdb.create_database()
+            sdb.scanid = sdb.get_scanid(1000)
+            s = S3Scanner(sdb, list_objects=fake.list_objects, jobs=4)
+            def insert_object(obj):
+                raise RuntimeError("write failed")
+            s.insert_object = insert_object
+            errors = []
+            def walk():
+                try:
+                    s.ingest_walk("s3://bucket/")
+                except RuntimeError as e:
+                    errors.append(str(e))
+            t = threading.Thread(target=walk, daemon=True)
+            t.start()
+            t.join(30)
+            assert not t.is_alive()
+            assert errors == ["write failed"]
+    finally:
+        (scanner.S3_PAGE_SIZE, scanner.S3_QUEUED_PAGES) = saved
+
+def test_s3_incremental():
+    import scandb
+    import tempfile
+    fake = FakeS3(["k{}/obj{}".format(i % 5, i) for i in range(300)])
+    fake.objects["k0/obj0"]["ETag"] = '"{}-2"'.format(HELLO_HASH)      # a multipart upload
+    fake.objects["k1/obj1"]["ETag"] = '"{}"'.format(HELLO_HASH)
+    with tempfile.NamedTemporaryFile(suffix='.dbfile') as tf:
+        sdb = scandb.SQLite3ScanDatabase(fname=tf.name)
+        sdb.create_database()
+        def scan(when, incremental):
+            sdb.scanid = sdb.get_scanid(when)
+            s = S3Scanner(sdb, list_objects=fake.list_objects, jobs=2, incremental=incremental)
+            s.ingest_walk("s3://bucket/")
+            s.finish()
+            sdb.ingest_done(0)
+            return s
+        def contents(when):
+            return sorted((dirname, filename, mtime, size, scandb.hash_from_db(value, algorithm), algorithm)
+                          for (dirname, filename, mtime, size, value, algorithm) in sdb.csfra(
+                                  """SELECT dirname, filename, mtime, size, hash, algorithm
+                                     FROM files NATURAL JOIN paths NATURAL JOIN dirnames NATURAL JOIN filenames
+                                     JOIN hashes USING (hashid) WHERE scanid=%s""", (sdb.get_scanid(when),)))
+        scan(1000, False)
+        assert ('s3://bucket/k0', 'obj0', 1553809011, 7, HELLO_HASH + '-2', S3_MULTIPART_ALGORITHM) in contents(1000)
+        assert ('s3://bucket/k1', 'obj1', 1553809011, 7, HELLO_HASH, 'md5') in contents(1000)
+        assert len(set(row[4] for row in contents(1000) if row[4].startswith(HELLO_HASH))) == 2
+
+        del fake.objects["k2/obj2"]
+        fake.objects["k3/obj3"].update(ETag='"{}"'.format(HELLO_HASH), LastModified='2020-01-01T00:00:00.000Z')
+        fake.objects["k4/new"] = dict(fake.objects["k4/obj4"], Key="k4/new")
+        s = scan(2000, True)
+        assert (s.filecount, s.carried, len(fake.objects)) == (300, 298, 300)
+        scan(3000, False)
+        assert contents(2000) == contents(3000)
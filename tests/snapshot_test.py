@@ -0,0 +1,39 @@
+from snapshot import *
+
+ROWS = [("/a/b/c.txt", 1, 1000, 10, 7),
+        ("/a/b/d.txt", 2, 1001, 20, 8),
+        ("/a/e.zip/f", 3, 1002, 30, 9)]
+
+def check_index(index):
+    assert len(index) == len(ROWS)
+    for (path, pathid, mtime, size, hashid) in ROWS:
+        assert tuple(index.get(path)) == (pathid, mtime, size, hashid)
+    assert index.get("/a/b/x.txt") is None
+    index.close()
+
+def test_snapshot_index():
+    check_index(SnapshotIndex(ROWS))
+
+def test_mmap_snapshot_index():
+    check_index(MmapSnapshotIndex(len(ROWS), ROWS))
+    # Make sure that probing past collisions works when the table is as full as it can get
+    rows = [("/f{}".format(i), i, i, i, i) for i in range(1, 1000)]
+    index = MmapSnapshotIndex(len(rows), rows)
+    assert all(index.get(row[0]) == row[1:] for row in rows)
+    index.close()
+
+def test_make_index():
+    assert isinstance(make_index(len(ROWS), ROWS), SnapshotIndex)
+    assert isinstance(make_index(len(ROWS), ROWS, mmap_threshold=1), MmapSnapshotIndex)
+
+def test_find_archives():
+    rows = ROWS + [("/a/e.zip", 4, 1003, 40, 10)]
+    assert find_archives(SnapshotIndex(rows), {"/a/b", "/a/e.zip"}) == {"/a/e.zip"}
+    assert find_archives(SnapshotIndex(rows), {"/a/b", "/a/e.zip/g/h"}) == {"/a/e.zip"}
+    assert find_archives(SnapshotIndex(ROWS), {"/a/b", "/a/e.zip"}) == set()
+
+def test_digests():
+    rows = [row + (digest_key("{:032x}".format(row[4])),) for row in ROWS]
+    for index in [make_index(len(rows), rows, digests=True), make_index(len(rows), rows, mmap_threshold=1, digests=True)]:
+        assert tuple(index.get("/a/b/d.txt")) == (2, 1001, 20, 8, digest_key("{:032x}".format(8)))
+        index.close()